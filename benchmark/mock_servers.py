@@ -0,0 +1,228 @@
+"""In-process mock Forward and NetBox servers for the benchmark harness:
+Both APIs are served by the same HTTP server, the Forward endpoints
+answer from a synthetic network, the NetBox endpoints keep the objects
+created by the export in memory. Every request sleeps for the
+configured latency, writes add a per-object latency on top of it.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from common import get_codec
+
+codec = get_codec()
+
+# Nested references NetBox expands to {id, url, display, name}, and the collection they point to
+REFERENCES = {
+    "device": "devices",
+    "site": "sites",
+    "role": "device-roles",
+    "device_type": "device-types",
+    "manufacturer": "manufacturers",
+    "master": "devices",
+}
+CHOICE_FIELDS = ("status", "type")  # Fields NetBox expands to {value, label}
+BRIEF_FIELDS = {"id", "url", "display", "name", "description"}
+BRIEF_EXTRA_FIELDS = {
+    "device-types": {"manufacturer", "model", "slug"},
+    "interfaces": {"device"},
+    "virtual-device-contexts": {"device", "identifier"},
+}
+
+
+class MockNetbox:
+    """Minimal NetBox dcim API: paginated lists and bulk POST, PATCH and DELETE"""
+
+    def __init__(self, latency=0.0, write_latency=0.0, max_page_size=1000, fields_support=True):
+        self.latency = latency              # Seconds added to every request
+        self.write_latency = write_latency  # Seconds added per object written
+        self.max_page_size = max_page_size  # Like the NetBox MAX_PAGE_SIZE setting
+        self.fields_support = fields_support  # NetBox 4.0+ honors ?fields=
+        self.collections = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def _display(self, collection, obj):
+        return obj.get("model") if collection == "device-types" else obj.get("name")
+
+    def serialize(self, collection, obj) -> dict:
+        """Return an object the way the NetBox REST API renders it"""
+        result = dict(obj)
+        result["url"] = f"/api/dcim/{collection}/{obj['id']}/"
+        result["display"] = self._display(collection, obj)
+        for field, target in REFERENCES.items():
+            value = result.get(field)
+            if isinstance(value, int):
+                referenced = self.collections.get(target, {}).get(value, {})
+                result[field] = {"id": value, "url": f"/api/dcim/{target}/{value}/",
+                                 "display": self._display(target, referenced), "name": referenced.get("name")}
+        for field in CHOICE_FIELDS:
+            if isinstance(result.get(field), str):
+                result[field] = {"value": result[field], "label": result[field].title()}
+        if isinstance(result.get("vdcs"), list):
+            result["vdcs"] = [{"id": vdc} if isinstance(vdc, int) else vdc for vdc in result["vdcs"]]
+        return result
+
+    def list(self, collection, query) -> dict:
+        objects = list(self.collections.get(collection, {}).values())
+        if "last_updated__gte" in query:
+            objects = [obj for obj in objects if obj["last_updated"] >= query["last_updated__gte"][0]]
+        limit = min(int(query.get("limit", [50])[0]) or self.max_page_size, self.max_page_size)
+        offset = int(query.get("offset", [0])[0])
+        results = [self.serialize(collection, obj) for obj in objects[offset:offset + limit]]
+        if "fields" in query and self.fields_support:
+            fields = set(query["fields"][0].split(","))
+            results = [{key: value for key, value in obj.items() if key in fields} for obj in results]
+        elif query.get("brief", [""])[0].lower() in ("true", "1"):
+            fields = BRIEF_FIELDS | BRIEF_EXTRA_FIELDS.get(collection, set())
+            results = [{key: value for key, value in obj.items() if key in fields} for obj in results]
+        return {"count": len(objects), "next": None, "previous": None, "results": results}
+
+    @staticmethod
+    def _now():
+        return datetime.now(timezone.utc).isoformat()
+
+    def create(self, collection, items) -> list:
+        created = []
+        with self.lock:
+            objects = self.collections.setdefault(collection, {})
+            for item in items:
+                obj = dict(item, id=self.next_id, last_updated=self._now())
+                self.next_id += 1
+                objects[obj["id"]] = obj
+                created.append(obj)
+        return [self.serialize(collection, obj) for obj in created]
+
+    def update(self, collection, items) -> list:
+        updated = []
+        with self.lock:
+            objects = self.collections.setdefault(collection, {})
+            for item in items:
+                obj = objects.get(item.get("id"))
+                if obj is None:
+                    return None
+                obj.update(item, last_updated=self._now())
+                updated.append(obj)
+        return [self.serialize(collection, obj) for obj in updated]
+
+    def delete(self, collection, items):
+        with self.lock:
+            objects = self.collections.setdefault(collection, {})
+            for item in items:
+                objects.pop(item.get("id"), None)
+
+
+class MockForward:
+    """Minimal Forward API: latest processed snapshot and paginated NQE queries"""
+
+    def __init__(self, network: dict, latency=0.0, max_page_size=10000, snapshot_id="1"):
+        self.network = network  # NQE query id -> list of rows
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.snapshot_id = snapshot_id
+
+    def nqe(self, body) -> dict:
+        options = body.get("queryOptions", {})
+        offset = options.get("offset", 0)
+        limit = min(options.get("limit", self.max_page_size), self.max_page_size)
+        rows = self.network.get(body.get("queryId"), [])
+        return {"snapshotId": self.snapshot_id, "items": rows[offset:offset + limit], "totalNumItems": len(rows)}
+
+
+def make_handler(netbox: MockNetbox, forward: MockForward):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status, body=None):
+            data = codec.dumps(body) if body is not None else b""
+            self.send_response(status)
+            if body is not None:
+                self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return codec.loads(self.rfile.read(length)) if length else None
+
+        def _collection(self, path):
+            parts = path.strip("/").split("/")
+            if len(parts) == 3 and parts[:2] == ["api", "dcim"]:
+                return parts[2]
+            return None
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = url.path.strip("/").split("/")
+            if parts[:2] == ["api", "networks"] and parts[-2:] == ["snapshots", "latestProcessed"]:
+                time.sleep(forward.latency)
+                return self._reply(200, {"id": forward.snapshot_id, "state": "PROCESSED"})
+            collection = self._collection(url.path)
+            if collection is None:
+                return self._reply(404, {"detail": "Not found."})
+            time.sleep(netbox.latency)
+            self._reply(200, netbox.list(collection, parse_qs(url.query)))
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = self._body()
+            if url.path == "/api/nqe":
+                time.sleep(forward.latency)
+                return self._reply(200, forward.nqe(body))
+            self._write(url.path, body, netbox.create, 201)
+
+        def do_PATCH(self):
+            self._write(urlparse(self.path).path, self._body(), netbox.update, 200)
+
+        def do_DELETE(self):
+            url = urlparse(self.path)
+            body = self._body()
+            collection = self._collection(url.path)
+            if collection is None or not isinstance(body, list):
+                return self._reply(404, {"detail": "Not found."})
+            time.sleep(netbox.latency + netbox.write_latency * len(body))
+            netbox.delete(collection, body)
+            self._reply(204)
+
+        def _write(self, path, body, operation, status):
+            collection = self._collection(path)
+            if collection is None:
+                return self._reply(404, {"detail": "Not found."})
+            items = body if isinstance(body, list) else [body]
+            time.sleep(netbox.latency + netbox.write_latency * len(items))
+            results = operation(collection, items)
+            if results is None:
+                return self._reply(400, [{"id": ["Object not found."]}])
+            self._reply(status, results if isinstance(body, list) else results[0])
+
+    return Handler
+
+
+class MockServer:
+    """HTTP server running the mock Forward and NetBox APIs on a background thread"""
+
+    def __init__(self, netbox: MockNetbox, forward: MockForward, port=0):
+        self.netbox = netbox
+        self.forward = forward
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(netbox, forward))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
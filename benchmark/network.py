@@ -0,0 +1,74 @@
+"""Synthetic Forward network: the NQE query results of a network of a given size"""
+import random
+
+# Query ids used by the mock Forward server and the benchmark configuration
+QUERY_IDS = {
+    "locations_query_id": "locations",
+    "vendors_query_id": "vendors",
+    "device_types_query_id": "device_types",
+    "device_models_query_id": "models",
+    "devices_query_id": "devices",
+    "interfaces_query_id": "interfaces",
+    "virtual_device_contexts_query_id": "vdcs",
+    "virtual_chassis_query_id": "virtual_chassis",
+}
+
+VENDORS = ["Cisco", "Juniper", "Arista", "Palo Alto Networks", "F5"]
+DEVICE_TYPES = ["router", "switch", "firewall", "load_balancer"]
+INTERFACE_SPEEDS = [1000, 10000, 25000, 40000, 100000]  # Mbps, as reported by Forward
+
+
+def generate_network(devices: int, interfaces_per_device=24, vdc_ratio=0.05, vdcs_per_device=2,
+                     devices_per_site=50, models=40, seed=0) -> dict:
+    """Return the rows of every NQE query of the export for a synthetic network:
+    devices are spread over sites, a vdc_ratio share of them hosts
+    vdcs_per_device VDCs, and every device and VDC has
+    interfaces_per_device interfaces. The same seed gives the same network.
+    """
+    rng = random.Random(seed)
+    sites = [f"site-{i:05d}" for i in range(max(devices // devices_per_site, 1))]
+    model_rows = []
+    for i in range(models):
+        vendor = VENDORS[i % len(VENDORS)]
+        model_rows.append({"model": f"{vendor[:3].upper()}-{i:04d}", "slug": f"{vendor[:3].lower()}-{i:04d}",
+                           "part_number": f"PN-{i:06d}", "manufacturer": vendor})
+
+    device_rows, vdc_rows, interface_rows = [], [], []
+    for i in range(devices):
+        name = f"dev-{i:07d}"
+        model = model_rows[rng.randrange(models)]
+        device_rows.append({"name": name, "device_type": model["model"], "site": rng.choice(sites),
+                            "role": rng.choice(DEVICE_TYPES), "status": "active"})
+        hosts = [name]
+        if rng.random() < vdc_ratio:
+            for j in range(vdcs_per_device):
+                vdc = f"{name}-vdc{j}"
+                vdc_rows.append({"device": name, "name": vdc, "identifier": j + 1, "status": "active"})
+                hosts.append(vdc)
+        # VDC interfaces belong to the parent device in NetBox, each VDC gets its own module
+        for module, host in enumerate(hosts, 1):
+            for port in range(interfaces_per_device):
+                interface_rows.append({"device": host, "name": f"Ethernet{module}/{port + 1}",
+                                       "type": rng.choice(INTERFACE_SPEEDS), "speed": rng.choice(INTERFACE_SPEEDS),
+                                       "enabled": rng.random() > 0.1})
+
+    return {
+        QUERY_IDS["locations_query_id"]: [{"name": site} for site in sites],
+        QUERY_IDS["vendors_query_id"]: [{"name": vendor, "slug": vendor} for vendor in VENDORS + ["Unknown"]],
+        QUERY_IDS["device_types_query_id"]: [{"name": role, "slug": role} for role in DEVICE_TYPES],
+        QUERY_IDS["device_models_query_id"]: model_rows,
+        QUERY_IDS["devices_query_id"]: device_rows,
+        QUERY_IDS["interfaces_query_id"]: interface_rows,
+        QUERY_IDS["virtual_device_contexts_query_id"]: vdc_rows,
+        QUERY_IDS["virtual_chassis_query_id"]: [],
+    }
+
+
+def mutate_network(network: dict, ratio=0.01, seed=1) -> int:
+    """Change the speed of a ratio of the interfaces, for steady-state runs with a few updates"""
+    rng = random.Random(seed)
+    interfaces = network[QUERY_IDS["interfaces_query_id"]]
+    changed = rng.sample(range(len(interfaces)), int(len(interfaces) * ratio)) if interfaces else []
+    for i in changed:
+        interfaces[i] = dict(interfaces[i], speed=interfaces[i]["speed"] * 10)
+    return len(changed)
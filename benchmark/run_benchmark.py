@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""Time the export stages against the mock Forward and NetBox servers:
+For every network size, a greenfield run creates everything in an
+empty NetBox, then a steady-state run syncs the same network again
+after a share of the interfaces changed. The stage timings, CPU time
+and request counts of each run are written to the results directory
+and compared with the results of the previous benchmark.
+
+Example:
+    python benchmark/run_benchmark.py --sizes 1000 10000 --latency 0.005
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import init_logging, logging  # noqa: E402
+from export_to_netbox import schedule_stages  # noqa: E402
+from forward_interface import ForwardAPI  # noqa: E402
+from metrics import Metrics, compare_reports  # noqa: E402
+from netbox_interface import NetboxAPI  # noqa: E402
+from network import QUERY_IDS, generate_network, mutate_network  # noqa: E402
+from mock_servers import MockForward, MockNetbox, MockServer  # noqa: E402
+
+DEFAULT_RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def benchmark_config(url: str, args) -> dict:
+    """Return an export configuration pointing both APIs to the mock server"""
+    return {
+        "debug": False,
+        "add_sites": True,
+        "add_manufacturers": True,
+        "add_device_roles": True,
+        "add_device_types": True,
+        "add_devices": True,
+        "add_interfaces": True,
+        "add_virtual_device_contexts": True,
+        "add_virtual_chassis": False,
+        "stage_workers": args.stage_workers,
+        "streaming": args.streaming,
+        "forward": {
+            "host": url,
+            "authentication": "Basic benchmark",
+            "network_id": "benchmark",
+            "timeout": 300,
+            "nqe_limit": args.nqe_limit,
+            "workers": args.workers,
+            "nqe": QUERY_IDS,
+        },
+        "netbox": {
+            "host": url,
+            "authentication": "Token benchmark",
+            "timeout": 300,
+            "request_limit": args.page_limit,
+            "post_limit": args.post_limit,
+            "workers": args.workers,
+        },
+    }
+
+
+def run_export(config: dict) -> dict:
+    """Run every export stage once and return the metrics report of the run"""
+    run_metrics = Metrics()
+    forward = ForwardAPI(config["forward"], metrics=run_metrics)
+    netbox = NetboxAPI(config["netbox"], metrics=run_metrics)
+    try:
+        forward.pin_snapshot()
+        scheduler = schedule_stages(config, forward, netbox)
+        try:
+            scheduler.run()
+        finally:
+            run_metrics.record_stages(scheduler)
+    finally:
+        forward.close()
+        netbox.close()
+    report = run_metrics.report()
+    report["bulk_failures"] = len(netbox.bulk_failures)
+    return report
+
+
+def benchmark_size(devices: int, args) -> dict:
+    """Benchmark a greenfield and a steady-state run on a network of the given number of devices"""
+    started = time.perf_counter()
+    network = generate_network(devices, args.interfaces, args.vdc_ratio, seed=args.seed)
+    counts = {query: len(rows) for query, rows in network.items()}
+    logging.info("Generated %d devices, %d VDCs and %d interfaces in %.1fs", counts["devices"], counts["vdcs"],
+                 counts["interfaces"], time.perf_counter() - started)
+
+    netbox = MockNetbox(args.latency, args.write_latency, args.page_limit, not args.no_fields)
+    forward = MockForward(network, args.latency, args.nqe_limit)
+    server = MockServer(netbox, forward).start()
+    try:
+        config = benchmark_config(server.url, args)
+        runs = {}
+        for run in ("greenfield", "steady_state"):
+            if run == "steady_state":
+                changed = mutate_network(network, args.change_ratio, seed=args.seed + 1)
+                logging.info("Changed the speed of %d interfaces", changed)
+            logging.info("=====> %d devices, %s run", devices, run)
+            runs[run] = run_export(config)
+            logging.info("%s run took %.2fs", run, runs[run]["stages_wall_seconds"] or 0)
+    finally:
+        server.stop()
+
+    return {
+        "devices": devices,
+        "network": counts,
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("sizes", "results_dir")},
+        "runs": runs,
+    }
+
+
+def record_result(result: dict, results_dir: str, threshold: float):
+    """Write the result of a size, compared with the previous result of the same size"""
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, f"devices_{result['devices']}.json")
+    if os.path.exists(path):
+        with open(path, "r", encoding="UTF-8") as f:
+            previous = json.load(f)
+        if previous.get("parameters") != result["parameters"]:
+            logging.warning("Benchmark parameters changed since %s, the comparison may not be meaningful", path)
+        result["comparison"] = {run: compare_reports(previous["runs"][run], report, threshold)
+                                for run, report in result["runs"].items() if run in previous.get("runs", {})}
+    with open(path, "w", encoding="UTF-8") as f:
+        json.dump(result, f, indent=2)
+    logging.info("Results written to %s", path)
+
+
+def print_summary(results: list):
+    """Print the wall time of each stage for every size and run"""
+    stages = sorted({stage for result in results for report in result["runs"].values()
+                     for stage in report["stages"] if not stage.startswith("fetch_")})
+    header = f"{'devices':>8} {'run':<13}" + "".join(f"{stage:>16}" for stage in stages) + f"{'total':>10}"
+    print(header)
+    for result in results:
+        for run, report in result["runs"].items():
+            cells = "".join(f"{report['stages'].get(stage, {}).get('wall_seconds', 0):>16.2f}" for stage in stages)
+            print(f"{result['devices']:>8} {run:<13}{cells}{report['stages_wall_seconds'] or 0:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="Numbers of devices")
+    parser.add_argument("--interfaces", type=int, default=24, help="Interfaces per device and VDC")
+    parser.add_argument("--vdc-ratio", type=float, default=0.05, help="Share of the devices hosting VDCs")
+    parser.add_argument("--change-ratio", type=float, default=0.01,
+                        help="Share of the interfaces changed before the steady-state run")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every mock request")
+    parser.add_argument("--write-latency", type=float, default=0.0, help="Seconds added per object written")
+    parser.add_argument("--page-limit", type=int, default=1000, help="NetBox page size and maximum page size")
+    parser.add_argument("--nqe-limit", type=int, default=10000, help="Forward NQE page size")
+    parser.add_argument("--post-limit", type=int, default=1000, help="Initial NetBox bulk write chunk size")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent requests per connector")
+    parser.add_argument("--stage-workers", type=int, default=4, help="Concurrent export stages")
+    parser.add_argument("--streaming", action="store_true", help="Stream the interfaces stage")
+    parser.add_argument("--no-fields", action="store_true", help="Emulate a NetBox release ignoring ?fields=")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic network")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Regression threshold of the comparison")
+    parser.add_argument("--results-dir", default=DEFAULT_RESULTS_DIR, help="Where the results are recorded")
+    args = parser.parse_args()
+
+    init_logging()
+    logging.getLogger().setLevel(logging.INFO)
+    results = []
+    for devices in args.sizes:
+        result = benchmark_size(devices, args)
+        record_result(result, args.results_dir, args.threshold)
+        results.append(result)
+    print_summary(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,201 @@
 import logging
+import logging.handlers
 import json
 import os
+import queue
+import random
 import requests
-from datetime import datetime
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from records import to_payload
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # === Logging Setup ===
 
-# Timestamp for this run
-timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+# Timestamp for this run, set by init_logging
+timestamp = None
 
 # Directory for logs
 log_dir = "logs"
-os.makedirs(log_dir, exist_ok=True)
 
 # Dictionary to store loggers
 loggers = {}
 
-# Initialize the root logger
+# Root logger, configured by init_logging rather than on import
 root_logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
 
 # Console handler (INFO and above)
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 console_formatter = logging.Formatter('[%(levelname)s] %(message)s')
 console_handler.setFormatter(console_formatter)
-root_logger.addHandler(console_handler)
+
+# Background thread writing the console and log files, see setup_loggers
+log_listener = None
+queue_handler = None
+
+# Above this number of objects, stages log one aggregate line instead of one line per object
+log_item_threshold = 100
+
+
+def init_logging():
+    """Log to the console and create the logs directory, once per process:
+    Importing this module has no side effect, scripts call this,
+    or setup_loggers, before logging.
+    """
+    global timestamp
+    if timestamp is not None:
+        return
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    os.makedirs(log_dir, exist_ok=True)
+    root_logger.setLevel(logging.DEBUG)
+    root_logger.addHandler(console_handler)
+
 
 # Dynamically create named loggers based on config keys
 def setup_loggers(config):
-    """Create per-feature log files based on config flags like add_devices, add_interfaces, etc."""
+    """Create per-feature log files based on config flags like add_devices, add_interfaces, etc.
+    Records are queued by the logging threads and written to the
+    console and the files by a single background listener thread,
+    call stop_loggers() to flush them before exiting.
+    """
+    global log_listener, queue_handler, log_item_threshold
+    init_logging()
+    stop_loggers()
+    log_item_threshold = config.get("log_item_threshold", 100)
+
     feature_keys = [k for k in config.keys() if k.startswith("add_") and config[k]]
+    handlers = [console_handler]
+    # Debug records, and the LazyDump arguments formatted when they are queued, only exist in debug runs
+    level = logging.DEBUG if config.get("debug") else logging.INFO
 
-    for key in feature_keys:
-        name = key.replace("add_", "")
+    for name in [key.replace("add_", "") for key in feature_keys] + ["general"]:
         log_file = os.path.join(log_dir, f"{name}_{timestamp}.log")
 
         feature_logger = logging.getLogger(name)
         file_handler = logging.FileHandler(log_file, mode='w')
         file_handler.setLevel(logging.DEBUG)
         file_handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s:%(name)s:%(message)s'))
+        file_handler.addFilter(logging.Filter(name))  # Only the records of this feature logger
+        handlers.append(file_handler)
 
-        feature_logger.addHandler(file_handler)
-        feature_logger.setLevel(logging.DEBUG)
-
+        feature_logger.setLevel(level)
         loggers[name] = feature_logger
 
-    # Always create a general fallback logger
-    general_log_file = os.path.join(log_dir, f"general_{timestamp}.log")
-    general_logger = logging.getLogger("general")
-    file_handler = logging.FileHandler(general_log_file, mode='w')
-    file_handler.setLevel(logging.DEBUG)
-    file_handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s:%(name)s:%(message)s'))
-    general_logger.addHandler(file_handler)
-    general_logger.setLevel(logging.DEBUG)
-    loggers["general"] = general_logger
+    # Feature loggers propagate to the root logger, whose only handler is the queue
+    queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    log_listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    root_logger.removeHandler(console_handler)
+    root_logger.addHandler(queue_handler)
+    log_listener.start()
+
+
+def stop_loggers():
+    """Write the queued log records, close the log files and log to the console synchronously again"""
+    global log_listener, queue_handler
+    if log_listener is None:
+        return
+    log_listener.stop()
+    for handler in log_listener.handlers:
+        if handler is not console_handler:
+            handler.close()
+    root_logger.removeHandler(queue_handler)
+    root_logger.addHandler(console_handler)
+    log_listener = None
+    queue_handler = None
+
+
+class _LogRelay(logging.Handler):
+    """Hand the records of the worker processes to the logger they were emitted with"""
+
+    def handle(self, record):
+        logging.getLogger(record.name).handle(record)
+        return True
+
+
+class _LogPrefix(logging.Filter):
+    """Prepend the prefix of a worker process, the network it syncs, to its records"""
+    prefix = ""
+
+    def filter(self, record):
+        if self.prefix:
+            record.msg = f"{self.prefix}{record.getMessage()}"
+            record.args = None
+        return True
+
+
+log_prefix = _LogPrefix()
+
+
+def start_log_relay(log_queue):
+    """Log the records that worker processes put in log_queue like the records of this process,
+    returns the listener to pass to stop_log_relay().
+    """
+    relay = logging.handlers.QueueListener(log_queue, _LogRelay())
+    relay.start()
+    return relay
+
+
+def stop_log_relay(relay):
+    relay.stop()
+
+
+def setup_worker_loggers(config, log_queue):
+    """Send the records of a worker process to the log_queue relayed by the main process"""
+    global log_item_threshold
+    log_item_threshold = config.get("log_item_threshold", 100)
+    for name in [key.replace("add_", "") for key in config if key.startswith("add_") and config[key]] + ["general"]:
+        loggers[name] = logging.getLogger(name)
+        loggers[name].setLevel(logging.DEBUG if config.get("debug") else logging.INFO)
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(log_prefix)
+    for existing in list(root_logger.handlers):
+        root_logger.removeHandler(existing)
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.DEBUG if config.get("debug") else logging.INFO)
+
+
+def set_log_prefix(prefix: str):
+    log_prefix.prefix = prefix
+
+
+class LazyDump:
+    """Log argument rendering a record list only when the message is emitted, truncated to limit items"""
+
+    def __init__(self, obj, limit=20):
+        self.obj = obj
+        self.limit = limit
+
+    def __str__(self):
+        if isinstance(self.obj, (list, tuple)) and len(self.obj) > self.limit:
+            shown = ", ".join(repr(item) for item in self.obj[:self.limit])
+            return f"[{shown}, ... {len(self.obj) - self.limit} more]"
+        if isinstance(self.obj, dict) and len(self.obj) > self.limit:
+            shown = ", ".join(f"{key!r}: {value!r}" for key, value in list(self.obj.items())[:self.limit])
+            return f"{{{shown}, ... {len(self.obj) - self.limit} more}}"
+        return repr(self.obj)
+
+
+def log_objects(log, action: str, kind: str, objects: list, name_field="name", with_id=False):
+    """Log one line per object, or a single line once there are more than log_item_threshold objects"""
+    if len(objects) > log_item_threshold:
+        log.info("%s %d %s objects", action, len(objects), kind)
+        log.debug("%s %s: %s", action, kind, LazyDump([obj.get(name_field) for obj in objects], 100))
+        return
+    for obj in objects:
+        if with_id:
+            log.info("%s %s: %s (id %s)", action, kind, obj[name_field], obj["id"])
+        else:
+            log.info("%s %s: %s", action, kind, obj[name_field])
 
 
 # === Utility Functions ===
@@ -64,11 +205,11 @@ def print_variables(config):
     logging.debug("======================== Configuration.yaml variables")
     for key, value in config.items():
         if isinstance(value, dict):
-            logging.debug(f"{key}:")
+            logging.debug("%s:", key)
             for subkey, subvalue in value.items():
-                logging.debug(f"  {subkey}: {subvalue}")
+                logging.debug("  %s: %s", subkey, subvalue)
         else:
-            logging.debug(f"{key}: {value}")
+            logging.debug("%s: %s", key, value)
     logging.debug("======================== Configuration.yaml variables end")
 
 
@@ -77,62 +218,378 @@ def create_slug(name):
     return name.lower().replace(' ', '-')
 
 
+# === JSON Codecs ===
+
+class JsonCodec:
+    """Standard library JSON encoding of request bodies and decoding of responses,
+    records are converted to dictionaries while they are encoded.
+    """
+
+    name = "json"
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), default=to_payload).encode("utf-8")
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """orjson encoding and decoding, several times faster on large pages"""
+
+    name = "orjson"
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, default=to_payload, option=orjson.OPT_NON_STR_KEYS)
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+
+def get_codec(name=None) -> JsonCodec:
+    """Return the JSON codec called name, by default the fastest one installed"""
+    if name in (None, "auto"):
+        name = "orjson" if orjson is not None else "json"
+    if name == "orjson":
+        if orjson is None:
+            logging.warning("orjson is not installed, using the standard library JSON codec")
+            return JsonCodec()
+        return OrjsonCodec()
+    if name == "json":
+        return JsonCodec()
+    raise ValueError(f"Unknown JSON codec: {name}")
+
+
 # === API Connector ===
 
+class RateLimiter:
+    """Token bucket allowing rate requests per second, shared by all the threads of a connector"""
+
+    def __init__(self, rate: float, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SharedRateLimiter(RateLimiter):
+    """Token bucket shared by the processes of a run, the tokens live in shared memory:
+    Created from the multiprocessing context of the pool and handed
+    to the worker processes when they start, like a semaphore.
+    """
+
+    def __init__(self, context, rate: float, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst else max(rate, 1)
+        self._state = context.RawArray("d", [self.capacity, time.monotonic()])  # tokens, updated
+        self.lock = context.Lock()
+
+    @property
+    def tokens(self):
+        return self._state[0]
+
+    @tokens.setter
+    def tokens(self, value):
+        self._state[0] = value
+
+    @property
+    def updated(self):
+        return self._state[1]
+
+    @updated.setter
+    def updated(self, value):
+        self._state[1] = value
+
+
 class ApiConnector:
     """Generic class to handle API connections"""
 
-    def __init__(self, host: str, authentication: str, http_headers, ssl_verify=True, timeout=30):
+    RETRY_STATUSES = (429, 502, 503, 504)
+    service = "api"  # Label of the requests of this connector in the run metrics
+
+    def __init__(self, host: str, authentication: str, http_headers, ssl_verify=True, timeout=30,
+                 pool_size=10, keep_alive=True, workers=4,
+                 retries=3, backoff_factor=0.5, backoff_max=30, rate_limit=None, rate_burst=None,
+                 json_codec=None, metrics=None):
         self.host = host
         self.authentication = authentication
         self.http_headers = http_headers
         self.timeout = timeout
         self.ssl_verify = ssl_verify
-
-    def _request(self, method: str, path: str, headers=None, payload=None):
-        """Generic HTTP method handler"""
+        self.workers = workers  # Concurrent requests for paginated reads
+        self.retries = retries
+        self.backoff_factor = backoff_factor  # Seconds, doubled at each retry
+        self.backoff_max = backoff_max
+        self.rate_limiter = RateLimiter(rate_limit, rate_burst) if rate_limit else None
+        self.concurrency = None  # Semaphore bounding the requests in flight, shared by the processes of a run
+        self.codec = get_codec(json_codec)
+        self.metrics = metrics  # metrics.Metrics recording every request, None to disable
+        self.plan = None        # plan.Plan recording the writes instead of sending them (dry run)
+        self.recording = None   # Read responses saved by start_recording(), request key -> encoded body
+        self.replay = None      # Read responses served instead of sending the requests (offline)
+        self._recording_lock = threading.Lock()
+        self.idempotent_posts = False  # Whether POST requests can be retried like GET ones
+        self.retry_count = 0
+        self.session = self._create_session(pool_size, keep_alive)
+        self.error_count = 0  # Failed requests, used to tell whether a run completed cleanly
+        self.bulk_failures = []  # Records rejected by bulk writes
+        self._error_lock = threading.Lock()
+        self._chunk_sizes = {}  # (method, path) -> adaptive bulk write chunk size
+
+    def reset_run_state(self):
+        """Forget the errors and failures of the previous run, the connections and chunk sizes stay warm"""
+        with self._error_lock:
+            self.error_count = 0
+            self.retry_count = 0
+        self.bulk_failures = []
+
+    @staticmethod
+    def _create_session(pool_size: int, keep_alive: bool):
+        """Create a pooled HTTP session shared by all the requests of this connector.
+        The pool blocks when all its connections are busy, so concurrent workers
+        wait for a connection to be released instead of opening throwaway ones.
+        Headers are passed per request, the session itself is never mutated
+        afterwards, which makes it safe to share across worker threads."""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not keep_alive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def connection_stats(self) -> dict:
+        """Return the number of requests sent and of connections opened by this connector"""
+        sent = opened = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    sent += pool.num_requests
+                    opened += pool.num_connections
+        return {"requests": sent, "connections": opened, "reused": max(sent - opened, 0)}
+
+    def close(self):
+        """Close all the pooled connections"""
+        self.session.close()
+
+    def _map_concurrently(self, func, items) -> list:
+        """Call func on every item using up to self.workers threads, results keep the input order"""
+        items = list(items)
+        if not items:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(items))) as executor:
+            return list(executor.map(func, items))
+
+    def _iter_concurrently(self, func, items):
+        """Yield func(item) for every item in input order, with at most self.workers calls in flight"""
+        items = iter(items)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque(executor.submit(func, item) for item in islice(items, self.workers))
+            while pending:
+                result = pending.popleft().result()
+                pending.extend(executor.submit(func, item) for item in islice(items, 1))
+                yield result
+
+    def _send(self, method: str, path: str, headers=None, payload=None, retry_statuses=None):
+        """Send an HTTP request and return the response, None when it could not be sent:
+        Requests go through the rate limiter. Connection errors and
+        retry_statuses answers are retried with jittered exponential
+        backoff, or after the delay given by a Retry-After header.
+        Requests that are not idempotent are only retried when the
+        server did not process them (429, 503, connection timeout).
+        The payload is encoded with the connector codec unless it is
+        already encoded bytes.
+        """
         method = method.upper()
         url = f"{self.host}{path}"
         if headers is None:
             headers = self.http_headers
+        if retry_statuses is None:
+            retry_statuses = self.RETRY_STATUSES
+        idempotent = method != "POST" or self.idempotent_posts
 
         logging.debug("Launching %s request to: %s", method, url)
 
-        try:
-            match method:
-                case "GET":
-                    response = requests.get(url, headers=headers, timeout=self.timeout, verify=self.ssl_verify)
-                case "POST":
-                    response = requests.post(url, headers=headers, data=json.dumps(payload),
-                                             timeout=self.timeout, verify=self.ssl_verify)
-                case "PATCH":
-                    response = requests.patch(url, headers=headers, data=json.dumps(payload),
-                                              timeout=self.timeout, verify=self.ssl_verify)
-                case "PUT":
-                    response = requests.put(url, headers=headers, data=json.dumps(payload),
-                                            timeout=self.timeout, verify=self.ssl_verify)
-                case "DELETE":
-                    response = requests.delete(url, headers=headers, data=json.dumps(payload),
-                                               timeout=self.timeout, verify=self.ssl_verify)
-                case _:
-                    raise ValueError(f"Unsupported HTTP method: {method}")
-
-            if response.status_code >= 400:
-                logging.warning("Request failed [%s %s] %d: %s",
-                                method, path, response.status_code, response.text)
+        match method:
+            case "GET":
+                data = None
+            case "POST" | "PATCH" | "PUT" | "DELETE":
+                data = payload if isinstance(payload, bytes) else self.codec.dumps(payload)
+            case _:
+                raise ValueError(f"Unsupported HTTP method: {method}")
+
+        for attempt in range(self.retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            started = time.perf_counter()
+            try:
+                if self.concurrency is None:
+                    response = self.session.request(method, url, headers=headers, data=data,
+                                                    timeout=self.timeout, verify=self.ssl_verify)
+                else:
+                    with self.concurrency:
+                        response = self.session.request(method, url, headers=headers, data=data,
+                                                        timeout=self.timeout, verify=self.ssl_verify)
+            except requests.RequestException as e:
+                if self.metrics is not None:
+                    self.metrics.observe_request(self.service, method, path, None, time.perf_counter() - started,
+                                                 len(data or b""), 0)
+                retryable = idempotent or isinstance(e, requests.ConnectTimeout)
+                if attempt < self.retries and retryable:
+                    self._wait_before_retry(attempt, method, path, str(e))
+                    continue
+                logging.error("Request failed with exception: %s", str(e))
+                self._count_error()
                 return None
 
-            content_type = response.headers.get("Content-Type", "")
-            if "application/json" in content_type:
-                return response.json()
-            else:
-                logging.warning("Unexpected Content-Type in response: %s", content_type)
-                return None
+            status = response.status_code
+            if self.metrics is not None:
+                self.metrics.observe_request(self.service, method, path, status, time.perf_counter() - started,
+                                             len(data or b""), len(response.content))
+            if attempt < self.retries and status in retry_statuses and (idempotent or status in (429, 503)):
+                self._wait_before_retry(attempt, method, path, status, self._retry_after(response))
+                continue
+            return response
+
+    def _wait_before_retry(self, attempt: int, method: str, path: str, reason, delay=None):
+        """Sleep before a retry, for delay seconds or a jittered exponential backoff"""
+        if delay is None:
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_factor * 2 ** attempt))
+        with self._error_lock:
+            self.retry_count += 1
+        if self.metrics is not None:
+            self.metrics.observe_retry(self.service, method, path)
+        logging.warning("Retrying %s %s in %.1fs (attempt %d of %d): %s",
+                        method, path, delay, attempt + 1, self.retries, reason)
+        time.sleep(delay)
+
+    @staticmethod
+    def _retry_after(response):
+        """Return the delay in seconds requested by a Retry-After header, None without one"""
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return None
 
-        except requests.RequestException as e:
-            logging.error("Request failed with exception: %s", str(e))
+    def _decode(self, response):
+        """Return the JSON body of a response, None when it has none"""
+        if "application/json" not in response.headers.get("Content-Type", ""):
+            return None
+        try:
+            return self.codec.loads(response.content)
+        except ValueError:
             return None
 
+    def _request(self, method: str, path: str, headers=None, payload=None):
+        """Generic HTTP method handler"""
+        method = method.upper()
+        is_read = method == "GET" or (method == "POST" and self.idempotent_posts)
+        if self.plan is not None and not is_read:
+            data = self._plan_write(method, path, payload if isinstance(payload, list) else [payload])
+            return data if isinstance(payload, list) else data[0]
+        if self.replay is not None and is_read:
+            return self._replay(method, path, payload)
+
+        response = self._send(method, path, headers, payload)
+        if response is None:
+            if method != "GET":
+                self._on_write(method, path, None)
+            return None
+
+        if response.status_code >= 400:
+            logging.warning("Request failed [%s %s] %d: %s",
+                            method, path, response.status_code, response.text)
+            self._count_error()
+            if method != "GET":
+                self._on_write(method, path, None)
+            return None
+
+        data = self._decode(response)
+        if data is None:
+            logging.warning("Unexpected Content-Type in response: %s", response.headers.get("Content-Type", ""))
+        elif self.recording is not None and is_read:
+            with self._recording_lock:
+                self.recording[self._request_key(method, path, payload)] = response.content
+        if method != "GET":
+            self._on_write(method, path, data)
+        return data
+
+    # === Dry runs and offline replay ===
+
+    def _plan_write(self, method: str, path: str, records: list) -> list:
+        """Record a write in the plan and return the objects NetBox would have sent back"""
+        results = self.plan.record(method, path, records)
+        if method == "POST":
+            self._on_write(method, path, results)  # Planned objects can be referenced by the next stages
+        return results
+
+    @staticmethod
+    def _request_key(method: str, path: str, payload=None) -> str:
+        body = json.dumps(payload, sort_keys=True, default=to_payload) if payload is not None else ""
+        return f"{method} {path} {body}"
+
+    def start_recording(self):
+        """Save the body of every read response from now on, see save_recording()"""
+        self.recording = {}
+
+    def save_recording(self, path: str):
+        """Write the recorded read responses to a dump file that load_replay() can serve offline"""
+        responses = {key: self.codec.loads(body) for key, body in self.recording.items()}
+        with open(path, "wb") as f:
+            f.write(self.codec.dumps({"host": self.host, "responses": responses}))
+        logging.info("Saved %d %s responses to %s", len(responses), self.service, path)
+
+    def load_replay(self, path: str):
+        """Serve the reads from a dump file instead of the API, for offline dry runs"""
+        with open(path, "rb") as f:
+            dump = self.codec.loads(f.read())
+        # Kept encoded, every read decodes a fresh copy the caller can modify
+        self.replay = {key: self.codec.dumps(body) for key, body in dump["responses"].items()}
+        logging.info("Loaded %d %s responses from %s", len(self.replay), self.service, path)
+
+    def _replay(self, method: str, path: str, payload=None):
+        body = self.replay.get(self._request_key(method, path, payload))
+        if body is None:
+            logging.warning("No saved response for %s %s, the dump was taken with a different configuration",
+                            method, path)
+            self._count_error()
+            return None
+        return self.codec.loads(body)
+
+    def _on_write(self, method: str, path: str, data):
+        """Called after every write with the decoded response, None when the write failed"""
+
+    def _count_error(self):
+        with self._error_lock:
+            self.error_count += 1
+
     def _get(self, path: str, headers=None):
         return self._request("GET", path, headers)
 
@@ -145,20 +602,142 @@ class ApiConnector:
     def _put(self, path: str, payload, headers=None):
         return self._request("PUT", path, headers, payload)
 
-    def _bulkpost(self, path: str, payload_list: list):
-        for i in range(0, len(payload_list), self.post_limit):
-            chunk = payload_list[i:i + self.post_limit]
-            logging.debug(f"POSTing chunk of {len(chunk)} items to {path}")
-            self._request("POST", path, self.http_headers, payload=chunk)
-
-    def _bulkpatch(self, path: str, payload_list: list):
-        for i in range(0, len(payload_list), self.post_limit):
-            chunk = payload_list[i:i + self.post_limit]
-            logging.debug(f"PATCHing chunk of {len(chunk)} items to {path}")
-            self._request("PATCH", path, self.http_headers, payload=chunk)
-
-    def _bulkdelete(self, path: str, payload_list: list):
-        for i in range(0, len(payload_list), self.post_limit):
-            chunk = payload_list[i:i + self.post_limit]
-            logging.debug(f"DELETEing chunk of {len(chunk)} items from {path}")
-            self._request("DELETE", path, self.http_headers, payload=chunk)
+    def _bulkpost(self, path: str, payload_list: list) -> list:
+        """POST a list of objects in adaptive chunks and return the created objects"""
+        return self._bulkwrite("POST", path, payload_list)
+
+    def _bulkpatch(self, path: str, payload_list: list) -> list:
+        """PATCH a list of objects in adaptive chunks and return the updated objects"""
+        return self._bulkwrite("PATCH", path, payload_list)
+
+    def _bulkdelete(self, path: str, payload_list: list) -> list:
+        """DELETE a list of objects in adaptive chunks and return the deleted records"""
+        return self._bulkwrite("DELETE", path, payload_list)
+
+    def _bulkwrite(self, method: str, path: str, payload_list: list) -> list:
+        """Send a bulk write in chunks and return the objects sent back:
+        The chunk size starts at post_limit for each endpoint, grows
+        up to max_post_limit while chunks complete well under
+        bulk_target_latency seconds and shrinks when they take longer.
+        A 413 or 504 halves the chunk and resends it. A chunk failing
+        validation is narrowed down to its invalid records, which are
+        logged and kept in bulk_failures, the valid ones are written.
+        On dry runs the whole list is recorded in the plan instead.
+        The next chunk is encoded while the current one is in flight,
+        and encoded again if the chunk size changes in the meantime.
+        """
+        if self.plan is not None:
+            return self._plan_write(method, path, payload_list)
+        results = []
+        size = self._chunk_sizes.get((method, path), self.post_limit)
+        i = 0
+        ahead = None  # (offset, length, future) of the chunk encoded ahead
+        with ThreadPoolExecutor(max_workers=1) as encoder:
+            while i < len(payload_list):
+                chunk = payload_list[i:i + size]
+                if ahead is not None and ahead[:2] == (i, len(chunk)):
+                    body = ahead[2].result()
+                else:
+                    body = self.codec.dumps(chunk)
+                following = i + len(chunk)
+                ahead = None
+                if following < len(payload_list):
+                    next_chunk = payload_list[following:following + size]
+                    ahead = (following, len(next_chunk), encoder.submit(self.codec.dumps, next_chunk))
+
+                logging.debug("%s chunk of %d items to %s", method, len(chunk), path)
+                started = time.perf_counter()
+                # A 504 shrinks the chunk rather than resending the same one
+                response = self._send(method, path, self.http_headers, body, retry_statuses=(429, 502, 503))
+                elapsed = time.perf_counter() - started
+                status = response.status_code if response is not None else None
+
+                if status in (413, 504) and len(chunk) > 1:
+                    size = max(len(chunk) // 2, 1)
+                    logging.info("%s %s answered %s for %d items, resending in chunks of %d",
+                                 method, path, status, len(chunk), size)
+                    continue
+
+                if status is not None and status < 400:
+                    results.extend(self._chunk_results(method, path, chunk, response))
+                    if len(chunk) == size:
+                        size = self._adapt_chunk_size(size, elapsed)
+                elif status == 400:
+                    results.extend(self._isolate_failures(method, path, chunk, response))
+                else:
+                    error = response.text if response is not None else "request not sent"
+                    self._record_failures(method, path, chunk, status, error)
+                i += len(chunk)
+
+        self._chunk_sizes[(method, path)] = size
+        return results
+
+    def _adapt_chunk_size(self, size: int, elapsed: float) -> int:
+        """Return the size of the next chunk given the latency of the last full one"""
+        if elapsed > self.bulk_target_latency:
+            new_size = max(size // 2, 1)
+        elif elapsed < self.bulk_target_latency / 2:
+            new_size = min(size + max(size // 2, 1), self.max_post_limit)
+        else:
+            return size
+        if new_size != size:
+            logging.debug("Chunk of %d items took %.2fs, next chunks hold %d items", size, elapsed, new_size)
+        return new_size
+
+    def _chunk_results(self, method: str, path: str, chunk: list, response) -> list:
+        """Return the objects of a successful chunk and notify the write"""
+        if method == "DELETE":
+            self._on_write(method, path, None)
+            return chunk
+        data = self._decode(response)
+        self._on_write(method, path, data)
+        return data if isinstance(data, list) else []
+
+    def _write_isolating_failures(self, method: str, path: str, chunk: list) -> list:
+        """Send a chunk, narrowing it down to its invalid records when it fails validation"""
+        response = self._send(method, path, self.http_headers, chunk, retry_statuses=(429, 502, 503))
+        status = response.status_code if response is not None else None
+        if status is not None and status < 400:
+            return self._chunk_results(method, path, chunk, response)
+        if status == 400:
+            return self._isolate_failures(method, path, chunk, response)
+        if status in (413, 504) and len(chunk) > 1:
+            return self._bisect(method, path, chunk)
+        self._record_failures(method, path, chunk, status, response.text if response is not None else "request not sent")
+        return []
+
+    def _isolate_failures(self, method: str, path: str, chunk: list, response) -> list:
+        """Write the valid records of a chunk that failed validation:
+        NetBox reports bulk validation errors as a list aligned with
+        the payload, when it does the records without errors are
+        resent at once. Otherwise the chunk is bisected until each
+        invalid record is isolated.
+        """
+        errors = self._decode(response)
+        if isinstance(errors, list) and len(errors) == len(chunk):
+            valid = [record for record, error in zip(chunk, errors) if not error]
+            if len(valid) < len(chunk):
+                for record, error in zip(chunk, errors):
+                    if error:
+                        self._record_failures(method, path, [record], 400, error)
+                return self._write_isolating_failures(method, path, valid) if valid else []
+
+        if len(chunk) == 1:
+            self._record_failures(method, path, chunk, 400, errors if errors is not None else response.text)
+            return []
+        return self._bisect(method, path, chunk)
+
+    def _bisect(self, method: str, path: str, chunk: list) -> list:
+        """Send both halves of a chunk separately"""
+        middle = len(chunk) // 2
+        return (self._write_isolating_failures(method, path, chunk[:middle])
+                + self._write_isolating_failures(method, path, chunk[middle:]))
+
+    def _record_failures(self, method: str, path: str, records: list, status, error):
+        """Log and keep the records a bulk write could not write"""
+        for record in records:
+            logging.warning("%s %s failed [%s] for %s: %s", method, path, status, record, error)
+            with self._error_lock:
+                self.bulk_failures.append({"method": method, "path": path, "status": status,
+                                           "record": record, "error": error})
+        self._count_error()
@@ -0,0 +1,211 @@
+"""Daemon mode: sync the networks whenever Forward processes a new snapshot, with warm connections and caches"""
+import json
+import os
+import signal
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from common import logging
+from metrics import Metrics
+
+# NetBox endpoints written by the per-network stages, their cached collections are reloaded before every sync.
+# The reference collections (sites, manufacturers, roles, device types) are kept up to cache_ttl seconds.
+NETWORK_PATHS = [
+    "/api/dcim/devices/",
+    "/api/dcim/virtual-device-contexts/",
+    "/api/dcim/virtual-chassis/",
+    "/api/dcim/interfaces/",
+]
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class SyncDaemon:
+    """Poll the latest processed snapshot of every network and sync the networks whose snapshot changed:
+    The connectors are created once, so their HTTP pools, adaptive
+    chunk sizes and NetBox caches stay warm across cycles. Cycles
+    syncing several networks run them in network_pool, whose
+    workers keep the connectors of each network they synced. The
+    status of the daemon and of its last sync is written to
+    status_file after every cycle, and served as JSON on
+    /status when status_port is set.
+    """
+
+    def __init__(self, config, forward, netbox, network_ids, sync, network_pool=None):
+        settings = config.get("daemon") or {}
+        self.config = config
+        self.forward = forward
+        self.netbox = netbox
+        self.network_ids = network_ids
+        self.sync = sync  # export_to_netbox.run_sync
+        self.network_pool = network_pool  # export_to_netbox.NetworkPool kept across cycles, None for one network
+        self.interval = settings.get("interval", 300)  # Seconds between two polls
+        self.cache_ttl = settings.get("cache_ttl", 3600)  # Seconds the reference collections are kept
+        self.status_file = settings.get("status_file", "daemon_status.json")
+        self.status_host = settings.get("status_host", "127.0.0.1")
+        self.status_port = settings.get("status_port", 0)
+        self.synced = {}  # network id -> last snapshot synced cleanly
+        if forward.incremental:
+            networks = {str(network_id) for network_id in network_ids}
+            self.synced = {network_id: snapshot_id for network_id, snapshot_id in forward.read_sync_state().items()
+                           if network_id in networks}
+        if len(network_ids) > 1 and netbox.allow_deletes:
+            # A cycle may sync a single network, whose orphans include the objects of the other networks
+            logging.warning("Deletes are disabled when the daemon syncs several networks")
+            netbox.allow_deletes = False
+        self.cache_loaded = None  # time.monotonic() of the last full NetBox cache reset
+        self.stopping = threading.Event()
+        self.server = None
+        self._lock = threading.Lock()
+        self.status = {
+            "state": "starting",
+            "pid": os.getpid(),
+            "started": _now(),
+            "networks": [str(network_id) for network_id in network_ids],
+            "interval": self.interval,
+            "cycles": 0,
+            "syncs": 0,
+            "last_poll": None,
+            "last_poll_error": None,
+            "synced_snapshots": dict(self.synced),
+            "last_sync": None,
+        }
+
+    def run(self):
+        """Poll and sync until SIGTERM or SIGINT"""
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: self.stop())
+        if self.status_port:
+            self._start_status_server()
+        logging.info("Daemon polling networks %s every %ss", ", ".join(self.status["networks"]), self.interval)
+        try:
+            while not self.stopping.is_set():
+                self.run_cycle()
+                self.stopping.wait(self.interval)
+        finally:
+            self._update_status(state="stopped")
+            if self.server is not None:
+                self.server.shutdown()
+                self.server.server_close()
+            logging.info("Daemon stopped after %d cycles", self.status["cycles"])
+
+    def stop(self):
+        self.stopping.set()
+
+    def poll(self) -> dict:
+        """Return the latest processed snapshot of every network not synced yet"""
+        changed = {}
+        for network_id in self.network_ids:
+            snapshot_id = self.forward.get_latest_snapshot(network_id)["id"]
+            if self.synced.get(str(network_id)) != snapshot_id:
+                changed[network_id] = snapshot_id
+        return changed
+
+    def run_cycle(self):
+        """Poll Forward once and sync the networks with a new snapshot"""
+        run_metrics = Metrics()
+        self.forward.metrics = self.netbox.metrics = run_metrics
+        self.forward.reset_run_state()
+        try:
+            changed = self.poll()
+        except Exception as e:
+            logging.warning("Polling the latest Forward snapshots failed: %s", e)
+            self._update_status(state="idle", cycles=self.status["cycles"] + 1, last_poll=_now(),
+                                last_poll_error=str(e))
+            return
+        self._update_status(cycles=self.status["cycles"] + 1, last_poll=_now(), last_poll_error=None)
+        if not changed:
+            logging.debug("No new Forward snapshot")
+            self._update_status(state="idle")
+            return
+
+        network_ids = list(changed)
+        logging.info("New Forward snapshots: %s", ", ".join(f"{network_id}={snapshot_id}"
+                                                             for network_id, snapshot_id in changed.items()))
+        self._prepare_caches()
+        self.netbox.reset_run_state()
+        self.forward.network_id = network_ids[0]
+        for network_id, snapshot_id in changed.items():
+            self.forward.pin_snapshot(network_id, snapshot_id)
+
+        self._update_status(state="syncing")
+        started = _now()
+        error = None
+        try:
+            self.sync(self.config, self.forward, self.netbox, network_ids, run_metrics,
+                      network_pool=self.network_pool)
+        except Exception as e:
+            logging.error("Sync failed: %s", e)
+            error = str(e)
+        clean = error is None and not self.forward.error_count and not self.netbox.error_count
+        if clean:
+            self.synced.update({str(network_id): snapshot_id for network_id, snapshot_id in changed.items()})
+        elif error is None:
+            logging.warning("Requests failed during this sync, the snapshots will be synced again")
+        report = run_metrics.report()
+        self._update_status(state="idle", syncs=self.status["syncs"] + 1, synced_snapshots=dict(self.synced),
+                            last_sync={
+                                "started": started,
+                                "finished": _now(),
+                                "snapshots": {str(network_id): snapshot_id
+                                              for network_id, snapshot_id in changed.items()},
+                                "success": clean,
+                                "error": error,
+                                "failed_requests": self.forward.error_count + self.netbox.error_count,
+                                "bulk_failures": len(self.netbox.bulk_failures),
+                                "stages_wall_seconds": report["stages_wall_seconds"],
+                                "totals": report["totals"],
+                                "stages": report["stages"],
+                            })
+
+    def _prepare_caches(self):
+        """Reload the per-network collections, and every collection once cache_ttl expired"""
+        if self.cache_loaded is None or time.monotonic() - self.cache_loaded > self.cache_ttl:
+            self.netbox.clear_cache()
+            self.cache_loaded = time.monotonic()
+            return
+        for path in NETWORK_PATHS:
+            self.netbox.invalidate(path)
+
+    def status_snapshot(self) -> dict:
+        with self._lock:
+            return json.loads(json.dumps(self.status))
+
+    def _update_status(self, **changes):
+        with self._lock:
+            self.status.update(changes)
+            self.status["updated"] = _now()
+            body = json.dumps(self.status, indent=2)
+        if self.status_file:
+            temporary = f"{self.status_file}.tmp"
+            with open(temporary, "w", encoding="UTF-8") as f:
+                f.write(body)
+            os.replace(temporary, self.status_file)
+
+    def _start_status_server(self):
+        daemon = self
+
+        class StatusHandler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0].rstrip("/") != "/status":
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = json.dumps(daemon.status_snapshot()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((self.status_host, self.status_port), StatusHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logging.info("Serving the daemon status on http://%s:%d/status", *self.server.server_address[:2])
@@ -1,22 +1,503 @@
 #!/usr/bin/env python3
 """Demo script for integrating Forward Enterprise with Netbox."""
 
-from yaml import load
-try:
-    from yaml import CLoader as Loader
-except ImportError:
-    from yaml import Loader
+import argparse
+import copy
+import os
+import time
 
-from common import logging, print_variables, setup_loggers, loggers
-from netbox_interface import NetboxAPI
-from forward_interface import ForwardAPI
+# The connectors, the scheduler, the daemon and the process pool are imported by the functions
+# using them, so --help, argument errors and runs of a few stages only load what they need
+from common import (LazyDump, SharedRateLimiter, logging, log_objects, print_variables, setup_loggers, stop_loggers,
+                    loggers, set_log_prefix, setup_worker_loggers, start_log_relay, stop_log_relay)
 
 CONFIG_FILE = "configuration.yaml"
 
-def main():
+
+def record_counts(records, created, updated) -> dict:
+    """Summarize a stage for the run metrics, skipped records were unchanged, unresolved or rejected"""
+    return {"created": len(created), "updated": len(updated),
+            "skipped": max(len(records) - len(created) - len(updated), 0)}
+
+
+def sync_sites(netbox, forward_locations):
+    log = loggers.get("sites", logging)
+    log.debug("%s", LazyDump(forward_locations))
+    create_sites_list, update_sites_list = netbox.add_site_list(forward_locations)
+    log_objects(log, "Added", "site", create_sites_list, with_id=True)
+    log_objects(log, "Updated", "site", update_sites_list)
+    return record_counts(forward_locations, create_sites_list, update_sites_list)
+
+
+def sync_manufacturers(netbox, fwd_vendors):
+    log = loggers.get("manufacturers", logging)
+    log.debug("%s", LazyDump(fwd_vendors))
+    fwd_vendors_adapted = netbox.adapt_forward_vendor_query(fwd_vendors)
+    create_manufacturers_list = netbox.add_manufacturer_list(fwd_vendors_adapted)
+    log_objects(log, "Added", "manufacturer", create_manufacturers_list, with_id=True)
+    return record_counts(fwd_vendors_adapted, create_manufacturers_list, [])
+
+
+def sync_roles(netbox, fwd_device_types):
+    log = loggers.get("roles", logging)
+    log.debug("%s", LazyDump(fwd_device_types))
+    fwd_device_types_adapted = netbox.adapt_forward_device_type_query(fwd_device_types)
+    create_roles_list = netbox.add_role_list(fwd_device_types_adapted)
+    log_objects(log, "Added", "role", create_roles_list, with_id=True)
+    return record_counts(fwd_device_types_adapted, create_roles_list, [])
+
+
+def sync_device_types(netbox, fwd_models):
+    log = loggers.get("device_types", logging)
+    log.debug("%s", LazyDump(fwd_models))
+    fwd_models_adapted = netbox.adapt_forward_model_query(fwd_models)
+    create_device_types_list = netbox.add_device_type_list(fwd_models_adapted)
+    log_objects(log, "Added", "device type", create_device_types_list, name_field="model", with_id=True)
+    return record_counts(fwd_models_adapted, create_device_types_list, [])
+
+
+def sync_devices(netbox, fwd_devices):
+    log = loggers.get("devices", logging)
+    log.debug("%s", LazyDump(fwd_devices))
+    fwd_devices_adapted = netbox.adapt_forward_device_query(fwd_devices)
+    create_devices_list, update_devices_list = netbox.add_device_list(fwd_devices_adapted)
+    log_objects(log, "Added", "device", create_devices_list, with_id=True)
+    log_objects(log, "Updated", "device", update_devices_list)
+    return record_counts(fwd_devices_adapted, create_devices_list, update_devices_list)
+
+
+def sync_virtual_device_contexts(netbox, fwd_vdcs):
+    log = loggers.get("vdcs", logging)
+    log.debug("%s", LazyDump(fwd_vdcs))
+    adapted_vdcs = netbox.adapt_forward_virtual_device_context_query(fwd_vdcs)
+    create_vdc_list, update_vdc_list = netbox.add_virtual_device_context_list(adapted_vdcs)
+    log_objects(log, "Added", "VDC", create_vdc_list, with_id=True)
+    log_objects(log, "Updated", "VDC", update_vdc_list)
+    return record_counts(adapted_vdcs, create_vdc_list, update_vdc_list)
+
+
+def sync_virtual_chassis(netbox, fwd_vcs):
+    log = loggers.get("virtual_chassis", logging)
+    log.debug("%s", LazyDump(fwd_vcs))
+    create_vcs_list, update_vcs_list = netbox.add_virtual_chassis_list(fwd_vcs)
+    log_objects(log, "Added", "chassis", create_vcs_list, with_id=True)
+    log_objects(log, "Updated", "chassis", update_vcs_list)
+    return record_counts(fwd_vcs, create_vcs_list, update_vcs_list)
+
+
+def sync_interfaces(netbox, fwd_interfaces):
+    log = loggers.get("interfaces", logging)
+    log.debug("%s", LazyDump(fwd_interfaces))
+    fwd_interfaces_adapted = netbox.adapt_forward_interface_query(fwd_interfaces)
+    create_interfaces_list, update_interfaces_list = netbox.add_interface_list(fwd_interfaces_adapted)
+    log_objects(log, "Added", "interface", create_interfaces_list, with_id=True)
+    log_objects(log, "Updated", "interface", update_interfaces_list)
+    return record_counts(fwd_interfaces, create_interfaces_list, update_interfaces_list)
+
+
+def sync_interfaces_stream(netbox, forward):
+    log = loggers.get("interfaces", logging)
+    pages = netbox.adapt_forward_interface_stream(forward.iter_interfaces())
+    summary = netbox.add_interface_stream(pages)
+    log.info("Interfaces: %d added, %d updated, %d unchanged",
+             summary["created"], summary["updated"], summary["unchanged"])
+    return {"created": summary["created"], "updated": summary["updated"], "skipped": summary["unchanged"]}
+
+
+# Export stages in run order:
+# (stage, config flag, NetBox objects, ForwardAPI query method, sync function, stages it depends on)
+STAGES = [
+    ("sites", "add_sites", "Sites", "get_locations", sync_sites, []),
+    ("manufacturers", "add_manufacturers", "Manufacturers", "get_vendors", sync_manufacturers, []),
+    ("roles", "add_device_roles", "Device Roles", "get_device_types", sync_roles, []),
+    ("device_types", "add_device_types", "Device Types", "get_models", sync_device_types, ["manufacturers"]),
+    ("devices", "add_devices", "Devices", "get_devices", sync_devices, ["sites", "roles", "device_types"]),
+    ("vdcs", "add_virtual_device_contexts", "Virtual Device Contexts", "get_virtual_device_contexts",
+     sync_virtual_device_contexts, ["devices"]),
+    ("virtual_chassis", "add_virtual_chassis", "Virtual Chassis", "get_virtual_chassis",
+     sync_virtual_chassis, ["devices"]),
+    ("interfaces", "add_interfaces", "Interfaces", "get_interfaces", sync_interfaces, ["devices", "vdcs"]),
+]
+
+# Stages of the objects shared by every network, synced once before the networks fan out on multi-network runs
+REFERENCE_STAGES = ("sites", "manufacturers", "roles", "device_types")
+REFERENCE_PATHS = ["/api/dcim/sites/", "/api/dcim/manufacturers/", "/api/dcim/device-roles/",
+                   "/api/dcim/device-types/"]
+# Key of the rows of a reference query, the rows of several networks with the same key are synced once
+REFERENCE_KEYS = {
+    "sites": lambda row: row["name"].lower(),
+    "manufacturers": lambda row: row["name"].lower(),
+    "roles": lambda row: row["name"].lower(),
+    "device_types": lambda row: row["model"],
+}
+
+
+def merge_network_rows(stage, results) -> list:
+    """Concatenate the rows of a reference query over several networks, keeping the first row of each key"""
+    key = REFERENCE_KEYS[stage]
+    merged = {}
+    for rows in results:
+        for row in rows or []:
+            merged.setdefault(key(row), row)
+    return list(merged.values())
+
+
+class RowScope:
+    """Row filter of schedule_stages keeping the Forward rows of some sites and devices:
+    Sites are kept by name, devices by site or name, VDCs and
+    interfaces by the name of their device. The devices of the
+    sites already in NetBox, and their VDCs, are looked up once,
+    so their interfaces are synced without the devices stage.
+    Virtual chassis and the reference stages are not filtered.
+    """
+
+    def __init__(self, netbox, sites, devices):
+        self.netbox = netbox
+        self.sites = {site.lower() for site in sites}
+        self.devices = {device.lower() for device in devices}
+        self.names = None  # Lowercase names of the devices and VDCs in scope
+
+    def device_names(self) -> set:
+        if self.names is None:
+            self.names = self.devices | self.netbox.scope_device_names()
+        return self.names
+
+    def __call__(self, stage, rows):
+        if stage == "sites" and self.sites:
+            return [row for row in rows if row["name"].lower() in self.sites]
+        if stage == "devices":
+            kept = [row for row in rows
+                    if (row["site"] or "").lower() in self.sites or row["name"].lower() in self.devices]
+            self.device_names().update(row["name"].lower() for row in kept)
+            return kept
+        if stage == "vdcs":
+            kept = [row for row in rows if row["device"].lower() in self.device_names()]
+            self.device_names().update(row["name"].lower() for row in kept)
+            return kept
+        if stage == "interfaces":
+            return [row for row in rows if row["device"].lower() in self.device_names()]
+        return rows
+
+
+def schedule_stages(config, forward, netbox, stages=None, network_ids=None, row_filter=None):
+    """Declare the enabled export stages:
+    Every stage depends on the prefetch of its Forward NQE query,
+    which can start right away, and on the NetBox stages it
+    references. Stages disabled in the configuration are left
+    out and no longer hold back the stages depending on them.
+    With streaming enabled, the interfaces stage fetches its
+    NQE pages itself and writes them as they arrive. When deletes
+    are allowed, a last stage deletes the orphans once every
+    other stage is done. Stages limits the run to some of the
+    STAGES, network_ids merges the rows of the reference queries
+    of several networks. Row_filter(stage, rows) returns the rows
+    of a stage to sync, like a RowScope.
+    """
+    from scheduler import StageScheduler
+
+    scheduler = StageScheduler(config.get("stage_workers", 4))
+    for stage, flag, title, query, sync, deps in stages or STAGES:
+        if not config.get(flag):
+            logging.info("========> Skipping NetBox %s Update...", title)
+            continue
+
+        def prefetch(results, stage=stage, query=query):
+            if network_ids:
+                return merge_network_rows(stage, [getattr(forward, query)(network_id) for network_id in network_ids])
+            return getattr(forward, query)()
+
+        def run(results, stage=stage, title=title, sync=sync):
+            logging.info("========> Updating NetBox %s...", title)
+            rows = results[f"fetch_{stage}"]
+            if row_filter is not None and rows is not None:
+                rows = row_filter(stage, rows)
+            return sync(netbox, rows)
+
+        if stage == "interfaces" and config.get("streaming"):
+            def stream(results, title=title):
+                logging.info("========> Streaming NetBox %s...", title)
+                return sync_interfaces_stream(netbox, forward)
+
+            scheduler.add(stage, stream, deps)
+            continue
+
+        scheduler.add(f"fetch_{stage}", prefetch)
+        scheduler.add(stage, run, [f"fetch_{stage}"] + deps)
+
+    if netbox.allow_deletes:
+        if forward.incremental:
+            logging.warning("Deletes are disabled on incremental runs, Forward only reports the changed rows")
+        else:
+            def delete_orphans(results):
+                if forward.error_count:
+                    raise RuntimeError("Forward requests failed, not deleting objects that may only be missing "
+                                       "from incomplete Forward data")
+                logging.info("========> Deleting NetBox objects missing from Forward...")
+                return netbox.delete_orphans()
+
+            scheduler.add("delete_orphans", delete_orphans, [stage for stage, *_ in STAGES])
+    return scheduler
+
+
+_network_worker = {}  # State of a network worker process, set by _init_network_worker
+
+
+def _init_network_worker(config, log_queue, netbox_budget, rate_limiters, keep_connectors=False):
+    setup_worker_loggers(config, log_queue)
+    _network_worker["netbox_budget"] = netbox_budget
+    _network_worker["rate_limiters"] = rate_limiters
+    _network_worker["keep_connectors"] = keep_connectors
+    _network_worker["connectors"] = {}  # network id -> (forward, netbox) kept by a long-lived pool
+
+
+def _network_connectors(config, network_id, run_metrics):
+    """Return the Forward and NetBox connectors of a network in this worker process:
+    Pools kept for the daemon's lifetime reuse the connectors of the
+    previous cycle, so their HTTP pools and adaptive chunk sizes stay
+    warm. Their NetBox cache is dropped, it is seeded again by the
+    caller and the network collections are reloaded.
+    """
+    from forward_interface import ForwardAPI
+    from netbox_interface import NetboxAPI
+
+    connectors = _network_worker.get("connectors", {})
+    if network_id in connectors:
+        forward, netbox = connectors[network_id]
+        forward.reset_run_state()
+        netbox.reset_run_state()
+        netbox.clear_cache()
+    else:
+        forward = ForwardAPI(config["forward"])
+        netbox = NetboxAPI(config["netbox"])
+        netbox.concurrency = _network_worker.get("netbox_budget")
+        for connector in (forward, netbox):
+            connector.rate_limiter = _network_worker.get("rate_limiters", {}).get(connector.service,
+                                                                                  connector.rate_limiter)
+        if _network_worker.get("keep_connectors"):
+            connectors[network_id] = (forward, netbox)
+    forward.metrics = netbox.metrics = run_metrics
+    return forward, netbox
+
+
+def sync_network(config, network_id, snapshot_id, reference_cache) -> dict:
+    """Run the device, VDC, virtual chassis and interface stages of one network in a worker process:
+    The reference objects synced by the main process are seeded in
+    the NetBox cache, the NetBox requests of every worker share the
+    netbox_budget semaphore, and the Forward and NetBox requests the
+    rate limiters of the run. Returns the run report of the network.
+    """
+    from metrics import Metrics
+
+    set_log_prefix(f"[network {network_id}] ")
+    config = copy.deepcopy(config)
+    config["forward"]["network_id"] = network_id
+    config["netbox"]["allow_deletes"] = False
+    for stage, flag, *_ in STAGES:
+        if stage in REFERENCE_STAGES:
+            config[flag] = False
+
+    run_metrics = Metrics()
+    forward, netbox = _network_connectors(config, network_id, run_metrics)
+    netbox.seed_cache(reference_cache)
+    forward.pin_snapshot(network_id, snapshot_id)
+    scheduler = schedule_stages(config, forward, netbox)
+    error = None
+    try:
+        scheduler.run()
+    except RuntimeError as e:
+        error = str(e)
+    finally:
+        run_metrics.record_stages(scheduler)
+    report_failures(netbox)
+    if not _network_worker.get("keep_connectors"):
+        close_connectors(forward, netbox)
+    return {"report": run_metrics.report(), "error": error,
+            "clean": error is None and not forward.error_count and not netbox.error_count}
+
+
+class NetworkPool:
+    """Worker processes syncing networks, with the log relay, NetBox budget and rate limiters they share:
+    sync_networks creates a pool per run. The daemon keeps one for its
+    lifetime with keep_connectors, so the workers keep the connectors
+    of their networks warm between cycles.
+    """
+
+    def __init__(self, config, network_count, keep_connectors=False):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        context = multiprocessing.get_context("spawn")  # Forking a process running threads is unsafe
+        log_queue = context.Queue()
+        netbox_budget = context.BoundedSemaphore(config["netbox"].get("max_concurrency",
+                                                                      config["netbox"].get("pool_size", 10)))
+        rate_limiters = {service: SharedRateLimiter(context, config[service]["rate_limit"],
+                                                    config[service].get("rate_burst"))
+                         for service in ("forward", "netbox") if config[service].get("rate_limit")}
+        self.workers = config.get("network_workers") or min(network_count, os.cpu_count() or 1)
+        self.relay = start_log_relay(log_queue)
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=context, initializer=_init_network_worker,
+                                            initargs=(config, log_queue, netbox_budget, rate_limiters,
+                                                      keep_connectors))
+
+    def close(self):
+        self.executor.shutdown()
+        stop_log_relay(self.relay)
+
+
+def sync_networks(config, forward, netbox, network_ids, run_metrics, network_pool=None):
+    """Sync several Forward networks:
+    The reference stages run once in this process over the rows of
+    every network, then the other stages of each network run in a
+    pool of network_workers processes, network_pool or one created
+    for this run. NetBox requests in flight across the workers are
+    bounded by netbox max_concurrency, and the rate_limit of each
+    service applies to all the workers. Incremental runs record the
+    snapshot of every network that synced cleanly. Raises a
+    RuntimeError listing failed networks.
+    """
+    from concurrent.futures import as_completed
+
+    if netbox.allow_deletes:
+        logging.warning("Deletes are disabled on multi-network runs, every network only knows its own objects")
+        netbox.allow_deletes = False
+    started = time.perf_counter()
+    scheduler = schedule_stages(config, forward, netbox,
+                                [entry for entry in STAGES if entry[0] in REFERENCE_STAGES], network_ids)
+    try:
+        scheduler.run()
+    finally:
+        run_metrics.record_stages(scheduler)
+    reference_cache = netbox.export_cache(REFERENCE_PATHS)
+
+    pool = network_pool or NetworkPool(config, len(network_ids))
+    logging.info("========> Syncing %d networks in %d processes...", len(network_ids), pool.workers)
+    failed = []
+    try:
+        futures = {pool.executor.submit(sync_network, config, network_id, forward.snapshot_ids[network_id],
+                                        reference_cache): network_id for network_id in network_ids}
+        for future in as_completed(futures):
+            network_id = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error("Network %s failed: %s", network_id, e)
+                failed.append(network_id)
+                continue
+            run_metrics.merge(result["report"], f"{network_id}:")
+            if result["error"] is not None:
+                logging.error("Network %s failed: %s", network_id, result["error"])
+                failed.append(network_id)
+            elif forward.incremental:
+                if result["clean"] and not forward.error_count and not netbox.error_count:
+                    forward.save_sync_state(network_id)
+                else:
+                    logging.warning("Requests failed while syncing network %s, the next run will sync it "
+                                    "from the same snapshot", network_id)
+    finally:
+        if network_pool is None:
+            pool.close()
+        run_metrics.stages_wall_seconds = round(time.perf_counter() - started, 6)
+    if failed:
+        raise RuntimeError(f"Networks failed: {', '.join(str(network_id) for network_id in failed)}")
+
+
+def run_sync(config, forward, netbox, network_ids, run_metrics, row_filter=None, network_pool=None):
+    """Sync the networks whose snapshot is pinned and export the run metrics:
+    Incremental runs of a single network record the snapshot as
+    synced when no request failed, multi-network runs record it
+    per network, in network_pool when given. Runs writing to NetBox
+    save its lookup maps to maps_cache. Raises a RuntimeError when
+    stages failed.
+    """
+    scheduler = None
+    try:
+        if len(network_ids) > 1:
+            sync_networks(config, forward, netbox, network_ids, run_metrics, network_pool)
+        else:
+            scheduler = schedule_stages(config, forward, netbox, row_filter=row_filter)
+            scheduler.run()
+    finally:
+        if scheduler is not None:
+            run_metrics.record_stages(scheduler)
+        run_metrics.export(config.get("metrics_report", "run_report.json"),
+                           config.get("metrics_textfile", "fwd_netbox.prom"),
+                           config.get("metrics_regression_threshold", 0.2))
+
+    report_failures(netbox)
+    if forward.incremental and netbox.plan is None and len(network_ids) == 1:
+        if forward.error_count or netbox.error_count:
+            logging.warning("Requests failed during this run, the next run will sync from the same snapshot")
+        else:
+            forward.save_sync_state(network_ids[0])
+    if netbox.plan is None and netbox.replay is None:
+        netbox.save_maps()
+
+
+def parse_args(argv=None):
+    stage_names = [stage for stage, *_ in STAGES]
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("stages", metavar="STAGE", nargs="*",
+                        help=f"Only run these stages, one of {', '.join(stage_names)}. The lookup maps of the "
+                             "stages left out are read from maps_cache")
+    parser.add_argument("--site", metavar="NAME", action="append", default=[],
+                        help="Only sync the site, devices, VDCs and interfaces of this site, can be repeated")
+    parser.add_argument("--device", metavar="NAME", action="append", default=[],
+                        help="Only sync this device, its VDCs and their interfaces, can be repeated")
+    parser.add_argument("--refresh-maps", action="store_true",
+                        help="Fetch the lookup maps from NetBox instead of reading them from maps_cache")
+    parser.add_argument("-c", "--config", default=CONFIG_FILE, help="Configuration file (default: %(default)s)")
+    parser.add_argument("--plan", metavar="PLAN_FILE",
+                        help="Dry run: compute the NetBox changes and write them to PLAN_FILE instead of NetBox")
+    parser.add_argument("--apply", metavar="PLAN_FILE", help="Apply a plan written by a dry run and exit")
+    parser.add_argument("--dump", metavar="DIR",
+                        help="Save the Forward and NetBox responses read during the run to DIR")
+    parser.add_argument("--offline", metavar="DIR",
+                        help="Read Forward and NetBox from the responses saved in DIR, implies a dry run")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running and sync whenever Forward processes a new snapshot")
+    parser.add_argument("--networks", metavar="NETWORK_IDS",
+                        type=lambda value: [network_id for network_id in value.split(",") if network_id],
+                        help="Comma-separated Forward networks to sync, e.g. --networks 170256,170257, overrides "
+                             "network_id and network_ids of the configuration")
+    args = parser.parse_args(argv)
+    unknown = [stage for stage in args.stages if stage not in stage_names]
+    if unknown:
+        parser.error(f"unknown stage {', '.join(unknown)}, choose from {', '.join(stage_names)}")
+    return args
+
+
+def report_failures(netbox):
+    if netbox.bulk_failures:
+        logging.warning("%d records could not be written to NetBox:", len(netbox.bulk_failures))
+        for failure in netbox.bulk_failures:
+            logging.warning("  %s %s %s: %s", failure["method"], failure["path"], failure["record"], failure["error"])
+
+
+def close_connectors(*connectors):
+    for connector in connectors:
+        stats = connector.connection_stats()
+        logging.info("%s HTTP connections: %d requests over %d connections (%d reused)",
+                     connector.service, stats["requests"], stats["connections"], stats["reused"])
+        connector.close()
+
+
+def main(argv=None):
     """Main function"""
-    with open(CONFIG_FILE, "r", encoding="UTF-8") as f:
+    args = parse_args(argv)
+    from yaml import load
+    try:
+        from yaml import CLoader as Loader
+    except ImportError:
+        from yaml import Loader
+    from forward_interface import ForwardAPI
+    from metrics import Metrics
+    from netbox_interface import NetboxAPI
+
+    with open(args.config, "r", encoding="UTF-8") as f:
         config = load(f, Loader=Loader)
+    if args.stages:
+        for stage, flag, *_ in STAGES:
+            config[flag] = stage in args.stages
 
     setup_loggers(config)
 
@@ -26,112 +507,85 @@ def main():
     else:
         logging.getLogger().setLevel(logging.INFO)
 
-    forward = ForwardAPI(config["forward"])
-    netbox = NetboxAPI(config["netbox"])
-
-    if config.get("add_sites"):
-        logging.info("========> Updating NetBox Sites...")
-        log = loggers.get("sites", logging)
-        forward_locations = forward.get_locations()
-        log.debug(forward_locations)
-        create_sites_list, update_sites_list = netbox.add_site_list(forward_locations)
-        for site in create_sites_list:
-            log.info(f"Added site: {site['name']}")
-        for site in update_sites_list:
-            log.info(f"Updated site: {site['name']}")
-    else:
-        logging.info("========> Skipping NetBox Sites Update...")
-
-    if config.get("add_manufacturers"):
-        logging.info("========> Updating NetBox Manufacturers...")
-        log = loggers.get("manufacturers", logging)
-        fwd_vendors = forward.get_vendors()
-        log.debug(fwd_vendors)
-        fwd_vendors_adapted = netbox.adapt_forward_vendor_query(fwd_vendors)
-        create_manufacturers_list = netbox.add_manufacturer_list(fwd_vendors_adapted)
-        for m in create_manufacturers_list:
-            log.info(f"Added manufacturer: {m['name']}")
-    else:
-        logging.info("========> Skipping NetBox Manufacturers Update...")
-
-    if config.get("add_device_roles"):
-        logging.info("========> Updating NetBox Device Roles...")
-        log = loggers.get("roles", logging)
-        fwd_device_types = forward.get_device_types()
-        log.debug(fwd_device_types)
-        fwd_device_types_adapted = netbox.adapt_forward_device_type_query(fwd_device_types)
-        create_roles_list = netbox.add_role_list(fwd_device_types_adapted)
-        for role in create_roles_list:
-            log.info(f"Added role: {role['name']}")
-    else:
-        logging.info("========> Skipping NetBox Device Roles Update...")
-
-    if config.get("add_device_types"):
-        logging.info("========> Updating NetBox Device Types...")
-        log = loggers.get("device_types", logging)
-        fwd_models = forward.get_models()
-        log.debug(fwd_models)
-        fwd_models_adapted = netbox.adapt_forward_model_query(fwd_models)
-        create_device_types_list = netbox.add_device_type_list(fwd_models_adapted)
-        for dt in create_device_types_list:
-            log.info(f"Added device type: {dt['model']}")
-    else:
-        logging.info("========> Skipping NetBox Device Types Update...")
-
-    if config.get("add_devices"):
-        logging.info("========> Updating NetBox Devices...")
-        log = loggers.get("devices", logging)
-        fwd_devices = forward.get_devices()
-        log.debug(fwd_devices)
-        fwd_devices_adapted = netbox.adapt_forward_device_query(fwd_devices)
-        create_devices_list, update_devices_list = netbox.add_device_list(fwd_devices_adapted)
-        for d in create_devices_list:
-            log.info(f"Added device: {d['name']}")
-        for d in update_devices_list:
-            log.info(f"Updated device: {d['name']}")
-    else:
-        logging.info("========> Skipping NetBox Device Update...")
-
-    if config.get("add_virtual_device_contexts"):
-        logging.info("========> Updating NetBox Virtual Device Contexts...")
-        log = loggers.get("vdcs", logging)
-        fwd_vdcs = forward.get_virtual_device_contexts()
-        log.debug(fwd_vdcs)
-        adapted_vdcs = netbox.adapt_forward_virtual_device_context_query(fwd_vdcs)
-        create_vdc_list, update_vdc_list = netbox.add_virtual_device_context_list(adapted_vdcs)
-        for v in create_vdc_list:
-            log.info(f"Added VDC: {v['name']}")
-        for v in update_vdc_list:
-            log.info(f"Updated VDC: {v['name']}")
-    else:
-        logging.info("========> Skipping NetBox Virtual Device Contexts Update...")
-
-    if config.get("add_virtual_chassis"):
-        logging.info("========> Updating NetBox Virtual Chassis...")
-        log = loggers.get("virtual_chassis", logging)
-        fwd_vcs = forward.get_virtual_chassis()
-        log.debug(fwd_vcs)
-        create_vcs_list, update_vcs_list = netbox.add_virtual_chassis_list(fwd_vcs)
-        for vc in create_vcs_list:
-            log.info(f"Added chassis: {vc['name']}")
-        for vc in update_vcs_list:
-            log.info(f"Updated chassis: {vc['name']}")
-    else:
-        logging.info("========> Skipping NetBox Virtual Chassis Update...")
-
-    if config.get("add_interfaces"):
-        logging.info("========> Updating NetBox Interfaces...")
-        log = loggers.get("interfaces", logging)
-        fwd_interfaces = forward.get_interfaces()
-        log.debug(fwd_interfaces)
-        fwd_interfaces_adapted = netbox.adapt_forward_interface_query(fwd_interfaces)
-        create_interfaces_list, update_interfaces_list = netbox.add_interface_list(fwd_interfaces_adapted)
-        for iface in create_interfaces_list:
-            log.info(f"Added interface: {iface['name']}")
-        for iface in update_interfaces_list:
-            log.info(f"Updated interface: {iface['name']}")
-    else:
-        logging.info("========> Skipping NetBox Interface Update...")
+    if args.plan or args.offline:
+        config["netbox"]["dry_run"] = True
+
+    network_ids = args.networks or config["forward"].get("network_ids") or [config["forward"]["network_id"]]
+    config["forward"]["network_id"] = network_ids[0]
+    if len(network_ids) > 1 and not args.apply and (args.dump or config["netbox"].get("dry_run")):
+        raise SystemExit("Dry runs, plans and dumps sync a single network, pick one with --networks")
+    if args.daemon and (args.apply or args.dump or config["netbox"].get("dry_run")):
+        raise SystemExit("The daemon writes to NetBox, it cannot run dry runs, plans or dumps")
+    scoped = bool(args.site or args.device)
+    if scoped and (len(network_ids) > 1 or args.daemon):
+        raise SystemExit("--site and --device runs sync a single network once, pick one with --networks")
+
+    try:
+        run_metrics = Metrics()
+        netbox = NetboxAPI(config["netbox"], metrics=run_metrics)
+        if args.apply:
+            from plan import Plan
+
+            logging.info("========> Applying plan %s", args.apply)
+            netbox.apply_plan(Plan.load(args.apply))
+            report_failures(netbox)
+            close_connectors(netbox)
+            return
+
+        forward = ForwardAPI(config["forward"], metrics=run_metrics)
+        if args.offline:
+            forward.load_replay(os.path.join(args.offline, "forward.json"))
+            netbox.load_replay(os.path.join(args.offline, "netbox.json"))
+        if args.dump:
+            forward.start_recording()
+            netbox.start_recording()
+        if args.daemon:
+            from daemon import SyncDaemon
+
+            # The workers of a multi-network daemon live as long as it does, keeping their connectors warm
+            network_pool = None
+            if len(network_ids) > 1:
+                network_pool = NetworkPool(config, len(network_ids), keep_connectors=True)
+            try:
+                SyncDaemon(config, forward, netbox, network_ids, run_sync, network_pool).run()
+            finally:
+                if network_pool is not None:
+                    network_pool.close()
+            close_connectors(forward, netbox)
+            return
+        if (args.stages or scoped) and not args.refresh_maps and not args.offline and not args.dump:
+            netbox.load_maps()
+        row_filter = None
+        if scoped:
+            if netbox.allow_deletes:
+                logging.warning("Deletes are disabled on --site and --device runs, the other objects would be orphans")
+                netbox.allow_deletes = False
+            config["streaming"] = False
+            netbox.set_scope(args.site, args.device)
+            row_filter = RowScope(netbox, args.site, args.device)
+        for network_id in network_ids:
+            forward.pin_snapshot(network_id)
+
+        run_sync(config, forward, netbox, network_ids, run_metrics, row_filter)
+
+        if args.dump:
+            os.makedirs(args.dump, exist_ok=True)
+            forward.save_recording(os.path.join(args.dump, "forward.json"))
+            netbox.save_recording(os.path.join(args.dump, "netbox.json"))
+
+        if netbox.plan is not None:
+            plan_file = args.plan or "plan.json"
+            netbox.plan.metadata = {"netbox": netbox.host, "forward_snapshots": forward.snapshot_ids}
+            netbox.plan.save(plan_file)
+            for path, counts in netbox.plan.summary().items():
+                logging.info("Plan %s: %d to create, %d to update, %d to delete",
+                             path, counts["create"], counts["update"], counts["delete"])
+            logging.info("Dry run, NetBox was not modified. Plan written to %s", plan_file)
+
+        close_connectors(forward, netbox)
+    finally:
+        stop_loggers()  # Flush the queued log records
+
 
 if __name__ == "__main__":
     main()
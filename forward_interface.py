@@ -1,10 +1,16 @@
 """Set of functions related to Forward API interactions"""
+import fcntl
+import json
+import os
 from common import ApiConnector, logging, requests
+from records import DeviceRecord, InterfaceRecord, VdcRecord
 
 
 class ForwardAPI(ApiConnector):
     """Forward API implementation"""
-    def __init__(self, config, ssl_verify=True):
+    service = "forward"
+
+    def __init__(self, config, ssl_verify=True, metrics=None):
         headers = {
             "Accept": "application/json",
             "Content-Type": "application/json",
@@ -15,7 +21,18 @@ class ForwardAPI(ApiConnector):
                               config["authentication"],
                               http_headers=headers,
                               ssl_verify=ssl_verify,
-                              timeout=config["timeout"])
+                              timeout=config["timeout"],
+                              pool_size=config.get("pool_size", 10),
+                              keep_alive=config.get("keep_alive", True),
+                              workers=config.get("workers", 4),
+                              retries=config.get("retries", 3),
+                              backoff_factor=config.get("backoff_factor", 0.5),
+                              backoff_max=config.get("backoff_max", 30),
+                              rate_limit=config.get("rate_limit"),
+                              rate_burst=config.get("rate_burst"),
+                              json_codec=config.get("json_codec"),
+                              metrics=metrics)
+        self.idempotent_posts = True  # NQE queries are read-only
         self.network_id = config["network_id"]
         self.locations_query_id = config["nqe"]["locations_query_id"]
         self.vendors_query_id = config["nqe"]["vendors_query_id"]
@@ -26,6 +43,16 @@ class ForwardAPI(ApiConnector):
         self.virtual_device_contexts_query_id = config["nqe"]["virtual_device_contexts_query_id"]
         self.virtual_chassis_query_id = config["nqe"]["virtual_chassis_query_id"]
         self.nqe_limit = config.get("nqe_limit", 1000)
+        self.snapshot_ids = {}  # Snapshot pinned for each network during this run
+        self.incremental = config.get("incremental", False)
+        self.state_file = config.get("state_file", "sync_state.json")
+        self.base_snapshot_ids = {}  # Last synced snapshot of each network, for incremental runs
+
+    def reset_run_state(self):
+        """Forget the snapshots pinned by the previous run"""
+        ApiConnector.reset_run_state(self)
+        self.snapshot_ids = {}
+        self.base_snapshot_ids = {}
 
     def get_locations(self, network_id=None, query_id=None) -> dict:
         """Get Location list using Forward NQE API"""
@@ -65,7 +92,7 @@ class ForwardAPI(ApiConnector):
             network_id = self.network_id
         if query_id is None:
             query_id = self.devices_query_id
-        return self.run_nqe_query(query_id, network_id)
+        return self.run_nqe_query(query_id, network_id, DeviceRecord)
 
     def get_interfaces(self, network_id=None, query_id=None) -> dict:
         """Get interfaces list using NQE API"""
@@ -73,7 +100,7 @@ class ForwardAPI(ApiConnector):
             network_id = self.network_id
         if query_id is None:
             query_id = self.interfaces_query_id
-        return self.run_nqe_query(query_id, network_id)
+        return self.run_nqe_query(query_id, network_id, InterfaceRecord)
 
     def get_virtual_device_contexts(self, network_id=None, query_id=None) -> dict:
         """Get virtual device context list using Forward NQE API"""
@@ -81,7 +108,7 @@ class ForwardAPI(ApiConnector):
             network_id = self.network_id
         if query_id is None:
             query_id = self.virtual_device_contexts_query_id
-        return self.run_nqe_query(query_id, network_id)
+        return self.run_nqe_query(query_id, network_id, VdcRecord)
 
     def get_virtual_chassis(self, network_id=None, query_id=None) -> dict:
         """Get virtual chassis list using Forward NQE API"""
@@ -91,41 +118,169 @@ class ForwardAPI(ApiConnector):
             query_id = self.virtual_chassis_query_id
         return self.run_nqe_query(query_id, network_id)
 
-    def run_nqe_query(self, query_id, network_id=None) -> list:
-        """Execute a paginated NQE query and return all results"""
+    def iter_interfaces(self, network_id=None, query_id=None):
+        """Yield pages of the interfaces list using NQE API"""
+        if network_id is None:
+            network_id = self.network_id
+        if query_id is None:
+            query_id = self.interfaces_query_id
+        return self.iter_nqe_query(query_id, network_id, InterfaceRecord)
+
+    def iter_nqe_query(self, query_id, network_id=None, record_type=None):
+        """Yield the result pages of an NQE query as they arrive, see run_nqe_query"""
         if network_id is None:
             network_id = self.network_id
-        snapshot_id = self.get_latest_snapshot(network_id)["id"]
+        snapshot_id = self.get_snapshot_id(network_id)
+        base_snapshot_id = self.base_snapshot_ids.get(network_id)
+        count = 0
+        if base_snapshot_id is not None:
+            if base_snapshot_id == snapshot_id:
+                logging.info("Snapshot %s already synced, nothing to fetch for NQE query %s", snapshot_id, query_id)
+                return
+            pages = self._iter_post_pages(f"/api/nqe-diffs/{base_snapshot_id}/{snapshot_id}", query_id,
+                                          "options", "rows", "totalNumRows")
+            for rows in pages:
+                changed = [row["after"] for row in rows
+                           if row.get("type") in ("ADDED", "MODIFIED") and row.get("after")]
+                count += len(changed)
+                yield self._to_records(changed, record_type)
+        else:
+            for items in self._iter_post_pages(f"/api/nqe?snapshotId={snapshot_id}", query_id,
+                                               "queryOptions", "items", "totalNumItems"):
+                count += len(items)
+                yield self._to_records(items, record_type)
+        logging.info("Streamed %d items from NQE query %s", count, query_id)
+
+    def run_nqe_query(self, query_id, network_id=None, record_type=None) -> list:
+        """Execute a paginated NQE query against the pinned snapshot and return all results.
+        On incremental runs only the rows added or modified since the last synced snapshot are returned.
+        Rows are converted to record_type records when one is given, dictionaries are returned otherwise.
+        """
+        if network_id is None:
+            network_id = self.network_id
+        snapshot_id = self.get_snapshot_id(network_id)
+        base_snapshot_id = self.base_snapshot_ids.get(network_id)
+        if base_snapshot_id is not None:
+            return self.run_nqe_diff(query_id, base_snapshot_id, snapshot_id, record_type)
+
         logging.debug("Running Forward NQE Query...")
+        all_items = self._post_paginated(f"/api/nqe?snapshotId={snapshot_id}", query_id,
+                                         "queryOptions", "items", "totalNumItems", record_type)
+        logging.info("Fetched %d items from NQE query %s", len(all_items), query_id)
+        return all_items
+
+    def run_nqe_diff(self, query_id, before_snapshot_id, after_snapshot_id, record_type=None) -> list:
+        """Execute a paginated NQE diff and return the rows added or modified between two snapshots"""
+        if before_snapshot_id == after_snapshot_id:
+            logging.info("Snapshot %s already synced, nothing to fetch for NQE query %s", after_snapshot_id, query_id)
+            return []
+        logging.debug("Running Forward NQE Diff...")
+        rows = self._post_paginated(f"/api/nqe-diffs/{before_snapshot_id}/{after_snapshot_id}", query_id,
+                                    "options", "rows", "totalNumRows")
+        changed = [row["after"] for row in rows if row.get("type") in ("ADDED", "MODIFIED") and row.get("after")]
+        changed = self._to_records(changed, record_type)
+        logging.info("Fetched %d changed items out of %d diff rows from NQE query %s", len(changed), len(rows), query_id)
+        return changed
+
+    def _post_paginated(self, path, query_id, options_key, items_key, total_key, record_type=None) -> list:
+        """POST a paginated NQE request and return all the items"""
+        return [item for items in self._iter_post_pages(path, query_id, options_key, items_key, total_key)
+                for item in self._to_records(items, record_type)]
+
+    @staticmethod
+    def _to_records(items, record_type=None) -> list:
+        """Convert a page of NQE rows to records, keep the dictionaries without a record_type"""
+        if record_type is None:
+            return items
+        return [record_type.from_row(item) for item in items]
 
-        offset = 0
-        limit = 1000
-        total_items = None
-        all_items = []
+    def _iter_post_pages(self, path, query_id, options_key, items_key, total_key):
+        """POST a paginated NQE request and yield its pages:
+        The first page returns the total number of items, the remaining
+        pages are then fetched concurrently, a few pages ahead of the
+        consumer, and yielded in page order.
+        """
+        limit = self.nqe_limit
 
-        while total_items is None or offset < total_items:
+        def get_page(offset):
             data = {
                 "queryId": query_id,
-                "queryOptions": {
+                options_key: {
                     "offset": offset,
                     "limit": limit
                 }
             }
+            response = self._post(path, data)
+            if response is None or items_key not in response:
+                logging.warning("No results from NQE at offset %d", offset)
+                return None
+            return response
 
-            response = self._post(f"/api/nqe?snapshotId={snapshot_id}", data)
-            if response is None or "items" not in response:
-                logging.warning(f"No results from NQE at offset {offset}")
-                break
+        response = get_page(0)
+        if response is None:
+            return
+        total_items = response.get(total_key, 0)
+        logging.debug("NQE reported %s=%d", total_key, total_items)
 
-            if total_items is None:
-                total_items = response.get("totalNumItems", 0)
-                logging.debug(f"NQE reported totalNumItems={total_items}")
+        yield response[items_key]
+        for page in self._iter_concurrently(get_page, range(limit, total_items, limit)):
+            yield page[items_key] if page is not None else []
 
-            all_items.extend(response["items"])
-            offset += limit
+    def pin_snapshot(self, network_id=None, snapshot_id=None):
+        """Pin the snapshot used by every NQE query of this run, defaults to the latest processed one"""
+        if network_id is None:
+            network_id = self.network_id
+        if snapshot_id is None:
+            snapshot_id = self.get_latest_snapshot(network_id)["id"]
+        self.snapshot_ids[network_id] = snapshot_id
+        logging.info("Using Forward snapshot %s for network %s", snapshot_id, network_id)
+        if self.incremental:
+            self._load_base_snapshot(network_id)
+        return snapshot_id
 
-        logging.info(f"Fetched {len(all_items)} items from NQE query {query_id}")
-        return all_items
+    def get_snapshot_id(self, network_id=None):
+        """Get the snapshot pinned for a network, pinning the latest processed one if needed"""
+        if network_id is None:
+            network_id = self.network_id
+        if network_id not in self.snapshot_ids:
+            return self.pin_snapshot(network_id)
+        return self.snapshot_ids[network_id]
+
+    def read_sync_state(self) -> dict:
+        """Read the last synced snapshot of each network from the state file"""
+        if not os.path.exists(self.state_file):
+            return {}
+        with open(self.state_file, "r", encoding="UTF-8") as f:
+            return json.load(f)
+
+    def _load_base_snapshot(self, network_id):
+        """Use the last synced snapshot of a network as the base of the NQE diffs"""
+        base_snapshot_id = self.read_sync_state().get(str(network_id))
+        if base_snapshot_id is None:
+            logging.info("No synced snapshot recorded for network %s, running a full sync", network_id)
+            self.base_snapshot_ids.pop(network_id, None)
+            return
+        logging.info("Incremental sync of network %s from snapshot %s", network_id, base_snapshot_id)
+        self.base_snapshot_ids[network_id] = base_snapshot_id
+
+    def save_sync_state(self, network_id=None):
+        """Record the pinned snapshot of a network as successfully synced:
+        Processes syncing other networks write the same state file, it
+        is re-read under an exclusive lock on state_file.lock and
+        replaced atomically, so no network's snapshot is lost.
+        """
+        if network_id is None:
+            network_id = self.network_id
+        snapshot_id = self.get_snapshot_id(network_id)
+        with open(f"{self.state_file}.lock", "w", encoding="UTF-8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # Released when the lock file is closed
+            state = self.read_sync_state()
+            state[str(network_id)] = snapshot_id
+            temporary = f"{self.state_file}.tmp"
+            with open(temporary, "w", encoding="UTF-8") as f:
+                json.dump(state, f, indent=2)
+            os.replace(temporary, self.state_file)
+        logging.info("Recorded snapshot %s as synced for network %s", snapshot_id, network_id)
 
     def get_latest_snapshot(self, network_id=None) -> dict:
         """Get latest snapshot id"""
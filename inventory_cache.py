@@ -0,0 +1,130 @@
+"""Persistent SQLite cache of the NetBox collections, refreshed incrementally between runs"""
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from common import logging
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS objects (
+    endpoint TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    last_updated TEXT,
+    body BLOB NOT NULL,
+    PRIMARY KEY (endpoint, id)
+);
+CREATE TABLE IF NOT EXISTS endpoints (endpoint TEXT PRIMARY KEY, refreshed TEXT);
+"""
+
+
+class InventoryCache:
+    """NetBox objects of every endpoint read by a run, stored as encoded JSON by id:
+    The newest last_updated value of an endpoint is the watermark of
+    its next refresh. The cache is wiped when it belongs to another
+    NetBox host. A single connection is shared by the stage threads.
+    """
+
+    def __init__(self, path: str, host: str, codec):
+        self.path = path
+        self.codec = codec
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)  # Shared by network worker processes
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(SCHEMA)
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'host'").fetchone()
+            if row is not None and row[0] != host:
+                logging.info("Inventory cache %s belongs to %s, starting over", path, row[0])
+                self.db.execute("DELETE FROM objects")
+                self.db.execute("DELETE FROM endpoints")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('host', ?)", (host,))
+
+    def is_cached(self, endpoint: str) -> bool:
+        """Whether the endpoint was fully loaded once, so it can be refreshed incrementally"""
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM endpoints WHERE endpoint = ?", (endpoint,)).fetchone() is not None
+
+    def watermark(self, endpoint: str, overlap=0):
+        """Return the newest last_updated of an endpoint minus overlap seconds, None when unknown"""
+        with self.lock:
+            row = self.db.execute("SELECT max(last_updated) FROM objects WHERE endpoint = ?", (endpoint,)).fetchone()
+        if row is None or not row[0]:
+            return None
+        try:
+            newest = datetime.fromisoformat(row[0].replace("Z", "+00:00"))
+        except ValueError:
+            return row[0]
+        return (newest - timedelta(seconds=overlap)).isoformat()
+
+    def replace(self, endpoint: str, objects: list):
+        """Store the full collection of an endpoint"""
+        rows = self._rows(endpoint, objects)
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM objects WHERE endpoint = ?", (endpoint,))
+            self.db.executemany("INSERT INTO objects VALUES (?, ?, ?, ?)", rows)
+            self.db.execute("INSERT OR REPLACE INTO endpoints VALUES (?, datetime('now'))", (endpoint,))
+
+    def upsert(self, endpoint: str, objects: list, mark=True):
+        """Store new and changed objects, mark=False leaves an endpoint being filled page by page uncached"""
+        rows = self._rows(endpoint, objects)
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)", rows)
+            if mark:
+                self.db.execute("INSERT OR REPLACE INTO endpoints VALUES (?, datetime('now'))", (endpoint,))
+
+    def mark_cached(self, endpoint: str):
+        """Record that the objects stored page by page are the full collection of an endpoint"""
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO endpoints VALUES (?, datetime('now'))", (endpoint,))
+
+    def forget(self, endpoint: str):
+        """Drop the objects of an endpoint before filling it again"""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM objects WHERE endpoint = ?", (endpoint,))
+            self.db.execute("DELETE FROM endpoints WHERE endpoint = ?", (endpoint,))
+
+    def delete(self, endpoint: str, ids):
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM objects WHERE endpoint = ? AND id = ?", ((endpoint, id_) for id_ in ids))
+
+    def ids(self, endpoint: str) -> set:
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT id FROM objects WHERE endpoint = ?", (endpoint,))}
+
+    def count(self, endpoint: str) -> int:
+        with self.lock:
+            return self.db.execute("SELECT count(*) FROM objects WHERE endpoint = ?", (endpoint,)).fetchone()[0]
+
+    def load(self, endpoint: str) -> list:
+        """Return the cached objects of an endpoint in id order, like NetBox lists them"""
+        with self.lock:
+            bodies = self.db.execute("SELECT body FROM objects WHERE endpoint = ? ORDER BY id", (endpoint,)).fetchall()
+        return [self.codec.loads(body) for (body,) in bodies]
+
+    def iter_pages(self, endpoint: str, size=1000):
+        """Yield the cached objects of an endpoint in id order, size objects at a time"""
+        last_id = None
+        while True:
+            with self.lock:
+                if last_id is None:
+                    rows = self.db.execute("SELECT id, body FROM objects WHERE endpoint = ? ORDER BY id LIMIT ?",
+                                           (endpoint, size)).fetchall()
+                else:
+                    rows = self.db.execute("SELECT id, body FROM objects WHERE endpoint = ? AND id > ? "
+                                           "ORDER BY id LIMIT ?", (endpoint, last_id, size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [self.codec.loads(body) for _, body in rows]
+
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM objects")
+            self.db.execute("DELETE FROM endpoints")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _rows(self, endpoint: str, objects: list) -> list:
+        return [(endpoint, obj["id"], obj.get("last_updated"), self.codec.dumps(obj)) for obj in objects]
@@ -0,0 +1,275 @@
+"""Run metrics: per-endpoint HTTP statistics, per-stage timings and record counts"""
+import json
+import os
+import re
+import threading
+import time
+from common import logging
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Path segments replaced by a placeholder so each endpoint is reported once
+_ID_SEGMENT = re.compile(r"/(\d+|FQ_[0-9a-f]+)(?=/|$)")
+
+
+def normalize_endpoint(path: str) -> str:
+    """Strip the query string and the ids of an API path, /api/dcim/devices/12/ becomes /api/dcim/devices/{id}/"""
+    return _ID_SEGMENT.sub("/{id}", path.split("?", 1)[0])
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket bounds, as Prometheus expects them"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list:
+        """Return (bound, observations lower or equal) pairs, the last bound is +Inf"""
+        total, result = 0, []
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_dict(self) -> dict:
+        return {"buckets": {str(bound): count for bound, count in self.cumulative()},
+                "sum": round(self.sum, 6), "count": self.count}
+
+    def merge_dict(self, data: dict):
+        """Add the observations of a histogram exported by to_dict()"""
+        previous = 0
+        for i, total in enumerate(data["buckets"].values()):
+            self.counts[i] += total - previous
+            previous = total
+        self.sum += data["sum"]
+        self.count += data["count"]
+
+
+class EndpointStats:
+    """HTTP statistics of one (service, method, endpoint)"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0  # Exceptions and 4xx/5xx answers
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = Histogram()
+
+    def to_dict(self) -> dict:
+        return {"requests": self.requests, "errors": self.errors, "retries": self.retries,
+                "bytes_sent": self.bytes_sent, "bytes_received": self.bytes_received,
+                "latency": self.latency.to_dict()}
+
+
+class Metrics:
+    """Metrics of a run, shared by the API connectors and the stage scheduler"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.endpoints = {}  # (service, method, endpoint) -> EndpointStats
+        self.stages = {}     # stage name -> dict of timings and record counts
+        self.stages_wall_seconds = None
+        self._lock = threading.Lock()
+
+    def _endpoint(self, service: str, method: str, path: str) -> EndpointStats:
+        key = (service, method, normalize_endpoint(path))
+        stats = self.endpoints.get(key)
+        if stats is None:
+            stats = self.endpoints[key] = EndpointStats()
+        return stats
+
+    def observe_request(self, service: str, method: str, path: str, status, latency: float,
+                        bytes_sent: int, bytes_received: int):
+        """Record one HTTP request, status is None when no answer was received"""
+        with self._lock:
+            stats = self._endpoint(service, method, path)
+            stats.requests += 1
+            if status is None or status >= 400:
+                stats.errors += 1
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.latency.observe(latency)
+
+    def observe_retry(self, service: str, method: str, path: str):
+        with self._lock:
+            self._endpoint(service, method, path).retries += 1
+
+    def record_stages(self, scheduler):
+        """Record the timings of every stage that ran and the record counts they returned"""
+        for stage in scheduler.stages.values():
+            if stage.started is None:
+                continue
+            entry = {"wall_seconds": round(stage.duration, 6), "cpu_seconds": round(stage.cpu_time, 6),
+                     "failed": stage.error is not None}
+            if isinstance(stage.result, dict):
+                for action in ("created", "updated", "skipped"):
+                    if action in stage.result:
+                        entry[action] = stage.result[action]
+            self.stages[stage.name] = entry
+        if scheduler.started is not None and scheduler.finished is not None:
+            self.stages_wall_seconds = round(scheduler.finished - scheduler.started, 6)
+
+    def merge(self, report: dict, stage_prefix=""):
+        """Add the requests and stages of the report of another process, its stage names prefixed"""
+        with self._lock:
+            for endpoint in report["endpoints"]:
+                stats = self._endpoint(endpoint["service"], endpoint["method"], endpoint["endpoint"])
+                for key in ("requests", "errors", "retries", "bytes_sent", "bytes_received"):
+                    setattr(stats, key, getattr(stats, key) + endpoint[key])
+                stats.latency.merge_dict(endpoint["latency"])
+            for name, stage in report["stages"].items():
+                self.stages[f"{stage_prefix}{name}"] = stage
+
+    def report(self) -> dict:
+        """Return the run report as a JSON-serializable dictionary"""
+        with self._lock:
+            endpoints = [{"service": service, "method": method, "endpoint": endpoint, **stats.to_dict()}
+                         for (service, method, endpoint), stats in sorted(self.endpoints.items())]
+        totals = {key: sum(endpoint[key] for endpoint in endpoints)
+                  for key in ("requests", "errors", "retries", "bytes_sent", "bytes_received")}
+        return {
+            "started": self.started,
+            "duration_seconds": round(time.time() - self.started, 6),
+            "stages_wall_seconds": self.stages_wall_seconds,
+            "totals": totals,
+            "stages": self.stages,
+            "endpoints": endpoints,
+        }
+
+    def export(self, report_file=None, textfile=None, regression_threshold=0.2) -> dict:
+        """Write the JSON run report and the Prometheus textfile, comparing with the previous report"""
+        report = self.report()
+        if report_file:
+            previous = self._read_report(report_file)
+            if previous is not None:
+                report["comparison"] = compare_reports(previous, report, regression_threshold)
+            _write_atomically(report_file, json.dumps(report, indent=2))
+            logging.info("Run report written to %s", report_file)
+        if textfile:
+            _write_atomically(textfile, to_prometheus(report))
+            logging.info("Prometheus metrics written to %s", textfile)
+        return report
+
+    @staticmethod
+    def _read_report(path: str):
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="UTF-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring unreadable previous run report %s: %s", path, e)
+            return None
+
+
+def compare_reports(previous: dict, current: dict, threshold=0.2, min_seconds=0.5) -> dict:
+    """Compare two run reports and log the stages and totals that regressed by more than threshold.
+    Stage time differences under min_seconds are ignored as noise.
+    """
+    def delta(before, after):
+        change = {"previous": before, "current": after, "delta": round(after - before, 6)}
+        if before:
+            change["ratio"] = round(after / before, 3)
+        return change
+
+    comparison = {"stages": {}, "totals": {}, "regressions": []}
+    for name, stage in current.get("stages", {}).items():
+        before = previous.get("stages", {}).get(name)
+        if not before:
+            continue
+        comparison["stages"][name] = {key: delta(before[key], stage[key])
+                                      for key in ("wall_seconds", "cpu_seconds") if key in before}
+        wall = comparison["stages"][name].get("wall_seconds")
+        if wall and wall["delta"] > min_seconds and wall["delta"] > threshold * wall["previous"]:
+            comparison["regressions"].append(f"stage {name} took {wall['current']:.2f}s "
+                                             f"instead of {wall['previous']:.2f}s")
+    for key, value in current.get("totals", {}).items():
+        before = previous.get("totals", {}).get(key)
+        if before is None:
+            continue
+        comparison["totals"][key] = delta(before, value)
+        if value > before * (1 + threshold) and key in ("requests", "errors", "retries"):
+            comparison["regressions"].append(f"{key} went from {before} to {value}")
+
+    for regression in comparison["regressions"]:
+        logging.warning("Regression since the previous run: %s", regression)
+    return comparison
+
+
+def _labels(**labels) -> str:
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def to_prometheus(report: dict) -> str:
+    """Render a run report in the Prometheus text exposition format, for the node_exporter textfile collector"""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP fwd_netbox_{name} {help_text}")
+        lines.append(f"# TYPE fwd_netbox_{name} {kind}")
+        for suffix, labels, value in samples:
+            lines.append(f"fwd_netbox_{name}{suffix}{_labels(**labels)} {value}")
+
+    endpoints = report["endpoints"]
+    label_sets = [{"service": e["service"], "method": e["method"], "endpoint": e["endpoint"]} for e in endpoints]
+    for name, key, help_text in (("http_requests_total", "requests", "HTTP requests sent"),
+                                 ("http_errors_total", "errors", "HTTP requests that failed"),
+                                 ("http_retries_total", "retries", "HTTP requests retried"),
+                                 ("http_sent_bytes_total", "bytes_sent", "Request body bytes sent"),
+                                 ("http_received_bytes_total", "bytes_received", "Response body bytes received")):
+        metric(name, "counter", help_text, [("", labels, e[key]) for labels, e in zip(label_sets, endpoints)])
+
+    samples = []
+    for labels, e in zip(label_sets, endpoints):
+        for bound, count in e["latency"]["buckets"].items():
+            samples.append(("_bucket", {**labels, "le": bound}, count))
+        samples.append(("_sum", labels, e["latency"]["sum"]))
+        samples.append(("_count", labels, e["latency"]["count"]))
+    metric("http_request_duration_seconds", "histogram", "HTTP request latency", samples)
+
+    stages = report["stages"]
+    metric("stage_duration_seconds", "gauge", "Stage wall time",
+           [("", {"stage": name}, stage["wall_seconds"]) for name, stage in stages.items()])
+    metric("stage_cpu_seconds", "gauge", "CPU time of the thread running the stage",
+           [("", {"stage": name}, stage["cpu_seconds"]) for name, stage in stages.items()])
+    metric("stage_records", "gauge", "Records created, updated or skipped by the stage",
+           [("", {"stage": name, "action": action}, stage[action])
+            for name, stage in stages.items() for action in ("created", "updated", "skipped") if action in stage])
+    metric("stage_failed", "gauge", "Whether the stage failed",
+           [("", {"stage": name}, int(stage["failed"])) for name, stage in stages.items()])
+
+    metric("run_duration_seconds", "gauge", "Run wall time", [("", {}, report["duration_seconds"])])
+    metric("run_timestamp_seconds", "gauge", "Start time of the run", [("", {}, report["started"])])
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomically(path: str, content: str):
+    """Write a file through a temporary file so readers never see it half-written"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="UTF-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
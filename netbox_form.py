@@ -1,8 +1,13 @@
-from flask import Flask, request, render_template
+import hmac
+from flask import Flask, jsonify, request, render_template
 import yaml
+from sync_jobs import SyncJobs
 
 app = Flask(__name__)
 
+CONFIG_FILE = 'configuration.yaml'
+sync_jobs = None  # Created on the first webhook call, with the webhook settings of the configuration
+
 default_values = {
     "debug": False,
     "add_sites": True,
@@ -73,7 +78,7 @@ def form():
         }
 
         # Write YAML data to a file
-        with open('configuration.yaml', 'w') as yaml_file:
+        with open(CONFIG_FILE, 'w') as yaml_file:
             yaml.dump(yaml_data, yaml_file, default_flow_style=False, sort_keys=False)
 
         return "YAML configuration file has been generated successfully."
@@ -81,5 +86,73 @@ def form():
     return render_template('netbox.html', defaults=default_values)
 
 
+def load_config():
+    try:
+        with open(CONFIG_FILE, 'r', encoding='UTF-8') as f:
+            return yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        return {}
+
+
+def authorized(settings):
+    """Check the webhook token, sent as a Bearer token or in the X-Webhook-Token header, when one is set"""
+    token = settings.get('token')
+    if not token:
+        return True
+    sent = request.headers.get('X-Webhook-Token', '')
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        sent = authorization[len('Bearer '):]
+    return hmac.compare_digest(sent.encode(), str(token).encode())
+
+
+def get_sync_jobs(settings):
+    global sync_jobs
+    if sync_jobs is None:
+        sync_jobs = SyncJobs(CONFIG_FILE, workers=settings.get('workers', 1), history=settings.get('history', 100))
+    return sync_jobs
+
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    """Queue a sync of the network of a Forward snapshot-processed notification"""
+    config = load_config()
+    settings = config.get('webhook') or {}
+    if not authorized(settings):
+        return jsonify(error='Invalid or missing webhook token'), 401
+
+    payload = request.get_json(silent=True) or {}
+    network_id = payload.get('networkId') or payload.get('network_id') or request.args.get('networkId')
+    if not network_id:
+        return jsonify(error='The notification has no networkId'), 400
+    forward = config.get('forward') or {}
+    networks = [str(network) for network in forward.get('network_ids') or [forward.get('network_id')]]
+    if str(network_id) not in networks:
+        return jsonify(error=f'Network {network_id} is not synced to NetBox'), 404
+
+    job, coalesced = get_sync_jobs(settings).submit(network_id, payload.get('snapshotId') or payload.get('snapshot_id'),
+                                                    trigger=request.remote_addr)
+    return jsonify(job=job, coalesced=coalesced), 202
+
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    settings = load_config().get('webhook') or {}
+    if not authorized(settings):
+        return jsonify(error='Invalid or missing webhook token'), 401
+    return jsonify(jobs=get_sync_jobs(settings).list())
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    settings = load_config().get('webhook') or {}
+    if not authorized(settings):
+        return jsonify(error='Invalid or missing webhook token'), 401
+    job = get_sync_jobs(settings).get(job_id)
+    if job is None:
+        return jsonify(error=f'Unknown job {job_id}'), 404
+    return jsonify(job=job)
+
+
 if __name__ == '__main__':
     app.run(debug=True)
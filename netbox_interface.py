@@ -1,12 +1,69 @@
 """Set of functions related to Netbox API interactions"""
+import functools
+import json
+import os
+import threading
+import time
+from collections import Counter
+from itertools import chain
 from math import ceil
-from common import ApiConnector, logging, create_slug
+from urllib.parse import quote
+from common import ApiConnector, LazyDump, logging, log_objects, create_slug
+from inventory_cache import InventoryCache
+from plan import Plan, resolve_placeholders
+from records import InterfaceRecord
+from reconcile import Reconciler, diff_fields, reconcile, reduce_object, ref_id
+
+
+# Endpoints whose orphans are deleted when allow_deletes is set, in deletion order:
+# objects are deleted before the objects they reference. Manufacturers, roles and
+# device types are shared reference data and are never deleted.
+DELETE_ORDER = [
+    ("/api/dcim/interfaces/", "interface"),
+    ("/api/dcim/virtual-device-contexts/", "VDC"),
+    ("/api/dcim/virtual-chassis/", "virtual chassis"),
+    ("/api/dcim/devices/", "device"),
+    ("/api/dcim/sites/", "site"),
+]
+
+
+def log_unresolved(missing: Counter, kind: str, outcome: str, examples=5):
+    """Log one warning for the entries whose device is not in NetBox, with a few of those devices"""
+    if not missing:
+        return
+    names = [name for name, _ in missing.most_common(examples)]
+    more = f" and {len(missing) - examples} more" if len(missing) > examples else ""
+    logging.warning("%d %s %s, devices not in NetBox (%d): %s%s",
+                    sum(missing.values()), kind, outcome, len(missing), ", ".join(names), more)
+
+
+def cached_map(path: str):
+    """Decorator keeping the map built by a helper until the NetBox endpoint it reads is written to"""
+    def decorator(helper):
+        @functools.wraps(helper)
+        def wrapper(self):
+            return self._cached((path, helper.__name__), lambda: helper(self))
+        wrapper.path = path
+        return wrapper
+    return decorator
+
+
+# Lookup maps of the prerequisite stages written to maps_cache, see save_maps
+SAVED_MAPS = [
+    "_get_site_map_helper",
+    "_get_manufacturer_map_helper",
+    "_get_role_map_helper",
+    "_get_device_type_map_helper",
+    "_get_interface_map_helper",
+    "_get_virtual_device_context_map_helper",
+]
 
 
 class NetboxAPI(ApiConnector):
     """API implementation for Netbox"""
+    service = "netbox"
 
-    def __init__(self, config, ssl_verify=True):
+    def __init__(self, config, ssl_verify=True, metrics=None):
         headers = {
             "Accept": "application/json",
             "Content-Type": "application/json",
@@ -18,7 +75,17 @@ class NetboxAPI(ApiConnector):
                               config["authentication"],
                               http_headers=headers,
                               ssl_verify=ssl_verify,
-                              timeout=config["timeout"])
+                              timeout=config["timeout"],
+                              pool_size=config.get("pool_size", 10),
+                              keep_alive=config.get("keep_alive", True),
+                              workers=config.get("workers", 4),
+                              retries=config.get("retries", 3),
+                              backoff_factor=config.get("backoff_factor", 0.5),
+                              backoff_max=config.get("backoff_max", 30),
+                              rate_limit=config.get("rate_limit"),
+                              rate_burst=config.get("rate_burst"),
+                              json_codec=config.get("json_codec"),
+                              metrics=metrics)
         self.speeds_types = {  # Static mapping of port speeds
             10:     "100base-tx",
             100:    "100base-tx",
@@ -32,42 +99,80 @@ class NetboxAPI(ApiConnector):
             100000: "100gbase-x-qsfp28",
             None: "other"
         }
-        self.request_limit = config.get("post_limit", 50)  # Defaults to 50
-        self.post_limit = config.get("post_limit", 100)
+        self.request_limit = config.get("request_limit", 50)  # Defaults to 50
+        self.post_limit = config.get("post_limit", 100)  # Initial chunk size of bulk writes
+        self.max_post_limit = config.get("max_post_limit", self.post_limit * 4)
+        self.bulk_target_latency = config.get("bulk_target_latency", 10)  # Seconds per bulk write chunk
+        self.lookup_mode = "fields"  # Lean lookup fetches: "fields" (NetBox 4.0+), then "brief"
+        self._cache = {}  # (endpoint, variant) -> collection or map, kept for the whole run
+        self._cache_lock = threading.Lock()
+        self._cache_key_locks = {}
         self.allow_deletes = config.get("allow_deletes", False)# Chunk size for bulk POST/PATCH operations
+        if config.get("dry_run", False):
+            self.plan = Plan()  # Writes are recorded in the plan, NetBox is left untouched
+        self.max_delete_fraction = config.get("max_delete_fraction", 0.1)
+        self.min_delete_cap = config.get("min_delete_cap", 10)  # Deletes always allowed per endpoint
+        self.orphans = {}  # endpoint -> (NetBox objects missing from Forward, number of NetBox objects)
+        self.forward_device_ids = set()  # NetBox ids of the devices synced from Forward
+        self.inventory = None  # Collections kept on disk between runs, refreshed with last_updated queries
+        if config.get("inventory_cache"):
+            self.inventory = InventoryCache(config["inventory_cache"], config["host"], self.codec)
+        self.inventory_overlap = config.get("inventory_overlap", 60)  # Seconds refetched before the watermark
+        self.maps_cache = config.get("maps_cache")  # Lookup maps kept between runs, see save_maps
+        self.maps_max_age = config.get("maps_max_age", 86400)  # Seconds a saved map is trusted
+        self._loaded_maps = {}  # map name -> (map seeded by load_maps, time it was built from NetBox)
+        self.scope = None  # (site names, device names) the interfaces are restricted to, see set_scope
+
+    def reset_run_state(self):
+        """Forget the orphans and Forward devices of the previous run"""
+        ApiConnector.reset_run_state(self)
+        self.orphans = {}
+        self.forward_device_ids = set()
+
+    def close(self):
+        """Close all the pooled connections and the inventory cache"""
+        ApiConnector.close(self)
+        if self.inventory is not None:
+            self.inventory.close()
 
     def get_manufacturers(self):
         """Get Manufacturers from netbox"""
         logging.debug("Getting Manufacturers From NetBox...")
-        return self._get_paginated("/api/dcim/manufacturers/")
+        return self._get_collection("/api/dcim/manufacturers/")
 
     def get_roles(self):
         """Get Roles from netbox"""
         logging.debug("Getting Roles From NetBox...")
-        return self._get_paginated("/api/dcim/device-roles/")
+        return self._get_collection("/api/dcim/device-roles/")
 
     def get_sites(self):
         """Get Sites from Netbox using API"""
         logging.debug("Getting Sites From NetBox...")
-        return self._get_paginated("/api/dcim/sites/")
+        return self._get_collection("/api/dcim/sites/")
 
     def get_device_types(self):
         """Get Device Types form Netbox using API"""
         logging.debug("Getting Device Types from NetBox...")
-        return self._get_paginated("/api/dcim/device-types/")
+        return self._get_collection("/api/dcim/device-types/")
 
     def get_devices(self) -> dict:
         """Get Devices form Netbox using API"""
         logging.debug("Getting Devices from NetBox...")
-        response = self._get_paginated("/api/dcim/devices/")
+        response = self._get_collection("/api/dcim/devices/")
         if response is not None:
             return response
         raise ValueError("Received empty response")
 
     def get_interfaces(self) -> dict:
-        """Get Interfaces using API"""
+        """Get Interfaces using API, only those of the scoped devices when set_scope() was called"""
         logging.debug("Getting Interfaces from Netbox using API")
-        response = self._get_paginated("/api/dcim/interfaces/")
+        if self.scope is not None:
+            # Keyed by the scope, the partial list must never be read as the full collection
+            sites, devices = self.scope
+            variant = f"scope:{','.join(sorted(sites))}|{','.join(sorted(devices))}"
+            response = self._cached(("/api/dcim/interfaces/", variant), self._get_scoped_interfaces)
+        else:
+            response = self._get_collection("/api/dcim/interfaces/")
         if response is not None:
             return response
         raise ValueError("Received empty response")
@@ -75,7 +180,7 @@ class NetboxAPI(ApiConnector):
     def get_virtual_device_contexts(self) -> dict:
         """Get Virtual Device Contexts from NetBox using API"""
         logging.debug("Getting Virtual Device Contexts from NetBox...")
-        response = self._get_paginated("/api/dcim/virtual-device-contexts/")
+        response = self._get_collection("/api/dcim/virtual-device-contexts/")
         if response is not None:
             return response
         raise ValueError("Received empty response")
@@ -83,54 +188,56 @@ class NetboxAPI(ApiConnector):
     def get_virtual_chassis(self) -> dict:
         """Get Virtual Chassis from NetBox using API"""
         logging.debug("Getting Virtual Chassis from NetBox...")
-        response = self._get_paginated("/api/dcim/virtual-chassis/")
+        response = self._get_collection("/api/dcim/virtual-chassis/")
         if response is not None:
             return response
         raise ValueError("Received empty response")
 
     def add_site(self, site):
         """Add a Site to netbox"""
-        logging.debug(f"Adding {site} site to NetBox...")
-        self._post("/api/dcim/sites/", site)
+        logging.debug("Adding %s site to NetBox...", site)
+        return self._post("/api/dcim/sites/", site)
+
+    def post_sites(self, sites: list) -> list:
+        """Add Sites to netbox in chunks using NetBox bulk POST API"""
+        logging.debug("Bulk POSTing %d sites", len(sites))
+        return self._bulkpost("/api/dcim/sites/", sites)
 
     def patch_sites(self, sites: list):
         """Patch existing Sites in netbox"""
         logging.debug("Patching Sites in Netbox...")
-        self._patch("/api/dcim/sites/", sites)
+        return self._bulkpatch("/api/dcim/sites/", sites)
 
     def add_site_list(self, fwd_locations):
         """Add list of sites to netbox:
         This function gets a list of forward locations, it then
-        iterates over the existing site list present
-        in Netbox to find existing sites, using sets
-        then it extract sites not present. For the
-        devices present it adds the id of the site
-        and patches the list as a whole. For the site
-        list of non-existing sites it posts each site
-        individually.
+        reconciles them against the existing sites present
+        in Netbox using the lower-cased site name as key.
+        For the sites present it adds the id of the site
+        and patches the changed fields only. The list of
+        non-existing sites is bulk posted, the created
+        sites are returned with their NetBox id.
 
         Keyword arguments:
         fwd_locations -- List of devices to add into Netbox.
         """
-        logging.debug(f"======> Adding a list of {len(fwd_locations)} sites")
+        logging.debug("======> Adding a list of %d sites", len(fwd_locations))
         site_res = self.get_sites()
-        if site_res is not None:
-            existing_sites = site_res["results"]  # Sites already in NetBox
-        update_sites = []    # List of sites to be updated in NetBox
-        create_sites = []    # List of sites to be added in NetBox
-        add_unknown_site = True
-
-        for site in fwd_locations:
-            for existing_site in existing_sites:
-                if site["name"] == existing_site["name"].lower():
-                    site["id"] = existing_site["id"]
-                    site["name"] = existing_site["name"]
-                    update_sites.append(site)
-
-                if existing_site["name"].lower() == "unknown":
-                    add_unknown_site = False
-
-        create_sites = [site for site in fwd_locations if "id" not in site.keys()]
+        existing_sites = site_res["results"] if site_res is not None else []  # Sites already in NetBox
+
+        def keep_netbox_name(site, existing_site):
+            site["name"] = existing_site["name"]
+
+        result = reconcile(fwd_locations, existing_sites,
+                           fwd_key=lambda site: site["name"].lower(),
+                           diff=diff_fields,
+                           on_match=keep_netbox_name)
+        # The Unknown site holds the devices Forward reports without a location
+        self._track_orphans("/api/dcim/sites/", [site for site in result.orphans if site["name"].lower() != "unknown"],
+                            len(existing_sites))
+        update_sites = result.update    # List of sites to be updated in NetBox
+        create_sites = result.create    # List of sites to be added in NetBox
+        add_unknown_site = not any(site["name"].lower() == "unknown" for site in existing_sites)
 
         # If a device in Forward is not assigned to any location, its location is set to "unknown" in the NQE query
         # The following two lines create an unknown_site and append it to the list of sites to be created
@@ -153,28 +260,33 @@ class NetboxAPI(ApiConnector):
         for site in create_sites:
             site["name"] = site["name"].title()
 
-        # Update existing devices
-        self.patch_sites(update_sites)
+        # Update existing sites
+        logging.info("%d sites changed, %d unchanged", len(update_sites), len(result.unchanged))
+        if result.patches:
+            self.patch_sites(result.patches)
 
-        # Create new Devices
-        for site in create_sites:
-            self.add_site(site)
+        # Create new sites
+        created_sites = self.post_sites(create_sites) if create_sites else []
 
-        return create_sites, update_sites
+        return created_sites, update_sites
 
     def add_device_type(self, device_type):
         """Add a device type to netbox"""
         logging.debug("Adding %s device type to NetBox...", device_type)
-        self._post("/api/dcim/device-types/", device_type)
+        return self._post("/api/dcim/device-types/", device_type)
+
+    def post_device_types(self, device_types: list) -> list:
+        """Add device types to netbox in chunks using NetBox bulk POST API"""
+        logging.debug("Bulk POSTing %d device types", len(device_types))
+        return self._bulkpost("/api/dcim/device-types/", device_types)
 
     def add_device_type_list(self, fwd_models):
         """Add list of device types to netbox:
         This function gets a list of forward device models, it then
-        iterates over the existing device types list present
-        in Netbox to find existing types, using sets
-        then it extract types not present. For the type
-        list of non-existing types it posts each type
-        individually.
+        reconciles them against the existing device types present
+        in Netbox using the model as key. The list of
+        non-existing types is bulk posted, the created
+        types are returned with their NetBox id.
 
         Keyword arguments:
         fwd_models -- List of device models to add into Netbox device types.
@@ -182,179 +294,219 @@ class NetboxAPI(ApiConnector):
         logging.debug("++++++++++++++ add_device_type_list ++++++++++++++")
         logging.debug("Adding a list of %d device types", len(fwd_models))
         device_types = self.get_device_types()
-        if device_types is not None:
-            existing_device_types = device_types["results"]  # Device Types already in NetBox
-        create_device_types = []    # List of device types to be added in NetBox
-        for device_type in fwd_models:
-            for existing_device_type in existing_device_types:
-                if device_type["model"] == existing_device_type["model"]:
-                    device_type["id"] = existing_device_type["id"]
-        create_device_types = [device_type for device_type in fwd_models if "id" not in device_type.keys()]
+        existing_device_types = device_types["results"] if device_types is not None else []
+        result = reconcile(fwd_models, existing_device_types, fwd_key=lambda device_type: device_type["model"])
+        create_device_types = result.create    # List of device types to be added in NetBox
 
         # Create new Device Types
-        for device_type in create_device_types:
-            self.add_device_type(device_type)
-        return create_device_types
+        return self.post_device_types(create_device_types) if create_device_types else []
 
     def add_manufacturer(self, manufacturer):
         """Add a Manufacturer to netbox"""
-        logging.debug(f"Adding {manufacturer} Manufacturer to NetBox...")
-        self._post("/api/dcim/manufacturers/", manufacturer)
+        logging.debug("Adding %s Manufacturer to NetBox...", manufacturer)
+        return self._post("/api/dcim/manufacturers/", manufacturer)
+
+    def post_manufacturers(self, manufacturers: list) -> list:
+        """Add Manufacturers to netbox in chunks using NetBox bulk POST API"""
+        logging.debug("Bulk POSTing %d manufacturers", len(manufacturers))
+        return self._bulkpost("/api/dcim/manufacturers/", manufacturers)
 
     def add_manufacturer_list(self, fwd_vendors):
         """Add list of manufacturers to netbox:
         This function gets a list of forward vendors, it then
-        iterates over the existing manufacturer list present
-        in Netbox to find existing manufacturers, using sets
-        then it extract vendors not present. For the vendor
-        list of non-existing vendors it posts each vendor
-        individually.
+        reconciles them against the existing manufacturers present
+        in Netbox using the name as key. The list of
+        non-existing vendors is bulk posted, the created
+        manufacturers are returned with their NetBox id.
 
         Keyword arguments:
         fwd_vendors -- List of vendor to add into Netbox manufacturers.
         """
-        logging.debug(f"Adding a list of {len(fwd_vendors)} manufacturers")
+        logging.debug("Adding a list of %d manufacturers", len(fwd_vendors))
         manufacturers = self.get_manufacturers()
-        if manufacturers is not None:
-            existing_manufacturers = manufacturers[
-                "results"
-            ]  # Manufacturers already in NetBox
-        create_manufacturers = []    # List of devices to be added in NetBox
-        for manufacturer in fwd_vendors:
-            for existing_manufacturer in existing_manufacturers:
-                if manufacturer["name"] == existing_manufacturer["name"]:
-                    manufacturer["id"] = existing_manufacturer["id"]
-        create_manufacturers = [manufacturer for manufacturer in fwd_vendors if "id" not in manufacturer.keys()]
+        existing_manufacturers = manufacturers["results"] if manufacturers is not None else []
+        result = reconcile(fwd_vendors, existing_manufacturers, fwd_key=lambda manufacturer: manufacturer["name"])
+        create_manufacturers = result.create    # List of manufacturers to be added in NetBox
 
         # Create new Manufacturers
-        for manufacturer in create_manufacturers:
-            self.add_manufacturer(manufacturer)
-        return create_manufacturers
+        return self.post_manufacturers(create_manufacturers) if create_manufacturers else []
 
     def add_role(self, role):
         """Add a Device Role to netbox"""
-        logging.debug(f"Adding {role} Device Role to NetBox...")
-        self._post("/api/dcim/device-roles/", role)
+        logging.debug("Adding %s Device Role to NetBox...", role)
+        return self._post("/api/dcim/device-roles/", role)
+
+    def post_roles(self, roles: list) -> list:
+        """Add Device Roles to netbox in chunks using NetBox bulk POST API"""
+        logging.debug("Bulk POSTing %d device roles", len(roles))
+        return self._bulkpost("/api/dcim/device-roles/", roles)
 
     def add_role_list(self, fwd_device_types):
         """Add list of device roles to netbox:
         This function gets a list of forward device type, it then
-        iterates over the existing roles list present
-        in Netbox to find existing roles, using sets
-        then it extract roles not present. For the roles
-        list of non-existing roles it posts each role
-        individually.
+        reconciles them against the existing roles present
+        in Netbox using the name as key. The list of
+        non-existing roles is bulk posted, the created
+        roles are returned with their NetBox id.
 
         Keyword arguments:
         fwd_device_types -- List of device types to add into Netbox roles.
         """
-        logging.debug(f"Adding a list of {len(fwd_device_types)} device roles")
+        logging.debug("Adding a list of %d device roles", len(fwd_device_types))
         roles = self.get_roles()
-        if roles is not None:
-            existing_roles = roles["results"]  # Roles already in NetBox
-        create_roles = []    # List of roles to be added in NetBox
-        for role in fwd_device_types:
-            for existing_role in existing_roles:
-                if role["name"] == existing_role["name"]:
-                    role["id"] = existing_role["id"]
-        create_roles = [role for role in fwd_device_types if "id" not in role.keys()]
+        existing_roles = roles["results"] if roles is not None else []
+        result = reconcile(fwd_device_types, existing_roles, fwd_key=lambda role: role["name"])
+        create_roles = result.create    # List of roles to be added in NetBox
 
         # Create new roles
-        for role in create_roles:
-            self.add_role(role)
-        return create_roles
+        return self.post_roles(create_roles) if create_roles else []
 
     def add_device(self, device):
         """Add a Device to netbox"""
-        logging.debug(f"Adding Device {device} to NetBox...")
-        self._post("/api/dcim/devices/", device)
+        logging.debug("Adding Device %s to NetBox...", device)
+        return self._post("/api/dcim/devices/", device)
+
+    def post_devices(self, devices: list) -> list:
+        """Add devices in chunks using NetBox bulk POST API"""
+        logging.debug("Bulk POSTing %d devices", len(devices))
+        return self._bulkpost("/api/dcim/devices/", devices)
 
     def patch_devices(self, devices: list):
         """Patch existing devices"""
         logging.debug("Patching devices in Netbox...")
-        self._patch("/api/dcim/devices/", devices)
+        return self._bulkpatch("/api/dcim/devices/", devices)
 
     def add_device_list(self, fwd_devices):
         """Add list of devices:
         This function gets a list of devices, it then
-        iterates over the existing device list present
-        in Netbox to find existing devices, using sets
-        then it extract devices not present. For the
+        reconciles them against the existing devices present
+        in Netbox using the device name as key. For the
         devices present it adds the id of the device
-        and patches the list as a whole. For the device
-        list of non-existing devices it posts each device
-        individually.
+        and patches the changed fields only. The list of
+        non-existing devices is bulk posted, the created
+        devices are returned with their NetBox id.
 
         Keyword arguments:
         fwd_devices -- List of devices to add into Netbox.
         """
-        logging.debug(f"Adding a list of {len(fwd_devices)} devices")
+        logging.debug("Adding a list of %d devices", len(fwd_devices))
         existing_devices = self.get_devices()["results"]  # Devices already in NetBox
-        update_devices = []    # List of devices to be updated in NetBox
-        create_devices = []    # List of devices to be added in NetBox
-        for device in fwd_devices:
-            for existing_device in existing_devices:
-                if device["name"] == existing_device["name"]:
-                    device["id"] = existing_device["id"]
-                    update_devices.append(device)
-        create_devices = [device for device in fwd_devices if "id" not in device.keys()]
+        result = reconcile(fwd_devices, existing_devices, fwd_key=lambda device: device["name"], diff=diff_fields)
+        update_devices = result.update    # List of devices to be updated in NetBox
+        create_devices = result.create    # List of devices to be added in NetBox
+        self._track_orphans("/api/dcim/devices/", result.orphans, len(existing_devices))
 
         # Update existing devices
-        self.patch_devices(update_devices)
+        logging.info("%d devices changed, %d unchanged", len(update_devices), len(result.unchanged))
+        if result.patches:
+            self.patch_devices(result.patches)
 
         # Create new Devices
-        for device in create_devices:
-            self.add_device(device)
+        created_devices = self.post_devices(create_devices) if create_devices else []
+        self.forward_device_ids.update(device["id"] for device in update_devices + result.unchanged + created_devices)
 
-        return create_devices, update_devices
+        return created_devices, update_devices
 
     def add_interface(self, interface):
         """Add an Interface to netbox"""
-        logging.debug(f"Adding {interface} Interface to NetBox...")
-        self._post("/api/dcim/interfaces/", interface)
+        logging.debug("Adding %s Interface to NetBox...", interface)
+        return self._post("/api/dcim/interfaces/", interface)
 
     def patch_interfaces(self, interfaces):
         """PATCH interfaces in chunks using NetBox bulk PATCH API"""
-        logging.debug(f"Bulk PATCHing {len(interfaces)} interfaces")
-        self._bulkpatch("/api/dcim/interfaces/", interfaces)
+        logging.debug("Bulk PATCHing %d interfaces", len(interfaces))
+        return self._bulkpatch("/api/dcim/interfaces/", interfaces)
 
     def add_interface_list(self, interfaces):
         """Adds a list of interfaces using chunked POST and PATCH"""
-        logging.debug(f"Adding a list of {len(interfaces)} interfaces")
+        logging.debug("Adding a list of %d interfaces", len(interfaces))
         existing_interfaces = self.get_interfaces()["results"]
-        update_interfaces = []
-        create_interfaces = []
-
-        for interface in interfaces:
-            for existing in existing_interfaces:
-                if (
-                    interface["name"] == existing["name"]
-                    and interface["device"] == existing["device"]["id"]
-                ):
-                    interface["id"] = existing["id"]
-                    update_interfaces.append(interface)
-                    break
-
-        create_interfaces = [i for i in interfaces if "id" not in i]
+        result = reconcile(interfaces, existing_interfaces,
+                           fwd_key=lambda interface: (interface["device"], interface["name"]),
+                           existing_key=lambda existing: (ref_id(existing["device"]), existing["name"]),
+                           diff=diff_fields)
+        self._track_device_orphans("/api/dcim/interfaces/", result.orphans, interfaces, len(existing_interfaces))
+        update_interfaces = result.update
+        create_interfaces = result.create
+        logging.info("%d interfaces unchanged", len(result.unchanged))
 
         if update_interfaces:
-            logging.info(f"Bulk PATCHing {len(update_interfaces)} interfaces...")
-            self.patch_interfaces(update_interfaces)
+            logging.info("Bulk PATCHing %d interfaces...", len(update_interfaces))
+            self.patch_interfaces(result.patches)
 
+        created_interfaces = []
         if create_interfaces:
-            logging.info(f"Bulk POSTing {len(create_interfaces)} interfaces...")
-            self._bulkpost("/api/dcim/interfaces/", create_interfaces)
-
-        return create_interfaces, update_interfaces
+            logging.info("Bulk POSTing %d interfaces...", len(create_interfaces))
+            created_interfaces = self._bulkpost("/api/dcim/interfaces/", create_interfaces)
+
+        return created_interfaces, update_interfaces
+
+    def add_interface_stream(self, pages) -> dict:
+        """Reconcile pages of adapted interfaces as they arrive and write them in bulk chunks:
+        The existing interfaces are indexed once, reduced to the fields
+        Forward provides, then every page is diffed against the index.
+        Creates and PATCHes are buffered and flushed every post_limit
+        records so the writes overlap with the Forward page fetches.
+        Returns the number of created, updated and unchanged interfaces.
+        """
+        summary = {"created": 0, "updated": 0, "unchanged": 0}
+        pages = iter(pages)
+        first_page = next((page for page in pages if page), None)
+        if first_page is None:
+            logging.info("No interfaces to sync")
+            return summary
+
+        # VDC interfaces carry a vdcs list, any interface of a later page may have one
+        fields = sorted({"id", "vdcs"}.union(*first_page))
+        path = "/api/dcim/interfaces/"
+        if self.lookup_mode == "fields":
+            path = f"{path}?fields={','.join(fields)}"
+        index = {}
+        if self._use_inventory():
+            existing_pages = self._iter_inventory("/api/dcim/interfaces/")
+        else:
+            existing_pages = self._iter_paginated(path)
+        for results in existing_pages:
+            for existing in results:
+                index[(ref_id(existing["device"]), existing["name"])] = InterfaceRecord.from_row(
+                    reduce_object(existing, fields))
+        logging.info("Indexed %d existing interfaces", len(index))
+
+        reconciler = Reconciler(index, fwd_key=lambda interface: (interface["device"], interface["name"]),
+                                diff=diff_fields)
+        creates, patches = [], []
+
+        def flush(final=False):
+            if len(creates) >= self.post_limit or (final and creates):
+                created = self._bulkpost("/api/dcim/interfaces/", creates)
+                summary["created"] += len(created)
+                logging.info("Bulk POSTed %d of %d interfaces", len(created), len(creates))
+                creates.clear()
+            if len(patches) >= self.post_limit or (final and patches):
+                self.patch_interfaces(patches)
+                summary["updated"] += len(patches)
+                logging.info("Bulk PATCHed %d interfaces", len(patches))
+                patches.clear()
+
+        for page in chain([first_page], pages):
+            result = reconciler.reconcile(page)
+            creates.extend(result.create)
+            patches.extend(result.patches)
+            summary["unchanged"] += len(result.unchanged)
+            flush()
+        flush(final=True)
+        self._track_device_orphans("/api/dcim/interfaces/", reconciler.orphans(),
+                                   [{"device": key[0]} for key in reconciler.seen], len(index))
+        return summary
 
     def add_virtual_device_context(self, vdc):
         """Add a Virtual Device Context to NetBox"""
-        logging.debug(f"Adding Virtual Device Context {vdc} to NetBox...")
-        self._post("/api/dcim/virtual-device-contexts/", vdc)
+        logging.debug("Adding Virtual Device Context %s to NetBox...", vdc)
+        return self._post("/api/dcim/virtual-device-contexts/", vdc)
 
     def patch_virtual_device_contexts(self, vdcs: list):
-            logging.debug("Patching Virtual Device Contexts in NetBox...")
-            self._patch("/api/dcim/virtual-device-contexts/", vdcs)
+        logging.debug("Patching Virtual Device Contexts in NetBox...")
+        return self._bulkpatch("/api/dcim/virtual-device-contexts/", vdcs)
 
     def add_virtual_device_context_list(self, vdcs):
         """Adds a list of virtual device contexts, patches if already exists
@@ -362,64 +514,466 @@ class NetboxAPI(ApiConnector):
         Keyword arguments:
         vdcs -- List of virtual device contexts to add into NetBox.
         """
-        logging.debug(f"Adding a list of {len(vdcs)} virtual device contexts")
+        logging.debug("Adding a list of %d virtual device contexts", len(vdcs))
         existing_vdcs = self.get_virtual_device_contexts()["results"]
-        update_vdcs = []
-        create_vdcs = []
-
-        for vdc in vdcs:
-            for existing_vdc in existing_vdcs:
-                if (
-                    vdc["name"] == existing_vdc["name"]
-                    and vdc["device"] == existing_vdc["device"]["id"]
-                ):
-                    vdc["id"] = existing_vdc["id"]
-                    update_vdcs.append(vdc)
-                    break  # Avoid duplicate updates
-
-        create_vdcs = [vdc for vdc in vdcs if "id" not in vdc.keys()]
-
-        self.patch_virtual_device_contexts(update_vdcs)
-
+        result = reconcile(vdcs, existing_vdcs,
+                           fwd_key=lambda vdc: (vdc["device"], vdc["name"]),
+                           existing_key=lambda existing: (ref_id(existing["device"]), existing["name"]),
+                           diff=diff_fields)
+        self._track_device_orphans("/api/dcim/virtual-device-contexts/", result.orphans, vdcs, len(existing_vdcs))
+        update_vdcs = result.update
+        create_vdcs = result.create
+
+        logging.info("%d VDCs changed, %d unchanged", len(update_vdcs), len(result.unchanged))
+        if result.patches:
+            self.patch_virtual_device_contexts(result.patches)
+
+        created_vdcs = []
         if create_vdcs:
-            logging.info(f"Bulk POSTing {len(create_vdcs)} new VDCs to NetBox...")
-            self._bulkpost("/api/dcim/virtual-device-contexts/", create_vdcs)
+            logging.info("Bulk POSTing %d new VDCs to NetBox...", len(create_vdcs))
+            created_vdcs = self._bulkpost("/api/dcim/virtual-device-contexts/", create_vdcs)
 
-        return create_vdcs, update_vdcs
+        return created_vdcs, update_vdcs
 
     def add_virtual_chassis(self, vc):
-        logging.debug(f"Adding Virtual Chassis {vc} to NetBox...")
-        self._post("/api/dcim/virtual-chassis/", vc)
+        logging.debug("Adding Virtual Chassis %s to NetBox...", vc)
+        return self._post("/api/dcim/virtual-chassis/", vc)
+
+    def post_virtual_chassis(self, vcs: list) -> list:
+        logging.debug("Bulk POSTing %d virtual chassis", len(vcs))
+        return self._bulkpost("/api/dcim/virtual-chassis/", vcs)
 
     def patch_virtual_chassis(self, vcs: list):
         logging.debug("Patching Virtual Chassis in NetBox...")
-        self._patch("/api/dcim/virtual-chassis/", vcs)
+        return self._bulkpatch("/api/dcim/virtual-chassis/", vcs)
 
     def add_virtual_chassis_list(self, chassis_list):
-        logging.debug(f"Adding a list of {len(chassis_list)} virtual chassis")
+        logging.debug("Adding a list of %d virtual chassis", len(chassis_list))
         existing_chassis = self.get_virtual_chassis()["results"]
-        update_chassis = []
-        create_chassis = []
+        result = reconcile(chassis_list, existing_chassis, fwd_key=lambda chassis: chassis["name"], diff=diff_fields)
+        self._track_orphans("/api/dcim/virtual-chassis/", result.orphans, len(existing_chassis))
+        update_chassis = result.update
+        create_chassis = result.create
 
-        for chassis in chassis_list:
-            for existing in existing_chassis:
-                if chassis["name"] == existing["name"]:
-                    chassis["id"] = existing["id"]
-                    update_chassis.append(chassis)
-                    break
+        logging.info("%d virtual chassis changed, %d unchanged", len(update_chassis), len(result.unchanged))
+        if result.patches:
+            self.patch_virtual_chassis(result.patches)
 
-        create_chassis = [ch for ch in chassis_list if "id" not in ch]
+        created_chassis = self.post_virtual_chassis(create_chassis) if create_chassis else []
 
-        self.patch_virtual_chassis(update_chassis)
+        return created_chassis, update_chassis
 
-        for chassis in create_chassis:
-            self.add_virtual_chassis(chassis)
+    def _track_orphans(self, path: str, orphans: list, existing_count: int):
+        """Keep the NetBox objects of an endpoint that Forward no longer reports, for delete_orphans()"""
+        if self.allow_deletes:
+            self.orphans[path] = (orphans, existing_count)
 
-        return create_chassis, update_chassis
+    def _track_device_orphans(self, path: str, orphans: list, fwd_records: list, existing_count: int):
+        """Keep the orphans of the devices synced from Forward only:
+        The objects of the other devices are either deleted with their
+        device or belong to a device Forward does not manage.
+        """
+        devices = self.forward_device_ids or {record["device"] for record in fwd_records}
+        self._track_orphans(path, [orphan for orphan in orphans if ref_id(orphan["device"]) in devices],
+                            existing_count)
+
+    def delete_orphans(self) -> dict:
+        """Bulk DELETE the NetBox objects missing from Forward, in dependency order:
+        Nothing is deleted when the orphans of an endpoint exceed both
+        min_delete_cap and max_delete_fraction of its objects, which
+        usually means the Forward data is incomplete. Sites still referenced by devices
+        that are kept are not deleted. Returns the number of deleted
+        objects per endpoint.
+        """
+        for path, (orphans, existing_count) in self.orphans.items():
+            if len(orphans) > max(self.max_delete_fraction * existing_count, self.min_delete_cap):
+                raise RuntimeError(f"Refusing to delete {len(orphans)} of the {existing_count} objects of {path}, "
+                                   f"more than max_delete_fraction ({self.max_delete_fraction:.0%})")
+
+        deleted = {}
+        deleted_devices = {device["id"] for device in self.orphans.get("/api/dcim/devices/", ([], 0))[0]}
+        if "/api/dcim/sites/" in self.orphans:
+            devices = self._get_collection("/api/dcim/devices/")  # Cached by the devices stage
+            used_sites = {ref_id(device["site"]) for device in (devices or {}).get("results", [])
+                          if device["id"] not in deleted_devices}
+            orphans, existing_count = self.orphans["/api/dcim/sites/"]
+            self.orphans["/api/dcim/sites/"] = ([site for site in orphans if site["id"] not in used_sites],
+                                                existing_count)
+
+        for path, kind in DELETE_ORDER:
+            orphans = self.orphans.get(path, ([], 0))[0]
+            if not orphans:
+                continue
+            log_objects(logging, "Deleting", kind, orphans)
+            deleted[path] = len(self._bulkdelete(path, [{"id": orphan["id"]} for orphan in orphans]))
+            logging.info("Deleted %d of %d orphan %s objects", deleted[path], len(orphans), kind)
+        return deleted
+
+    def apply_plan(self, plan: Plan) -> dict:
+        """Apply the writes of a plan recorded by a dry run:
+        Endpoints are created and updated in the order the dry run first
+        wrote to them, which follows the stage dependencies, and deleted
+        in DELETE_ORDER, children first. The placeholder ids of the planned objects
+        are replaced by the ids NetBox assigns as they are created.
+        Returns the number of objects written per endpoint and action.
+        """
+        ids = {}  # placeholder id -> NetBox id
+        applied = {}
+        for path, entity in plan.changes.items():
+            applied[path] = {"create": 0, "update": 0, "delete": 0}
+            if entity.get("create"):
+                placeholders = [record["id"] for record in entity["create"]]
+                payloads = [resolve_placeholders({key: value for key, value in record.items() if key != "id"}, ids)
+                            for record in entity["create"]]
+                failures = len(self.bulk_failures)
+                created = self._bulkpost(path, payloads)
+                failed = {id(failure["record"]) for failure in self.bulk_failures[failures:]}
+                written = [placeholder for placeholder, payload in zip(placeholders, payloads) if id(payload) not in failed]
+                ids.update((placeholder, obj["id"]) for placeholder, obj in zip(written, created))
+                applied[path]["create"] = len(created)
+            if entity.get("update"):
+                patches = [resolve_placeholders(record, ids) for record in entity["update"]]
+                applied[path]["update"] = len(self._bulkpatch(path, patches))
+        delete_paths = [path for path, _ in DELETE_ORDER if path in plan.changes]
+        delete_paths += [path for path in plan.changes if path not in delete_paths]
+        for path in delete_paths:
+            if plan.changes[path].get("delete"):
+                applied[path]["delete"] = len(self._bulkdelete(path, plan.changes[path]["delete"]))
+        for path, counts in applied.items():
+            logging.info("%s: %d created, %d updated, %d deleted", path, counts["create"], counts["update"],
+                         counts["delete"])
+        return applied
+
+    def _cached(self, key, loader):
+        """Return a value cached for this run, calling loader at most once while it stays cached"""
+        with self._cache_lock:
+            if key in self._cache:
+                return self._cache[key]
+            key_lock = self._cache_key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._cache_lock:
+                if key in self._cache:
+                    return self._cache[key]
+            value = loader()
+            if value is not None:  # Empty collections and maps are results too, failed fetches are not
+                with self._cache_lock:
+                    self._cache[key] = value
+            return value
+
+    def invalidate(self, path: str):
+        """Drop the cached collection, lookup and maps of a NetBox endpoint"""
+        with self._cache_lock:
+            for key in [key for key in self._cache if key[0] == path]:
+                del self._cache[key]
+
+    def clear_cache(self):
+        """Drop every cached collection, lookup and map"""
+        with self._cache_lock:
+            self._cache.clear()
+
+    def export_cache(self, paths: list) -> dict:
+        """Return the cached collections and lookups of the given endpoints, for seed_cache()"""
+        with self._cache_lock:
+            return {key: value for key, value in self._cache.items()
+                    if key[0] in paths and key[1] in ("full", "lookup")}
+
+    def seed_cache(self, entries: dict):
+        """Cache collections and lookups fetched by another connector, like another process of the run"""
+        with self._cache_lock:
+            self._cache.update(entries)
+
+    def _on_write(self, method: str, path: str, data):
+        """Keep the cached data of an endpoint in line with the writes sent to it"""
+        path = path.split("?")[0]
+        if method in ("POST", "PATCH", "PUT") and data is not None:
+            self._update_cache(path, method, data if isinstance(data, list) else [data])
+        else:
+            self.invalidate(path)
+
+    def _update_cache(self, path: str, method: str, objects: list):
+        """Merge the objects returned by a write into the cached collections of an endpoint:
+        created objects are appended, updated objects replace the
+        cached ones, in the "scope:" collections of a scoped run too
+        as its writes stay in scope. Maps built from the endpoint are
+        dropped and rebuilt from the cached collections on their next
+        use.
+        """
+        with self._cache_lock:
+            variants = [key[1] for key in self._cache
+                        if key[0] == path and (key[1] in ("full", "lookup") or key[1].startswith("scope:"))]
+            for key in [key for key in self._cache
+                        if key[0] == path and key[1] not in variants and not key[1].startswith("index:")]:
+                del self._cache[key]
+            for variant in variants:
+                collection = self._cache[(path, variant)]
+                results = collection["results"]
+                positions = self._cache.get((path, f"index:{variant}"))  # id -> position, built on the first PATCH
+                if method == "POST":
+                    if positions is not None:
+                        positions.update((obj.get("id"), len(results) + i) for i, obj in enumerate(objects))
+                    results.extend(objects)
+                else:
+                    if positions is None:
+                        positions = {obj["id"]: i for i, obj in enumerate(results)}
+                        self._cache[(path, f"index:{variant}")] = positions
+                    for obj in objects:
+                        if obj.get("id") in positions:
+                            results[positions[obj["id"]]] = obj
+                        else:
+                            positions[obj["id"]] = len(results)
+                            results.append(obj)
+                collection["count"] = len(results)
+
+    def save_maps(self):
+        """Write the lookup maps built from NetBox during this run to maps_cache, for load_maps() on later runs:
+        Each map keeps the time it was built, maps seeded by load_maps
+        keep their original time so they still expire. Maps this run
+        did not use are neither fetched nor dropped from the file.
+        """
+        if not self.maps_cache:
+            return
+        with self._cache_lock:
+            current = {name: self._cache.get((getattr(type(self), name).path, name)) for name in SAVED_MAPS}
+        saved = self._read_maps()
+        built = 0
+        for name, value in current.items():
+            if value is None:
+                continue
+            loaded = self._loaded_maps.get(name)
+            if loaded is not None and loaded[0] is value:
+                continue  # Still the map read from the file, with its original time
+            saved["maps"][name] = value
+            saved["saved"][name] = time.time()
+            built += 1
+        if not built:
+            return
+        temporary = f"{self.maps_cache}.tmp"
+        with open(temporary, "w", encoding="UTF-8") as f:
+            json.dump(saved, f)
+        os.replace(temporary, self.maps_cache)
+        logging.debug("Saved %d NetBox lookup maps to %s", built, self.maps_cache)
+
+    def load_maps(self) -> int:
+        """Cache the lookup maps saved by earlier runs, except those older than maps_max_age:
+        The stages then resolve sites, device types, roles, devices and
+        VDCs without fetching their endpoints. A map is rebuilt from
+        NetBox as usual once its endpoint is written to. Returns the
+        number of maps loaded.
+        """
+        saved = self._read_maps()
+        now = time.time()
+        fresh = {name: value for name, value in saved["maps"].items()
+                 if name in SAVED_MAPS and now - saved["saved"].get(name, 0) <= self.maps_max_age}
+        with self._cache_lock:
+            for name, value in fresh.items():
+                self._cache[(getattr(type(self), name).path, name)] = value
+                self._loaded_maps[name] = (value, saved["saved"][name])
+        if len(fresh) < len(saved["maps"]):
+            logging.info("%d lookup maps in %s are stale, fetching them from NetBox",
+                         len(saved["maps"]) - len(fresh), self.maps_cache)
+        if fresh:
+            oldest = min(saved["saved"][name] for name in fresh)
+            logging.info("Using %d lookup maps from %s, the oldest saved %d minutes ago",
+                         len(fresh), self.maps_cache, (now - oldest) // 60)
+        return len(fresh)
+
+    def _read_maps(self) -> dict:
+        """Return the maps saved in maps_cache for this NetBox host, with the time each one was built"""
+        empty = {"netbox": self.host, "saved": {}, "maps": {}}
+        if not self.maps_cache or not os.path.exists(self.maps_cache):
+            return empty
+        try:
+            with open(self.maps_cache, "r", encoding="UTF-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring unreadable lookup maps %s: %s", self.maps_cache, e)
+            return empty
+        if saved.get("netbox") != self.host or not isinstance(saved.get("saved"), dict):
+            return empty
+        return saved
+
+    def set_scope(self, sites: list, devices: list):
+        """Restrict the existing interfaces read from NetBox to the devices of some sites and to some devices:
+        Only the interfaces of those devices are then fetched and
+        reconciled, the orphans of a scoped run are incomplete and
+        must not be deleted.
+        """
+        self.scope = ({site.lower() for site in sites}, {device.lower() for device in devices})
+        self.invalidate("/api/dcim/interfaces/")
+
+    def scope_device_names(self) -> set:
+        """Return the lowercase names of the NetBox devices in scope and of their VDCs"""
+        devices = self._get_scoped_devices()
+        vdcs = self._get_virtual_device_context_map_helper()
+        return ({name.lower() for name in devices.values()} |
+                {name.lower() for name, (parent_id, _) in vdcs.items() if parent_id in devices})
+
+    def _get_scoped_devices(self) -> dict:
+        """Return the ids and names of the NetBox devices at the scoped sites or with a scoped name,
+        kept until devices are written.
+        """
+        return self._cached(("/api/dcim/devices/", "scope"), self._fetch_scoped_devices)
+
+    def _fetch_scoped_devices(self) -> dict:
+        sites, names = self.scope
+        site_ids = {name.lower(): site_id for name, site_id in self._get_site_map_helper().items()}
+        devices = {}
+        for site in sites:
+            if site not in site_ids:
+                logging.warning("Site %s not in NetBox", site)
+                continue
+            response = self._get_paginated(f"/api/dcim/devices/?site_id={site_ids[site]}&brief=true")
+            if response is not None:
+                devices.update({device["id"]: device["name"] for device in response["results"]})
+        for name, device_id in self._get_interface_map_helper().items():
+            if name.lower() in names:
+                devices[device_id] = name
+        return devices
+
+    def _get_scoped_interfaces(self):
+        """Get the interfaces of the scoped devices, request_limit devices per query"""
+        device_ids = sorted(self._get_scoped_devices())
+        results = []
+        for start in range(0, len(device_ids), self.request_limit):
+            query = "&".join(f"device_id={device_id}" for device_id in device_ids[start:start + self.request_limit])
+            response = self._get_paginated(f"/api/dcim/interfaces/?{query}")
+            if response is None:
+                return None
+            results.extend(response["results"])
+        logging.info("%d NetBox interfaces on %d scoped devices", len(results), len(device_ids))
+        return {"count": len(results), "next": None, "previous": None, "results": results}
+
+    def _get_collection(self, path: str):
+        """Get every object of a NetBox endpoint, downloaded once per run"""
+        if self._use_inventory():
+            return self._cached((path, "full"), lambda: self._refresh_inventory(path))
+        return self._cached((path, "full"), lambda: self._get_paginated(path))
+
+    def _get_lookup(self, path: str, fields: list):
+        """Get the objects of a NetBox endpoint for a lookup map, from the full collection when cached"""
+        with self._cache_lock:
+            collection = self._cache.get((path, "full"))
+        if collection is not None:
+            return collection
+        if self._use_inventory():
+            return self._get_collection(path)
+        return self._cached((path, "lookup"), lambda: self._fetch_lookup(path, fields))
+
+    def _use_inventory(self) -> bool:
+        """Whether collections are served from the inventory cache: not when
+        responses are recorded or replayed, those need the full collections.
+        """
+        return self.inventory is not None and self.recording is None and self.replay is None
+
+    def _iter_inventory(self, path: str):
+        """Yield the objects of an endpoint page by page from the refreshed inventory cache:
+        Unlike _get_collection, the collection is never loaded as a
+        whole, a cold cache is filled page by page as NetBox is read.
+        """
+        with self._cache_lock:
+            collection = self._cache.get((path, "full"))
+        if collection is not None:
+            yield collection["results"]
+            return
+        if self._refresh_inventory(path, load=False) is not None:
+            yield from self.inventory.iter_pages(path)
+
+    def _refresh_inventory(self, path: str, load=True):
+        """Get every object of a NetBox endpoint from the inventory cache, refreshed first:
+        Objects updated since the newest cached last_updated, minus
+        inventory_overlap seconds, are fetched and stored. If the
+        NetBox count then differs from the cached count, the ids of
+        the endpoint are fetched to drop the deleted objects. Ids the
+        cache never saw mean it missed changes, the endpoint is then
+        downloaded again in full, like on the first run. With load
+        False, the objects are only stored and True is returned.
+        """
+        watermark = self.inventory.watermark(path, self.inventory_overlap)
+        if watermark is not None and self.inventory.is_cached(path):
+            changed = self._get_paginated(f"{path}?last_updated__gte={quote(watermark)}")
+            if changed is None:
+                return None
+            if len(changed["results"]) != changed["count"]:
+                logging.warning("Incomplete refresh of the inventory cache of %s, downloading it again", path)
+                return self._replace_inventory(path, load)
+            self.inventory.upsert(path, changed["results"])
+            count = self._get(f"{path}?limit=1&brief=true")
+            if count is None:
+                return None
+            deleted = 0
+            if count["count"] != self.inventory.count(path):
+                ids = self._fetch_lookup(path, ["id"])
+                if ids is None:
+                    return None
+                netbox_ids = {obj["id"] for obj in ids["results"]}
+                cached_ids = self.inventory.ids(path)
+                if netbox_ids - cached_ids:
+                    logging.info("Inventory cache of %s is missing objects, downloading it again", path)
+                    watermark = None
+                else:
+                    self.inventory.delete(path, cached_ids - netbox_ids)
+                    deleted = len(cached_ids - netbox_ids)
+            if watermark is not None:
+                logging.info("Inventory cache of %s: %d objects, %d changed and %d deleted since the last run",
+                             path, self.inventory.count(path), len(changed["results"]), deleted)
+                if not load:
+                    return True
+                results = self.inventory.load(path)
+                return {"count": len(results), "next": None, "previous": None, "results": results}
+
+        return self._replace_inventory(path, load)
+
+    def _replace_inventory(self, path: str, load=True):
+        """Download every object of a NetBox endpoint and store it in the inventory cache when complete:
+        With load False, the pages are stored as they arrive instead
+        of being kept in memory, and True is returned.
+        """
+        if load:
+            response = self._get_paginated(path)
+            if response is not None and len(response["results"]) == response["count"]:
+                self.inventory.replace(path, response["results"])
+            return response
+
+        self.inventory.forget(path)
+        stored = 0
+        for results in self._iter_paginated(path):
+            self.inventory.upsert(path, results, mark=False)
+            stored += len(results)
+        count = self._get(f"{path}?limit=1&brief=true")
+        if count is not None and count["count"] == stored:
+            self.inventory.mark_cached(path)
+        return True
+
+    def _fetch_lookup(self, path: str, fields: list):
+        """Get a NetBox collection with only the fields needed to build a lookup map:
+        NetBox 4.0+ honors the fields query parameter, older releases
+        ignore it and return full objects, in that case the brief
+        representation is used from then on. Endpoints whose brief
+        representation lacks one of the fields are fetched in full.
+        """
+        if self.lookup_mode == "fields":
+            response = self._get_paginated(f"{path}?fields={','.join(fields)}")
+            if response is None or not response["results"]:
+                return response
+            if set(response["results"][0]) <= set(fields):
+                return response
+            logging.info("NetBox ignores the fields query parameter, using brief lookups")
+            self.lookup_mode = "brief"
+            if all(field in response["results"][0] for field in fields):
+                return response
+
+        response = self._get_paginated(f"{path}?brief=true")
+        if response is None or not response["results"]:
+            return response
+        if all(field in response["results"][0] for field in fields):
+            return response
+        logging.debug("Brief %s objects lack %s, fetching full objects", path, fields)
+        return self._get_paginated(path)
 
+    @cached_map("/api/dcim/sites/")
     def _get_site_map_helper(self) -> dict:
         """Helper method that returns a dictionary of Sites and the id"""
-        results = self.get_sites()
+        results = self._get_lookup("/api/dcim/sites/", ["id", "name"])
         sites = {}
         if results is None:
             logging.warning("No sites where found.")
@@ -428,9 +982,10 @@ class NetboxAPI(ApiConnector):
             sites[result["name"]] = result["id"]
         return sites
 
+    @cached_map("/api/dcim/manufacturers/")
     def _get_manufacturer_map_helper(self) -> dict:
         """Helper method that returns a dictionary of Manufacturers and the id"""
-        results = self.get_manufacturers()
+        results = self._get_lookup("/api/dcim/manufacturers/", ["id", "name"])
         manufacturers = {}
         if results is None:
             logging.warning("No manufacturers where found in NetBox.")
@@ -438,12 +993,13 @@ class NetboxAPI(ApiConnector):
         for result in results["results"]:
             # Convert the names of NetBox roles to lowercase to enable case-insensitive lookup
             manufacturers[result["name"].lower()] = result["id"]
-        logging.debug(f"NetBox Manufacturers List: {manufacturers}")
+        logging.debug("NetBox Manufacturers List: %s", LazyDump(manufacturers))
         return manufacturers
 
+    @cached_map("/api/dcim/device-roles/")
     def _get_role_map_helper(self) -> dict:
         """Helper method that returns a dictionary of Roles and the id"""
-        results = self.get_roles()
+        results = self._get_lookup("/api/dcim/device-roles/", ["id", "name"])
         roles = {}
         if results is None:
             logging.warning("No roles where found.")
@@ -453,9 +1009,10 @@ class NetboxAPI(ApiConnector):
             roles[result["name"].lower()] = result["id"]
         return roles
 
+    @cached_map("/api/dcim/device-types/")
     def _get_device_type_map_helper(self) -> dict:
         """Helper method that returns a dictionary of device types and the id"""
-        results = self.get_device_types()
+        results = self._get_lookup("/api/dcim/device-types/", ["id", "display"])
         device_types = {}
         if results is None:
             logging.warning("No device types where found in NetBox.")
@@ -463,12 +1020,13 @@ class NetboxAPI(ApiConnector):
         for result in results["results"]:
             # Convert the names of NetBox roles to lowercase to enable case-insensitive lookup
             device_types[result["display"].lower()] = result["id"]
-        logging.debug(f"====== NetBox Device Types List: {device_types}")
+        logging.debug("====== NetBox Device Types List: %s", LazyDump(device_types))
         return device_types
 
+    @cached_map("/api/dcim/virtual-device-contexts/")
     def _get_virtual_device_context_map_helper(self) -> dict:
         """Helper method to map VDC name to (parent device ID, VDC ID)"""
-        results = self.get_virtual_device_contexts()
+        results = self._get_lookup("/api/dcim/virtual-device-contexts/", ["id", "name", "device"])
         vdc_map = {}
 
         if results is None:
@@ -481,12 +1039,13 @@ class NetboxAPI(ApiConnector):
             parent_device_id = vdc["device"]["id"] if isinstance(vdc["device"], dict) else vdc["device"]
             vdc_map[name] = (parent_device_id, vdc_id)
 
-        logging.debug(f"[VDC Map Helper] Resolved VDC map: {vdc_map}")
+        logging.debug("[VDC Map Helper] Resolved VDC map: %s", LazyDump(vdc_map))
         return vdc_map
 
+    @cached_map("/api/dcim/devices/")
     def _get_interface_map_helper(self) -> dict:
         """Helper method that returns a dictionary of Devices and the id"""
-        results = self.get_devices()
+        results = self._get_lookup("/api/dcim/devices/", ["id", "name"])
         devices = {}
         if results is None:
             logging.warning("No devices where found.")
@@ -505,7 +1064,7 @@ class NetboxAPI(ApiConnector):
     def adapt_forward_model_query(self, query):
         """Helper method to convert a device models forward query into a Netbox device types Query"""
         manufacturers = self._get_manufacturer_map_helper()
-        logging.debug(f"NetBox Manufacturers: {manufacturers}")
+        logging.debug("NetBox Manufacturers: %s", LazyDump(manufacturers))
         for entry in query:
             # slug transformation
             if entry["slug"] is None:
@@ -538,21 +1097,21 @@ class NetboxAPI(ApiConnector):
 
     def adapt_forward_device_query(self, query):
         """Helper method to convert a device forward query into a Netbox Query"""
-        logging.debug(f"====> adapt_forward_device_query {query}")
+        logging.debug("====> adapt_forward_device_query %s", LazyDump(query))
 
         # Convert the names of Forward and NetBox to lowercase to enable case-insensitive lookup
         sites = self._get_site_map_helper()
         sites = {key.lower(): value for key, value in sites.items()}
-        logging.debug(f"==> NetBox sites {sites}")
+        logging.debug("==> NetBox sites %s", LazyDump(sites))
 
         devices = self._get_device_type_map_helper()
-        logging.debug(f"==> NetBox devices types {devices}")
+        logging.debug("==> NetBox devices types %s", LazyDump(devices))
 
         roles = self._get_role_map_helper()
-        logging.debug(f"==> NetBox roles {roles}")
+        logging.debug("==> NetBox roles %s", LazyDump(roles))
 
         for entry in query:
-            logging.debug(f"==> Device entry {entry}")
+            logging.debug("==> Device entry %s", entry)
 
             # Device type transformation
             if entry["device_type"] is None:
@@ -577,17 +1136,37 @@ class NetboxAPI(ApiConnector):
         return query
 
     def adapt_forward_virtual_device_context_query(self, query):
-         """Helper method to convert a Forward VDC query into a NetBox-compatible format"""
-         devices = self._get_interface_map_helper()
-         for entry in query:
-             if entry["device"] in devices:
-                 entry["device"] = devices[entry["device"]]
-             else:
-                 logging.warning(f"Device {entry['device']} not found in NetBox. Skipping ID resolution.")
-         return query
+        """Helper method to convert a Forward VDC query into a NetBox-compatible format"""
+        devices = self._get_interface_map_helper()
+        missing = Counter()
+        for entry in query:
+            if entry["device"] in devices:
+                entry["device"] = devices[entry["device"]]
+            else:
+                missing[entry["device"]] += 1
+        log_unresolved(missing, "VDCs", "kept without a device id")
+        return query
 
     def adapt_forward_interface_query(self, query):
         """Helper method to convert an interface forward query into a NetBox-compatible format"""
+        missing = Counter()
+        adapt = self._interface_adapter(missing)
+        adapted = [entry for entry in map(adapt, query) if entry is not None]
+        log_unresolved(missing, "interfaces", "skipped")
+        return adapted
+
+    def adapt_forward_interface_stream(self, pages):
+        """Adapt pages of an interface forward query as they are yielded"""
+        missing = Counter()
+        adapt = self._interface_adapter(missing)
+        for page in pages:
+            yield [entry for entry in map(adapt, page) if entry is not None]
+        log_unresolved(missing, "interfaces", "skipped")
+
+    def _interface_adapter(self, missing: Counter):
+        """Return a function converting one Forward interface entry, None when its device is not in NetBox:
+        The entries skipped are counted by device name in missing.
+        """
         raw_device_map = self._get_interface_map_helper()  # device_name -> device_id
         raw_vdc_map = self._get_virtual_device_context_map_helper()  # vdc_name -> (parent_device_id, vdc_id)
 
@@ -595,7 +1174,7 @@ class NetboxAPI(ApiConnector):
         device_map = {k.lower(): v for k, v in raw_device_map.items()}
         vdc_map = {k.lower(): v for k, v in raw_vdc_map.items()}
 
-        for entry in query:
+        def adapt(entry):
             original_device_name = entry["device"]
             lookup_name = original_device_name.lower()
 
@@ -610,8 +1189,8 @@ class NetboxAPI(ApiConnector):
                 entry["vdcs"] = [vdc_id]
 
             else:
-                logging.warning(f"[Interface Adapt] Device or VDC '{original_device_name}' not found in NetBox. Skipping.")
-                continue
+                missing[original_device_name] += 1
+                return None
 
             # Interface type normalization
             entry["type"] = self.speeds_types.get(entry["type"], "other")
@@ -621,18 +1200,55 @@ class NetboxAPI(ApiConnector):
                 entry["speed"] *= 1000
             else:
                 entry["speed"] = 0
+            return entry
 
-        return query
+        return adapt
 
     def _get_paginated(self, original_path: str):
-        path = f"{original_path}?limit={self.request_limit}"
+        """GET every page of a NetBox list endpoint:
+        The first page returns the total count, the remaining pages
+        are then fetched concurrently and stored in a preallocated
+        list so the results are returned in page order.
+        """
+        separator = "&" if "?" in original_path else "?"
+        path = f"{original_path}{separator}limit={self.request_limit}"
         response = self._get(path)
-        if response is not None:
-            count = response["count"]
-            if count > self.request_limit:
-                for i in range(1, ceil(count/self.request_limit)):
-                    new_path = f"{path}&offset={(self.request_limit*i)}"
-                    offset_response = self._get(new_path)
-                    if offset_response is not None:
-                        response["results"] = response["results"] + offset_response["results"]
+        if response is None:
+            return None
+
+        page_count = ceil(response["count"] / self.request_limit)
+        if page_count <= 1:
+            return response
+
+        def get_page(page):
+            offset_response = self._get(f"{path}&offset={self.request_limit * page}")
+            if offset_response is None:
+                logging.warning("Missing page %d of %s", page, original_path)
+                return []
+            return offset_response["results"]
+
+        pages = [None] * page_count
+        pages[0] = response["results"]
+        pages[1:] = self._map_concurrently(get_page, range(1, page_count))
+        response["results"] = [result for results in pages for result in results]
         return response
+
+    def _iter_paginated(self, original_path: str):
+        """Yield the results of every page of a NetBox list endpoint in page order,
+        a few pages are fetched ahead of the consumer.
+        """
+        separator = "&" if "?" in original_path else "?"
+        path = f"{original_path}{separator}limit={self.request_limit}"
+        response = self._get(path)
+        if response is None:
+            return
+        yield response["results"]
+
+        def get_page(page):
+            offset_response = self._get(f"{path}&offset={self.request_limit * page}")
+            if offset_response is None:
+                logging.warning("Missing page %d of %s", page, original_path)
+                return []
+            return offset_response["results"]
+
+        yield from self._iter_concurrently(get_page, range(1, ceil(response["count"] / self.request_limit)))
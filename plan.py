@@ -0,0 +1,89 @@
+"""Sync plans: the NetBox writes of a dry run, saved to a file and applied later"""
+import json
+import threading
+from datetime import datetime, timezone
+
+PLAN_VERSION = 1
+ACTIONS = {"POST": "create", "PATCH": "update", "DELETE": "delete"}
+
+
+class Plan:
+    """Writes recorded instead of sent to NetBox, per endpoint and action:
+    Objects to create get a negative placeholder id, returned to the
+    caller like NetBox would return the created object, so later stages
+    can reference them. Applying the plan replaces the placeholders with
+    the ids NetBox assigns.
+    """
+
+    def __init__(self):
+        self.changes = {}  # path -> {"create": [...], "update": [...], "delete": [...]}, in first write order
+        self.metadata = {}
+        self._next_placeholder = -1
+        self._lock = threading.Lock()
+
+    def record(self, method: str, path: str, records: list) -> list:
+        """Record a write and return the objects NetBox would have sent back"""
+        action = ACTIONS.get(method.upper())
+        if action is None:
+            raise ValueError(f"Unsupported write method in a plan: {method}")
+        payloads = [dict(record.items()) for record in records]
+        with self._lock:
+            entity = self.changes.setdefault(path, {"create": [], "update": [], "delete": []})
+            if action == "create":
+                for payload in payloads:
+                    payload["id"] = self._next_placeholder
+                    self._next_placeholder -= 1
+            entity[action].extend(payloads)
+        if action == "create":
+            # Lookup maps index devices and sites by name and device types by display
+            return [{"display": payload.get("model", payload.get("name")), **payload} for payload in payloads]
+        return payloads
+
+    def summary(self) -> dict:
+        """Return the number of creates, updates and deletes per endpoint"""
+        return {path: {action: len(records) for action, records in entity.items()}
+                for path, entity in self.changes.items()}
+
+    def is_empty(self) -> bool:
+        return not any(records for entity in self.changes.values() for records in entity.values())
+
+    def to_dict(self) -> dict:
+        return {
+            "version": PLAN_VERSION,
+            "created": datetime.now(timezone.utc).isoformat(),
+            **self.metadata,
+            "summary": self.summary(),
+            "changes": self.changes,
+        }
+
+    def save(self, path: str):
+        with open(path, "w", encoding="UTF-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> "Plan":
+        with open(path, "r", encoding="UTF-8") as f:
+            data = json.load(f)
+        if data.get("version") != PLAN_VERSION:
+            raise ValueError(f"Unsupported plan version {data.get('version')} in {path}")
+        plan = cls()
+        plan.changes = data["changes"]
+        plan.metadata = {key: value for key, value in data.items()
+                         if key not in ("version", "created", "summary", "changes")}
+        return plan
+
+
+# Payload fields holding the id of another object, possibly one created by the same plan
+REFERENCE_FIELDS = ("device", "site", "role", "device_type", "manufacturer", "master", "vdcs")
+
+
+def resolve_placeholders(payload: dict, ids: dict) -> dict:
+    """Replace the placeholder ids referenced by a planned payload by the ids NetBox assigned"""
+    def resolve(value):
+        if isinstance(value, list):
+            return [resolve(item) for item in value]
+        if isinstance(value, int) and not isinstance(value, bool) and value < 0:
+            return ids.get(value, value)
+        return value
+
+    return {key: resolve(value) if key in REFERENCE_FIELDS else value for key, value in payload.items()}
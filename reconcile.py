@@ -0,0 +1,166 @@
+"""Reconciliation of Forward records against existing NetBox objects"""
+from common import logging
+
+# Fields NetBox normalizes to a different case than Forward reports them
+CASE_INSENSITIVE_FIELDS = {"mac_address"}
+
+
+def ref_id(value):
+    """Return the id of a nested NetBox reference, or the value itself"""
+    if isinstance(value, dict):
+        return value.get("id")
+    return value
+
+
+def _normalize(value):
+    """Reduce a NetBox value to the shape Forward payloads use:
+    nested references such as device or site become their id,
+    choice fields such as status or type become their value.
+    """
+    if isinstance(value, dict):
+        if "id" in value:
+            return value["id"]
+        if "value" in value:
+            return value["value"]
+        return value
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    if value == "":
+        return None
+    return value
+
+
+def _same(desired, current, field=None) -> bool:
+    """Compare a Forward payload value with the NetBox value of the same field"""
+    if isinstance(desired, dict) and isinstance(current, dict):
+        return all(key in current and _same(value, current[key], key) for key, value in desired.items())
+    current = _normalize(current)
+    if isinstance(desired, list) and isinstance(current, list):
+        desired = [_normalize(item) for item in desired]
+        if len(desired) != len(current):
+            return False
+        try:
+            return sorted(desired) == sorted(current)
+        except TypeError:
+            return desired == current
+    if desired == "":
+        desired = None
+    if field in CASE_INSENSITIVE_FIELDS and isinstance(desired, str) and isinstance(current, str):
+        return desired.lower() == current.lower()
+    return desired == current
+
+
+def diff_fields(record, existing, ignore=("id",)) -> dict:
+    """Return the fields of a Forward record whose value differs from the NetBox object.
+    Fields NetBox does not return are skipped, NetBox ignores them on write as well.
+    """
+    changes = {}
+    for field, desired in record.items():
+        if field in ignore or field not in existing:
+            continue
+        if not _same(desired, existing[field], field):
+            changes[field] = desired
+    return changes
+
+
+def index_by(records, key) -> dict:
+    """Build a dictionary of key(record) -> record, first occurrence wins"""
+    index = {}
+    for record in records:
+        index.setdefault(key(record), record)
+    return index
+
+
+class ReconcileResult:
+    """Outcome of matching a list of Forward records against NetBox objects"""
+
+    def __init__(self):
+        self.create = []     # Forward records not present in NetBox
+        self.update = []     # Forward records present in NetBox, "id" is set
+        self.patches = []    # PATCH payload of each updated record
+        self.unchanged = []  # Forward records present in NetBox that need no update
+        self.orphans = []    # NetBox objects not present in Forward
+
+    def __repr__(self):
+        return (f"ReconcileResult(create={len(self.create)}, update={len(self.update)}, "
+                f"unchanged={len(self.unchanged)}, orphans={len(self.orphans)})")
+
+
+class Reconciler:
+    """Match Forward records against an index of NetBox objects, one batch at a time:
+    Batches can be reconciled as they arrive, the keys looked up
+    so far are remembered so the orphans can be computed once the
+    last batch is done.
+    """
+
+    def __init__(self, index: dict, fwd_key, diff=None, on_match=None):
+        self.index = index
+        self.fwd_key = fwd_key
+        self.diff = diff
+        self.on_match = on_match
+        self.seen = set()
+
+    def reconcile(self, fwd_records) -> ReconcileResult:
+        """Sort a batch of Forward records into the create, update and unchanged lists"""
+        result = ReconcileResult()
+        for record in fwd_records:
+            key = self.fwd_key(record)
+            existing = self.index.get(key)
+            if existing is None:
+                result.create.append(record)
+                continue
+            self.seen.add(key)
+            record["id"] = existing["id"]
+            if self.on_match is not None:
+                self.on_match(record, existing)
+            if self.diff is None:
+                result.update.append(record)
+                result.patches.append(record)
+                continue
+            changes = self.diff(record, existing)
+            if changes:
+                result.update.append(record)
+                result.patches.append({"id": record["id"], **changes})
+            else:
+                result.unchanged.append(record)
+        return result
+
+    def orphans(self) -> list:
+        """Return the NetBox objects no Forward record matched so far"""
+        return [existing for key, existing in self.index.items() if key not in self.seen]
+
+
+def reduce_object(existing, fields) -> dict:
+    """Keep the id and the given fields of a NetBox object, in the shape Forward payloads use"""
+    reduced = {"id": existing["id"]}
+    for field in fields:
+        if field in existing:
+            reduced[field] = _normalize(existing[field])
+    return reduced
+
+
+def reconcile(fwd_records, existing_records, fwd_key, existing_key=None, diff=None, on_match=None):
+    """Match Forward records against NetBox objects in linear time:
+    This function indexes the NetBox objects by key, then looks up
+    every Forward record in that index. Matched records get the id
+    of the NetBox object and are sorted into the update or unchanged
+    lists, the others go into the create list. NetBox objects whose
+    key was never looked up are returned as orphans. When a diff
+    function is given the PATCH payloads only carry the changed fields.
+
+    Keyword arguments:
+    fwd_records -- List of (adapted) Forward records.
+    existing_records -- List of NetBox objects.
+    fwd_key -- Function returning the matching key of a Forward record.
+    existing_key -- Function returning the matching key of a NetBox object, defaults to fwd_key.
+    diff -- Function (record, existing) -> dict of changed fields, matched records are all updates when omitted.
+    on_match -- Function (record, existing) called for every matched record.
+    """
+    if existing_key is None:
+        existing_key = fwd_key
+    reconciler = Reconciler(index_by(existing_records, existing_key), fwd_key, diff, on_match)
+    result = reconciler.reconcile(fwd_records)
+    result.orphans = reconciler.orphans()
+    logging.debug("Reconciled %d records against %d NetBox objects: %s",
+                  len(fwd_records), len(existing_records), result)
+    return result
@@ -0,0 +1,119 @@
+"""Compact records of the Forward rows synced in bulk (devices, interfaces, VDCs)"""
+import sys
+
+_MISSING = object()
+
+
+class Record:
+    """Slotted record that behaves like the dictionary it replaces:
+    The fields declared by a subclass are stored in slots instead of
+    a per-row dictionary, names repeated across rows are interned,
+    and any other field of the NQE row is kept in the extra dictionary.
+    Records are converted back to dictionaries only when written.
+    """
+
+    __slots__ = ("extra",)
+    FIELDS = ()    # Fields stored in slots, in payload order
+    INTERNED = ()  # String fields shared by many rows
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.FIELDS)
+        cls._interned = frozenset(cls.INTERNED)
+
+    def __init__(self, **fields):
+        self.extra = None
+        for key, value in fields.items():
+            self[key] = value
+
+    @classmethod
+    def from_row(cls, row):
+        """Build a record from an NQE row or a NetBox object"""
+        record = cls()
+        for key, value in row.items():
+            record[key] = value
+        return record
+
+    def to_payload(self) -> dict:
+        """Return the dictionary sent to NetBox"""
+        return dict(self.items())
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            value = getattr(self, key, _MISSING)
+        elif self.extra is not None:
+            value = self.extra.get(key, _MISSING)
+        else:
+            value = _MISSING
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            if key in self._interned and type(value) is str:
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        if key in self._field_set:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> list:
+        keys = [field for field in self.FIELDS if hasattr(self, field)]
+        if self.extra:
+            keys.extend(self.extra)
+        return keys
+
+    def items(self) -> list:
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())})"
+
+
+class InterfaceRecord(Record):
+    FIELDS = ("id", "device", "name", "type", "speed", "enabled", "description", "mtu", "mac_address", "vdcs")
+    INTERNED = ("device",)
+    __slots__ = FIELDS
+
+
+class DeviceRecord(Record):
+    FIELDS = ("id", "name", "device_type", "site", "role", "status", "platform", "serial")
+    INTERNED = ("device_type", "site", "role", "status", "platform")
+    __slots__ = FIELDS
+
+
+class VdcRecord(Record):
+    FIELDS = ("id", "device", "name", "identifier", "status")
+    INTERNED = ("device", "status")
+    __slots__ = FIELDS
+
+
+def to_payload(obj):
+    """JSON encoder fallback converting records to dictionaries"""
+    if isinstance(obj, Record):
+        return obj.to_payload()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
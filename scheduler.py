@@ -0,0 +1,140 @@
+"""Dependency-aware scheduler running the export stages concurrently"""
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from common import logging
+
+
+class Stage:
+    """A unit of work started once all the stages it depends on are done"""
+
+    def __init__(self, name: str, func, deps=()):
+        self.name = name
+        self.func = func      # Called with the dictionary of results of the completed stages
+        self.deps = list(deps)
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.cpu_time = 0.0  # CPU time of the thread running the stage, worker threads excluded
+
+    @property
+    def duration(self) -> float:
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+
+class StageScheduler:
+    """Run stages as soon as their dependencies complete, independent stages run concurrently"""
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.stages = {}
+        self.started = None
+        self.finished = None
+
+    def add(self, name: str, func, deps=()) -> Stage:
+        """Declare a stage, dependencies on stages that are never added are ignored"""
+        self.stages[name] = Stage(name, func, deps)
+        return self.stages[name]
+
+    def run(self) -> dict:
+        """Run every stage and return their results by name:
+        A stage whose dependency failed is skipped, the other
+        stages keep running. A RuntimeError listing the failed
+        stages is raised once everything else is done.
+        """
+        for stage in self.stages.values():
+            stage.deps = [dep for dep in stage.deps if dep in self.stages]
+        self._check_cycles()
+
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        failed = []
+        self.started = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if any(dep in failed for dep in stage.deps):
+                        logging.error("Skipping stage %s, a stage it depends on failed", name)
+                        failed.append(name)
+                        del pending[name]
+                    elif all(dep in results for dep in stage.deps):
+                        running[executor.submit(self._run_stage, stage, dict(results))] = stage
+                        del pending[name]
+
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    if stage.error is None:
+                        results[stage.name] = stage.result
+                    else:
+                        failed.append(stage.name)
+
+        self.finished = time.perf_counter()
+        self.report()
+        if failed:
+            raise RuntimeError(f"Stages failed: {', '.join(failed)}")
+        return results
+
+    @staticmethod
+    def _run_stage(stage: Stage, results: dict):
+        stage.started = time.perf_counter()
+        cpu_started = time.thread_time()
+        try:
+            stage.result = stage.func(results)
+        except Exception as e:  # Reported by run(), dependent stages are skipped
+            logging.exception("Stage %s failed: %s", stage.name, e)
+            stage.error = e
+        finally:
+            stage.finished = time.perf_counter()
+            stage.cpu_time = time.thread_time() - cpu_started
+
+    def _check_cycles(self):
+        """Raise a ValueError when the declared dependencies contain a cycle"""
+        visiting, visited = set(), set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage dependency cycle involving {name}")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def critical_path(self) -> list:
+        """Return the chain of stages that determined the total run time"""
+        finished = [stage for stage in self.stages.values() if stage.finished is not None]
+        if not finished:
+            return []
+        stage = max(finished, key=lambda s: s.finished)
+        path = [stage]
+        while True:
+            deps = [self.stages[dep] for dep in stage.deps if self.stages[dep].finished is not None]
+            if not deps:
+                break
+            stage = max(deps, key=lambda s: s.finished)
+            path.append(stage)
+        return list(reversed(path))
+
+    def report(self):
+        """Log the duration of each stage and the critical path"""
+        if self.started is None or self.finished is None:
+            return
+        for stage in sorted(self.stages.values(), key=lambda s: s.started or 0):
+            if stage.started is not None:
+                logging.info("Stage %s: %.2fs, %.2fs CPU (started at +%.2fs)",
+                             stage.name, stage.duration, stage.cpu_time, stage.started - self.started)
+        path = self.critical_path()
+        logging.info("Critical path: %s (%.2fs of %.2fs)", " -> ".join(stage.name for stage in path),
+                     sum(stage.duration for stage in path), self.finished - self.started)
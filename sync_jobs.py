@@ -0,0 +1,132 @@
+"""Sync jobs triggered by Forward snapshot notifications, run on a background pool one network at a time"""
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+EXPORT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "export_to_netbox.py")
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class SyncJobs:
+    """Queue of export runs, at most one running and one waiting per network:
+    A trigger for a network that already has a waiting job is
+    coalesced into it. A trigger arriving while the network syncs
+    gets a new job, started once the running one is done, so runs
+    of a network never overlap. Each job runs export_to_netbox.py
+    for its network in a subprocess. The last history jobs are
+    kept with their status, timings and last output lines.
+    """
+
+    def __init__(self, config_file="configuration.yaml", workers=1, history=100, output_lines=20):
+        self.config_file = config_file
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sync-job")
+        self.history = history
+        self.output_lines = output_lines
+        self.jobs = OrderedDict()  # job id -> job, oldest first
+        self.networks = {}  # network id -> {"running": job id, "waiting": job id}
+        self._lock = threading.Lock()
+
+    def submit(self, network_id, snapshot_id=None, trigger=None):
+        """Queue a sync of a network, return the job and whether the trigger was coalesced into it"""
+        network_id = str(network_id)
+        with self._lock:
+            state = self.networks.setdefault(network_id, {"running": None, "waiting": None})
+            if state["waiting"] is not None:
+                job = self.jobs[state["waiting"]]
+                job["triggers"] += 1
+                if snapshot_id is not None:
+                    job["snapshot_id"] = snapshot_id
+                return self._public(job), True
+            job = {
+                "id": uuid.uuid4().hex,
+                "network_id": network_id,
+                "snapshot_id": snapshot_id,
+                "trigger": trigger,
+                "triggers": 1,
+                "status": "queued",
+                "progress": None,
+                "created": _now(),
+                "started": None,
+                "finished": None,
+                "queued_seconds": None,
+                "run_seconds": None,
+                "returncode": None,
+                "output": [],
+                "_queued_at": time.monotonic(),
+            }
+            self.jobs[job["id"]] = job
+            state["waiting"] = job["id"]
+            if state["running"] is None:
+                self.executor.submit(self._run, job)
+            self._trim()
+            return self._public(job), False
+
+    def get(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return self._public(job) if job is not None else None
+
+    def list(self) -> list:
+        """Return the known jobs, newest first"""
+        with self._lock:
+            return [self._public(job) for job in reversed(self.jobs.values())]
+
+    def _run(self, job):
+        with self._lock:
+            state = self.networks[job["network_id"]]
+            state["waiting"] = None
+            state["running"] = job["id"]
+            job["status"] = "running"
+            job["started"] = _now()
+            job["queued_seconds"] = round(time.monotonic() - job["_queued_at"], 3)
+        started = time.monotonic()
+        output = deque(maxlen=self.output_lines)
+        process = None
+        returncode = None
+        try:
+            process = subprocess.Popen([sys.executable, EXPORT_SCRIPT, "-c", self.config_file,
+                                        "--networks", job["network_id"]],
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            for line in process.stdout:
+                line = line.rstrip()
+                with self._lock:
+                    output.append(line)
+                    job["output"] = list(output)
+                    if "========>" in line:
+                        job["progress"] = line.split("========>", 1)[1].strip()
+            returncode = process.wait()
+        except Exception as e:
+            output.append(str(e))
+            if process is not None and process.poll() is None:
+                process.kill()
+        finally:
+            # Always release the network, or its next notifications would wait forever
+            with self._lock:
+                job["returncode"] = returncode
+                job["status"] = "succeeded" if returncode == 0 else "failed"
+                job["finished"] = _now()
+                job["run_seconds"] = round(time.monotonic() - started, 3)
+                job["output"] = list(output)
+                state = self.networks[job["network_id"]]
+                state["running"] = None
+                if state["waiting"] is not None:
+                    self.executor.submit(self._run, self.jobs[state["waiting"]])
+
+    def _trim(self):
+        """Forget the oldest finished jobs beyond history"""
+        finished = [job_id for job_id, job in self.jobs.items() if job["status"] in ("succeeded", "failed")]
+        for job_id in finished[:max(len(self.jobs) - self.history, 0)]:
+            del self.jobs[job_id]
+
+    @staticmethod
+    def _public(job) -> dict:
+        return {key: value for key, value in job.items() if not key.startswith("_")}
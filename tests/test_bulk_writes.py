@@ -0,0 +1,98 @@
+"""Bulk writes narrowing failed chunks down to their invalid records"""
+import json
+
+import requests
+
+from common import ApiConnector
+
+PATH = "/api/dcim/sites/"
+
+
+class StubSession:
+    """Session answering every request with handler(records), records are the decoded payload"""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.sent = []  # Names of the records of every request, in sending order
+        self.written = []  # Records accepted by the stub NetBox
+
+    def request(self, method, url, headers=None, data=None, timeout=None, verify=None):
+        records = json.loads(data)
+        self.sent.append([record["name"] for record in records])
+        status, body = self.handler(records)
+        if status < 400:
+            body = [dict(record, id=len(self.written) + i + 1) for i, record in enumerate(records)]
+            self.written.extend(records)
+        response = requests.Response()
+        response.status_code = status
+        response.headers["Content-Type"] = "application/json"
+        response._content = json.dumps(body).encode()
+        return response
+
+    def close(self):
+        pass
+
+
+def connector(handler, post_limit=10, max_post_limit=10):
+    api = ApiConnector("http://netbox", "Token x", {}, retries=0, json_codec="json")
+    api.post_limit = post_limit
+    api.max_post_limit = max_post_limit
+    api.bulk_target_latency = 10
+    api.session = StubSession(handler)
+    return api
+
+
+def records(*names):
+    return [{"name": name} for name in names]
+
+
+def test_per_record_errors_resend_the_valid_records():
+    def handler(sent):
+        if any(record["name"].startswith("bad") for record in sent):
+            return 400, [{"name": ["invalid"]} if record["name"].startswith("bad") else {} for record in sent]
+        return 201, None
+
+    api = connector(handler)
+    results = api._bulkpost(PATH, records("a", "bad1", "b", "bad2", "c"))
+
+    assert [result["name"] for result in results] == ["a", "b", "c"]
+    assert api.session.written == records("a", "b", "c")
+    assert api.session.sent == [["a", "bad1", "b", "bad2", "c"], ["a", "b", "c"]]
+    assert api.bulk_failures == [
+        {"method": "POST", "path": PATH, "status": 400, "record": {"name": "bad1"}, "error": {"name": ["invalid"]}},
+        {"method": "POST", "path": PATH, "status": 400, "record": {"name": "bad2"}, "error": {"name": ["invalid"]}},
+    ]
+
+
+def test_opaque_error_bisects_down_to_the_invalid_record():
+    def handler(sent):
+        if any(record["name"] == "bad" for record in sent):
+            return 400, {"detail": "invalid chunk"}
+        return 201, None
+
+    api = connector(handler)
+    results = api._bulkpost(PATH, records("a", "b", "bad", "c"))
+
+    assert [result["name"] for result in results] == ["a", "b", "c"]
+    assert api.session.written == records("a", "b", "c")
+    assert api.session.sent == [["a", "b", "bad", "c"], ["a", "b"], ["bad", "c"], ["bad"], ["c"]]
+    assert api.bulk_failures == [
+        {"method": "POST", "path": PATH, "status": 400, "record": {"name": "bad"}, "error": {"detail": "invalid chunk"}},
+    ]
+    assert api.error_count == 1
+
+
+def test_too_large_halves_the_chunk():
+    def handler(sent):
+        if len(sent) > 2:
+            return 413, {"detail": "request entity too large"}
+        return 201, None
+
+    api = connector(handler, max_post_limit=2)
+    results = api._bulkpost(PATH, records("a", "b", "c", "d", "e"))
+
+    assert [result["name"] for result in results] == ["a", "b", "c", "d", "e"]
+    assert api.session.written == records("a", "b", "c", "d", "e")
+    assert api.session.sent == [["a", "b", "c", "d", "e"], ["a", "b"], ["c", "d"], ["e"]]
+    assert api.bulk_failures == []
+    assert api._chunk_sizes[("POST", PATH)] == 2
@@ -0,0 +1,62 @@
+"""Run cache of the NetBox collections and lookup maps"""
+from netbox_interface import NetboxAPI
+from reconcile import diff_fields, reconcile
+
+
+def netbox(**config):
+    return NetboxAPI({"host": "http://netbox", "authentication": "Token x", "timeout": 5, **config})
+
+
+def test_empty_results_are_cached():
+    api = netbox()
+    fetched = []
+
+    def get_paginated(path):
+        fetched.append(path)
+        return {"count": 0, "next": None, "previous": None, "results": []}
+
+    api._get_paginated = get_paginated
+    assert api._get_site_map_helper() == {}
+    assert api._get_site_map_helper() == {}
+    assert api.get_virtual_chassis()["results"] == []
+    assert api.get_virtual_chassis()["results"] == []
+    assert fetched == ["/api/dcim/sites/?fields=id,name", "/api/dcim/virtual-chassis/"]
+
+
+def test_patch_after_post_replaces_the_created_object():
+    api = netbox()
+    api._get_paginated = lambda path: {"count": 1, "next": None, "previous": None,
+                                       "results": [{"id": 1, "name": "site-a", "status": "active"}]}
+    api.get_sites()
+    api._update_cache("/api/dcim/sites/", "PATCH", [{"id": 1, "name": "site-a", "status": "planned"}])
+    api._update_cache("/api/dcim/sites/", "POST", [{"id": 2, "name": "site-b", "status": "active"}])
+    api._update_cache("/api/dcim/sites/", "PATCH", [{"id": 2, "name": "site-b", "status": "retired"}])
+
+    existing = api.get_sites()["results"]
+    assert existing == [{"id": 1, "name": "site-a", "status": "planned"},
+                        {"id": 2, "name": "site-b", "status": "retired"}]
+    result = reconcile([{"name": "site-b", "status": "retired"}], existing,
+                       fwd_key=lambda site: site["name"], existing_key=lambda site: site["name"], diff=diff_fields)
+    assert result.patches == []
+    assert len(result.unchanged) == 1
+
+
+def test_scoped_interfaces_are_not_cached_as_the_full_collection():
+    api = netbox()
+    interfaces = [{"id": 1, "name": "eth0", "device": {"id": 1}}, {"id": 2, "name": "eth0", "device": {"id": 2}}]
+    fetched = []
+
+    def get_paginated(path):
+        fetched.append(path)
+        results = [interface for interface in interfaces
+                   if "?" not in path or path.endswith(f"device_id={interface['device']['id']}")]
+        return {"count": len(results), "next": None, "previous": None, "results": results}
+
+    api._get_paginated = get_paginated
+    api._fetch_scoped_devices = lambda: {1: "dev-a"}
+    api.set_scope([], ["dev-a"])
+    assert [interface["id"] for interface in api.get_interfaces()["results"]] == [1]
+    api._update_cache("/api/dcim/interfaces/", "POST", [{"id": 3, "name": "eth1", "device": {"id": 1}}])
+    assert [interface["id"] for interface in api.get_interfaces()["results"]] == [1, 3]
+    assert [interface["id"] for interface in api._get_collection("/api/dcim/interfaces/")["results"]] == [1, 2]
+    assert fetched == ["/api/dcim/interfaces/?device_id=1", "/api/dcim/interfaces/"]
@@ -0,0 +1,23 @@
+"""Applying the plans recorded by dry runs"""
+from netbox_interface import DELETE_ORDER, NetboxAPI
+from plan import Plan
+
+
+def test_delete_only_plan_deletes_children_first():
+    plan = Plan()
+    for path, _ in DELETE_ORDER:
+        if path != "/api/dcim/virtual-chassis/":
+            plan.record("DELETE", path, [{"id": 7}])
+    api = NetboxAPI({"host": "http://netbox", "authentication": "Token x", "timeout": 5})
+    deleted = []
+
+    def bulkdelete(path, records):
+        deleted.append(path)
+        return records
+
+    api._bulkdelete = bulkdelete
+    applied = api.apply_plan(plan)
+
+    assert deleted == ["/api/dcim/interfaces/", "/api/dcim/virtual-device-contexts/", "/api/dcim/devices/",
+                       "/api/dcim/sites/"]
+    assert all(applied[path]["delete"] == 1 for path in deleted)
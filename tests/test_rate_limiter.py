@@ -0,0 +1,26 @@
+"""Rate limits shared by the worker processes of a multi-network run"""
+import multiprocessing
+import time
+
+from common import SharedRateLimiter
+
+
+def take_tokens(limiter, times, first, count):
+    for i in range(first, first + count):
+        limiter.acquire()
+        times[i] = time.monotonic()
+
+
+def test_shared_rate_limiter_bounds_every_process():
+    context = multiprocessing.get_context("spawn")
+    limiter = SharedRateLimiter(context, rate=50, burst=1)
+    times = context.RawArray("d", 30)
+    processes = [context.Process(target=take_tokens, args=(limiter, times, 10 * i, 10)) for i in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert [process.exitcode for process in processes] == [0, 0, 0]
+    # 30 tokens at 50 per second after the first one, instead of 10 per process in parallel
+    assert max(times) - min(times) >= 29 / 50 * 0.95
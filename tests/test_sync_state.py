@@ -0,0 +1,32 @@
+"""Snapshots recorded as synced in the state file"""
+import multiprocessing
+
+from forward_interface import ForwardAPI
+
+QUERIES = ("locations", "vendors", "device_types", "device_models", "devices", "interfaces",
+           "virtual_device_contexts", "virtual_chassis")
+
+
+def forward(state_file):
+    return ForwardAPI({"host": "http://forward", "authentication": "Basic x", "timeout": 5, "network_id": "1",
+                       "nqe": {f"{query}_query_id": query for query in QUERIES}, "state_file": state_file})
+
+
+def save_networks(state_file, network_ids):
+    api = forward(state_file)
+    for network_id in network_ids:
+        api.pin_snapshot(network_id, f"snapshot-{network_id}")
+        api.save_sync_state(network_id)
+
+
+def test_concurrent_saves_keep_every_network(tmp_path):
+    state_file = str(tmp_path / "sync_state.json")
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=save_networks, args=(state_file, [f"{worker}-{i}" for i in range(25)]))
+                 for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert forward(state_file).read_sync_state() == {f"{worker}-{i}": f"snapshot-{worker}-{i}"
+                                                     for worker in range(4) for i in range(25)}